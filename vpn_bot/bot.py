@@ -24,6 +24,11 @@ from database.models import BotInstance
 from handlers import user_router, admin_router
 from services.scheduler import SchedulerService
 from services.uptime_monitor import init_monitor
+from services.ssh_pool import ssh_pool
+from services.provisioning import ProvisioningService
+from services.migration import MigrationService
+from services.remote_agent import AgentRegistry
+from services.bulkhead import OpPriority, operation_priority
 from sqlalchemy import select
 
 logging.basicConfig(
@@ -209,6 +214,24 @@ async def main():
     dp.message.middleware(BlockedUserMiddleware())
     dp.callback_query.middleware(BlockedUserMiddleware())
     
+    class OperationPriorityMiddleware(BaseMiddleware):
+        """SSH операции из хендлеров роутера получают его приоритет в очереди сервера"""
+        def __init__(self, priority: OpPriority):
+            self.priority = priority
+        
+        async def __call__(
+            self,
+            handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any]
+        ) -> Any:
+            with operation_priority(self.priority):
+                return await handler(event, data)
+    
+    for router, priority in ((user_router, OpPriority.USER), (admin_router, OpPriority.ADMIN)):
+        router.message.middleware(OperationPriorityMiddleware(priority))
+        router.callback_query.middleware(OperationPriorityMiddleware(priority))
+    
     # Глобальный обработчик ошибок
     from aiogram.types import ErrorEvent
     
@@ -246,6 +269,15 @@ async def main():
     uptime_monitor = init_monitor(bot)
     uptime_monitor.start()
     
+    # Пул SSH соединений к VPN серверам
+    ssh_pool.start()
+    
+    # Воркеры очереди заданий на создание конфигов
+    await ProvisioningService.start(bots)
+    
+    # Переносы клиентов, прерванные перезапуском
+    await MigrationService.resume_all()
+    
     # Логирование в Telegram
     from services.telegram_logger import setup_telegram_logging, TelegramLogHandler
     setup_telegram_logging(bot)
@@ -263,6 +295,9 @@ async def main():
     
     scheduler.stop()
     uptime_monitor.stop()
+    ProvisioningService.stop()
+    AgentRegistry.close_all()
+    await ssh_pool.stop()
     TelegramLogHandler.stop()
     for b in bots:
         await b.session.close()
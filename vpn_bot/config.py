@@ -19,6 +19,9 @@ LOCAL_MODE = os.getenv("LOCAL_MODE", "false").lower() == "true"
 
 DATABASE_URL = "sqlite+aiosqlite:///./vpn_bot.db"
 
+# Кэш отрисованных QR-кодов на диске
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR", "./qr_cache")
+
 TARIFFS = {
     "trial": {"days": 3, "price": 0, "name": "3 дня"},
     "30": {"days": 30, "price": 200, "name": "30 дней"},
@@ -1,4 +1,4 @@
 from .db import async_session, init_db
-from .models import User, Config, Subscription, Payment, Settings, Server, WithdrawalRequest, BotInstance, ConfigQueue, BotSettings
+from .models import User, Config, Subscription, Payment, Settings, Server, WithdrawalRequest, BotInstance, ConfigQueue, BotSettings, PooledPeer, IpPool, IpAllocation, MediaFile, Migration, MigrationItem, TrafficSample, TrafficRollup
 
-__all__ = ["async_session", "init_db", "User", "Config", "Subscription", "Payment", "Settings", "Server", "WithdrawalRequest", "BotInstance", "ConfigQueue", "BotSettings"]
+__all__ = ["async_session", "init_db", "User", "Config", "Subscription", "Payment", "Settings", "Server", "WithdrawalRequest", "BotInstance", "ConfigQueue", "BotSettings", "PooledPeer", "IpPool", "IpAllocation", "MediaFile", "Migration", "MigrationItem", "TrafficSample", "TrafficRollup"]
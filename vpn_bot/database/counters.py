@@ -0,0 +1,152 @@
+"""
+Счётчики активных клиентов на серверах (Server.active_clients и по протоколам).
+
+Счётчики меняются в той же транзакции, что и сами конфиги: перед flush
+смотрим на новые, удалённые и изменённые Config (is_active, server_id,
+protocol_type) и одним UPDATE на сервер сдвигаем счётчики. Так выбор
+сервера и проценты заполненности читают готовое число вместо COUNT по
+configs.
+
+Массовые UPDATE/DELETE по configs (в обход ORM) счётчики не видят —
+их выравнивает recount_client_counters (при старте и по расписанию).
+"""
+
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, inspect, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .models import Config, Server
+
+logger = logging.getLogger(__name__)
+
+# Колонка счётчика протокола
+PROTOCOL_COLUMNS = {"wg": "active_wg", "awg": "active_awg", "v2ray": "active_v2ray"}
+COUNTER_COLUMNS = ("active_clients",) + tuple(PROTOCOL_COLUMNS.values())
+
+
+def _slot(server_id: Optional[int], protocol: Optional[str], is_active: Optional[bool]) -> Optional[Tuple[int, str]]:
+    """(сервер, протокол), который конфиг занимает, или None — не занимает"""
+    if not server_id or is_active is False:
+        return None
+    return server_id, protocol if protocol in PROTOCOL_COLUMNS else "wg"
+
+
+def _committed(config: Config, attr: str):
+    """Значение атрибута до изменений в этой сессии"""
+    history = inspect(config).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(config, attr)
+
+
+def _committed_slot(config: Config) -> Optional[Tuple[int, str]]:
+    return _slot(
+        _committed(config, "server_id"),
+        _committed(config, "protocol_type"),
+        _committed(config, "is_active"),
+    )
+
+
+def _current_slot(config: Config) -> Optional[Tuple[int, str]]:
+    server_id = config.server_id
+    if server_id is None:
+        # server задан связью, server_id появится только при flush
+        server = config.__dict__.get("server")
+        server_id = server.id if server is not None else None
+    return _slot(server_id, config.protocol_type, config.is_active)
+
+
+def track_client_counters(session: Session, flush_context, instances) -> None:
+    """before_flush: сдвинуть счётчики серверов по изменённым конфигам"""
+    deltas: Dict[Tuple[int, str], int] = defaultdict(int)
+
+    for obj in session.new:
+        if isinstance(obj, Config):
+            slot = _current_slot(obj)  # is_active=None — сработает default True
+            if slot:
+                deltas[slot] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Config):
+            slot = _committed_slot(obj)
+            if slot:
+                deltas[slot] -= 1
+
+    for obj in session.dirty:
+        if isinstance(obj, Config) and session.is_modified(obj):
+            old, new = _committed_slot(obj), _current_slot(obj)
+            if old != new:
+                if old:
+                    deltas[old] -= 1
+                if new:
+                    deltas[new] += 1
+
+    by_server: Dict[int, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for (server_id, protocol), delta in deltas.items():
+        if delta:
+            by_server[server_id]["active_clients"] += delta
+            by_server[server_id][PROTOCOL_COLUMNS[protocol]] += delta
+
+    table = Server.__table__
+    for server_id, columns in by_server.items():
+        session.connection().execute(
+            update(table)
+            .where(table.c.id == server_id)
+            .values({
+                name: func.coalesce(table.c[name], 0) + delta
+                for name, delta in columns.items()
+                if delta
+            })
+        )
+
+
+async def recount_client_counters(session: AsyncSession) -> List[str]:
+    """
+    Сверить счётчики с полным подсчётом конфигов и исправить расхождения.
+    Возвращает имена исправленных серверов.
+    """
+    rows = (await session.execute(
+        select(Config.server_id, Config.protocol_type, func.count(Config.id))
+        .where(Config.is_active == True, Config.server_id.isnot(None))
+        .group_by(Config.server_id, Config.protocol_type)
+    )).all()
+
+    actual: Dict[int, Dict[str, int]] = defaultdict(lambda: dict.fromkeys(COUNTER_COLUMNS, 0))
+    for server_id, protocol, count in rows:
+        actual[server_id]["active_clients"] += count
+        actual[server_id][PROTOCOL_COLUMNS.get(protocol, "active_wg")] += count
+
+    fixed = []
+    for server in (await session.execute(select(Server))).scalars().all():
+        expected = actual[server.id]
+        stored = {name: getattr(server, name) for name in COUNTER_COLUMNS}
+        if stored == expected:
+            continue
+        if any(value is not None for value in stored.values()):
+            logger.warning(f"Счётчики клиентов сервера {server.name} разошлись: {stored} → {expected}")
+        fixed.append(server.name)
+
+        # Пересчёт одним UPDATE, чтобы не затереть конфиги, созданные после подсчёта выше
+        active = (Config.server_id == server.id) & (Config.is_active == True)
+        values = {"active_clients": select(func.count(Config.id)).where(active).scalar_subquery()}
+        for protocol, name in PROTOCOL_COLUMNS.items():
+            if protocol == "wg":
+                # Как в _slot: пустой или неизвестный протокол считается wg
+                protocol_filter = Config.protocol_type.is_(None) | Config.protocol_type.notin_(("awg", "v2ray"))
+            else:
+                protocol_filter = Config.protocol_type == protocol
+            values[name] = select(func.count(Config.id)).where(active & protocol_filter).scalar_subquery()
+        await session.execute(
+            update(Server).where(Server.id == server.id).values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
+    if fixed:
+        await session.commit()
+    return fixed
@@ -1,11 +1,52 @@
+import logging
+
+from sqlalchemy import event, inspect, text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
 from .models import Base
+from .counters import track_client_counters, recount_client_counters
 from config import DATABASE_URL
 
+logger = logging.getLogger(__name__)
+
 engine = create_async_engine(DATABASE_URL, echo=False)
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Счётчики клиентов серверов меняются в одной транзакции с конфигами
+event.listen(Session, "before_flush", track_client_counters)
+
+
+def _add_missing_columns(sync_conn) -> None:
+    """
+    create_all не меняет существующие таблицы, поэтому новые колонки моделей
+    добавляем сами через ALTER TABLE ADD COLUMN (новые колонки — nullable).
+    """
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            col_type = column.type.compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}'))
+            logger.info(f"БД: добавлена колонка {table.name}.{column.name}")
+        
+        # Индексы, объявленные позже создания таблицы
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
 
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+    
+    # Заполнить счётчики клиентов после добавления колонок и выровнять их
+    async with async_session() as session:
+        fixed = await recount_client_counters(session)
+    if fixed:
+        logger.info(f"БД: пересчитаны счётчики клиентов серверов: {', '.join(fixed)}")
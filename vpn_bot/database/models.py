@@ -1,6 +1,7 @@
+import json
 from datetime import datetime
 from typing import Optional, List, TYPE_CHECKING
-from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Integer, String, Text, Float
+from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Index, Integer, String, Text, Float, UniqueConstraint
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 if TYPE_CHECKING:
@@ -36,6 +37,32 @@ class Server(Base):
     
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     
+    # Возможности сервера (кэш проверки, см. services/capabilities.py)
+    has_wg: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
+    has_awg: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
+    has_v2ray: Mapped[Optional[bool]] = mapped_column(Boolean, nullable=True)
+    awg_interface: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
+    public_endpoint: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)  # внешний IP сервера
+    wg_public_key: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)  # ключ интерфейса WG
+    wg_port: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    awg_port: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    v2ray_port: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    capabilities_checked_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    
+    # Активные клиенты (ведутся вместе с конфигами, см. database/counters.py)
+    active_clients: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, default=0)
+    active_wg: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, default=0)
+    active_awg: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, default=0)
+    active_v2ray: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, default=0)
+    
+    @property
+    def client_count(self) -> int:
+        return self.active_clients or 0
+    
+    @property
+    def fill_percent(self) -> float:
+        return self.client_count * 100.0 / self.max_clients if self.max_clients else 100.0
+    
     # Связь с конфигами
     configs: Mapped[List["Config"]] = relationship("Config", back_populates="server")
 
@@ -96,10 +123,38 @@ class Config(Base):
     # Последние значения с WG (для отслеживания перезапусков)
     last_wg_received: Mapped[int] = mapped_column(BigInteger, default=0)  # последнее значение received с WG
     last_wg_sent: Mapped[int] = mapped_column(BigInteger, default=0)  # последнее значение sent с WG
+    # Имя пира на сервере, если конфиг выдан из пула заготовок (иначе совпадает с name)
+    peer_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    # Клиентский конфиг (для V2Ray — ссылка); None — хранится только на сервере (старые конфиги)
+    config_content: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
     user: Mapped["User"] = relationship("User", back_populates="configs")
     server: Mapped[Optional["Server"]] = relationship("Server", back_populates="configs")
 
+    @property
+    def remote_name(self) -> str:
+        """Имя конфига на сервере (файлы клиента, пир в wg0.conf, email в Xray)"""
+        return self.peer_name or self.name
+
+
+class PooledPeer(Base):
+    """Заранее созданный на сервере, ещё не выданный пир (пул заготовок)"""
+    __tablename__ = "peer_pool"
+    __table_args__ = (
+        Index("ix_peer_pool_server_protocol", "server_id", "protocol_type"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    server_id: Mapped[int] = mapped_column(Integer, ForeignKey("servers.id"), nullable=False)
+    protocol_type: Mapped[str] = mapped_column(String(20), nullable=False)  # wg, awg, v2ray
+    peer_name: Mapped[str] = mapped_column(String(255), unique=True, nullable=False)
+    public_key: Mapped[str] = mapped_column(String(255), nullable=False)
+    preshared_key: Mapped[str] = mapped_column(String(255), default="")
+    allowed_ips: Mapped[str] = mapped_column(String(255), default="")
+    client_ip: Mapped[str] = mapped_column(String(50), default="")
+    config_content: Mapped[str] = mapped_column(Text, default="")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
@@ -158,6 +213,55 @@ class WithdrawalRequest(Base):
     user: Mapped["User"] = relationship("User", back_populates="withdrawals")
 
 
+class IpPool(Base):
+    """Адресное пространство клиентов одного интерфейса сервера (IPAM)"""
+    __tablename__ = "ip_pools"
+    __table_args__ = (
+        UniqueConstraint("server_id", "protocol_type", name="uq_ip_pools_server_protocol"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    server_id: Mapped[int] = mapped_column(Integer, ForeignKey("servers.id"), nullable=False)
+    protocol_type: Mapped[str] = mapped_column(String(20), nullable=False)  # wg, awg
+    subnet: Mapped[str] = mapped_column(String(50), nullable=False)  # 10.7.0.0/24
+    # Следующий ещё ни разу не выданный номер хоста в подсети
+    next_offset: Mapped[int] = mapped_column(Integer, default=1)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class IpAllocation(Base):
+    """Адрес подсети: занятый или освобождённый (free-list)"""
+    __tablename__ = "ip_allocations"
+    __table_args__ = (
+        UniqueConstraint("pool_id", "host_offset", name="uq_ip_allocations_pool_offset"),
+        Index("ix_ip_allocations_pool_free", "pool_id", "is_free"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    pool_id: Mapped[int] = mapped_column(Integer, ForeignKey("ip_pools.id"), nullable=False)
+    host_offset: Mapped[int] = mapped_column(Integer, nullable=False)  # номер хоста в подсети
+    address: Mapped[str] = mapped_column(String(50), nullable=False)
+    is_free: Mapped[bool] = mapped_column(Boolean, default=False)
+    peer_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, index=True)
+    allocated_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+
+
+class MediaFile(Base):
+    """Уже загруженный в Telegram файл: хэш содержимого -> file_id (у каждого бота свои)"""
+    __tablename__ = "media_cache"
+    __table_args__ = (
+        UniqueConstraint("bot_id", "content_hash", name="uq_media_cache_bot_hash"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    bot_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=False)  # sha256
+    kind: Mapped[str] = mapped_column(String(20), nullable=False)  # document, photo, animation
+    file_id: Mapped[str] = mapped_column(String(255), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
 class BotInstance(Base):
     """Экземпляр бота с индивидуальными настройками"""
     __tablename__ = "bot_instances"
@@ -181,16 +285,79 @@ class BotInstance(Base):
 class ConfigQueue(Base):
     """Очередь ожидающих конфигов (когда все серверы заполнены)"""
     __tablename__ = "config_queue"
+    __table_args__ = (
+        # Позиция в очереди и выборка по порядку — без сканирования таблицы
+        Index("ix_config_queue_status_created", "status", "created_at"),
+        Index("ix_config_queue_user_status", "user_id", "status"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
     config_name: Mapped[str] = mapped_column(String(100), nullable=False)  # желаемое имя конфига
-    status: Mapped[str] = mapped_column(String(20), default="waiting")  # waiting, processing, completed, cancelled
+    # pending — ждёт воркера, waiting — нет свободных серверов,
+    # processing, completed, failed, cancelled
+    status: Mapped[str] = mapped_column(String(20), default="waiting")
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     processed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
     
+    # Задание на создание конфига (см. services/provisioning.py)
+    protocol_type: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)  # None — awg, если есть, иначе wg
+    server_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("servers.id"), nullable=True)  # конкретный сервер
+    idempotency_key: Mapped[Optional[str]] = mapped_column(String(100), unique=True, index=True, nullable=True)
+    bot_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)  # каким ботом отправлять результат
+    on_complete: Mapped[Optional[str]] = mapped_column(String(30), nullable=True)  # имя обработчика результата
+    payload: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # JSON для обработчика
+    attempts: Mapped[Optional[int]] = mapped_column(Integer, default=0, nullable=True)
+    next_attempt_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    locked_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    config_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)  # созданный конфиг
+    
     # Связь с пользователем
     user: Mapped["User"] = relationship("User", backref="queue_items")
+    
+    @property
+    def payload_data(self) -> dict:
+        """payload как словарь"""
+        return json.loads(self.payload) if self.payload else {}
+
+
+class Migration(Base):
+    """Перенос клиентов с сервера на сервер (план и ход выполнения)"""
+    __tablename__ = "migrations"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    source_server_id: Mapped[int] = mapped_column(Integer, ForeignKey("servers.id"), nullable=False)
+    target_server_id: Mapped[int] = mapped_column(Integer, ForeignKey("servers.id"), nullable=False)
+    status: Mapped[str] = mapped_column(String(20), default="running")  # running, completed
+    bot_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)  # каким ботом уведомлять клиентов
+    admin_chat_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)  # куда отправить итог
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+
+class MigrationItem(Base):
+    """Конфиг в плане переноса"""
+    __tablename__ = "migration_items"
+    __table_args__ = (
+        Index("ix_migration_items_migration_status", "migration_id", "status"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    migration_id: Mapped[int] = mapped_column(Integer, ForeignKey("migrations.id"), nullable=False)
+    config_id: Mapped[int] = mapped_column(Integer, ForeignKey("configs.id"), nullable=False)
+    protocol_type: Mapped[str] = mapped_column(String(20), default="wg")
+    # pending — ждёт, issued — пир создан на новом сервере, но конфиг ещё не обновлён,
+    # moved — конфиг на новом сервере, done — старый пир удалён, failed
+    status: Mapped[str] = mapped_column(String(20), default="pending")
+    # Старый пир — удаляется с исходного сервера после переноса
+    old_peer_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    old_public_key: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    # Новый пир — записывается сразу после создания, чтобы после падения его можно было убрать
+    new_peer_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    new_public_key: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    notified: Mapped[bool] = mapped_column(Boolean, default=False)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
 
 class LogChannel(Base):
@@ -218,3 +385,40 @@ class BotSettings(Base):
     value: Mapped[str] = mapped_column(String(255), nullable=True)
     
     # Настройки по умолчанию создаются при первом запуске
+
+
+class TrafficSample(Base):
+    """Прирост трафика конфига за один цикл сбора (сырые замеры, хранятся недолго)"""
+    __tablename__ = "traffic_samples"
+    __table_args__ = (
+        Index("ix_traffic_samples_config_time", "config_id", "sampled_at"),
+        Index("ix_traffic_samples_time", "sampled_at"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # Без внешних ключей: история трафика переживает удаление конфига
+    config_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    user_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    server_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    sampled_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    received: Mapped[int] = mapped_column(BigInteger, default=0)  # байт за интервал
+    sent: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class TrafficRollup(Base):
+    """Трафик конфига за час или сутки (period: hour, day)"""
+    __tablename__ = "traffic_rollups"
+    __table_args__ = (
+        UniqueConstraint("period", "config_id", "bucket_start", name="uq_traffic_rollups_bucket"),
+        Index("ix_traffic_rollups_user", "period", "user_id", "bucket_start"),
+        Index("ix_traffic_rollups_time", "period", "bucket_start"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    period: Mapped[str] = mapped_column(String(5), nullable=False)
+    bucket_start: Mapped[datetime] = mapped_column(DateTime, nullable=False)  # начало часа/суток (UTC)
+    config_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    user_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    server_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    received: Mapped[int] = mapped_column(BigInteger, default=0)
+    sent: Mapped[int] = mapped_column(BigInteger, default=0)
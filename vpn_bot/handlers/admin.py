@@ -32,8 +32,10 @@ from database.models import BotSettings
 from keyboards.user_kb import get_main_menu_kb
 from services.wireguard import WireGuardService
 from services.traffic import format_bytes, get_config_traffic, get_server_traffic
+from services.collectors import feed_key
 from services.wireguard_multi import WireGuardMultiService
 from services.settings import get_setting, set_setting
+from services.provisioning import ProvisioningService, completion_callback
 from states.user_states import AdminStates
 from utils import transliterate_ru_to_en, format_datetime_moscow, format_date_moscow
 
@@ -332,7 +334,7 @@ async def admin_delete_inactive(callback: CallbackQuery):
                 if config.server_id:
                     server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
                     if server:
-                        await WireGuardMultiService.delete_config(config.name, server, config.public_key)
+                        await WireGuardMultiService.delete_config(config.remote_name, server, config.public_key)
                 else:
                     await WireGuardService.delete_config(config.name)
             
@@ -369,7 +371,8 @@ async def admin_config_queue(callback: CallbackQuery, bot: Bot):
     
     await callback.answer()
     
-    queue = await ConfigQueueService.get_waiting_queue()
+    queue = await ConfigQueueService.get_waiting_queue(limit=20)
+    total = await ConfigQueueService.get_waiting_count()
     
     if not queue:
         await callback.message.edit_text(
@@ -382,16 +385,16 @@ async def admin_config_queue(callback: CallbackQuery, bot: Bot):
         )
         return
     
-    text = f"⏳ *Очередь конфигов ({len(queue)})*\n\n"
+    text = f"⏳ *Очередь конфигов ({total})*\n\n"
     
-    for i, item in enumerate(queue[:20], 1):  # Показываем первые 20
+    for i, item in enumerate(queue, 1):  # Показываем первые 20
         user = item.user
         user_info = f"@{user.username}" if user and user.username else f"ID:{user.telegram_id}" if user else "?"
         created = format_datetime_moscow(item.created_at)
         text += f"{i}. {user_info} — `{item.config_name}`\n   📅 {created}\n"
     
-    if len(queue) > 20:
-        text += f"\n... и ещё {len(queue) - 20} в очереди"
+    if total > len(queue):
+        text += f"\n... и ещё {total - len(queue)} в очереди"
     
     buttons = [
         [InlineKeyboardButton(text="🔄 Обработать очередь", callback_data="admin_process_queue")],
@@ -527,28 +530,16 @@ async def admin_user_detail(callback: CallbackQuery, state: FSMContext):
     
     traffic_info = ""
     if not LOCAL_MODE and user.configs:
-        # Собираем трафик со всех серверов
-        server_traffic_cache = {}  # Кэш трафика по server_id
-        async with async_session() as traffic_session:
-            for config in user.configs:
-                if config.server_id:
-                    # Мультисервер
-                    if config.server_id not in server_traffic_cache:
-                        server = await WireGuardMultiService.get_server_by_id(traffic_session, config.server_id)
-                        if server:
-                            server_traffic_cache[config.server_id] = await WireGuardMultiService.get_traffic_stats(server)
-                        else:
-                            server_traffic_cache[config.server_id] = {}
-                    traffic_stats = server_traffic_cache[config.server_id]
-                else:
-                    # Локальный сервер
-                    traffic_stats = await WireGuardService.get_traffic_stats()
-                
-                if config.public_key in traffic_stats:
-                    stats = traffic_stats[config.public_key]
-                    rx = format_bytes(stats['received'])
-                    tx = format_bytes(stats['sent'])
-                    traffic_info += f"\n📊 {config.name}: ⬇️{rx} ⬆️{tx}"
+        from services.traffic_history import TrafficHistory
+        
+        # Трафик за 30 дней — из истории трафика, без запросов к серверам
+        usage = await TrafficHistory.get_usage(
+            datetime.utcnow() - timedelta(days=30), config_ids=[c.id for c in user.configs]
+        )
+        for config in user.configs:
+            stats = usage.get(config.id)
+            if stats:
+                traffic_info += f"\n📊 {config.name} (30 дн.): ⬇️{stats.format_received()} ⬆️{stats.format_sent()}"
     
     username = f"@{user.username}" if user.username else "—"
     max_configs_text = f" (лимит: {user.max_configs})" if user.max_configs else ""
@@ -618,23 +609,16 @@ async def admin_config_detail(callback: CallbackQuery):
     
     traffic_info = ""
     if not LOCAL_MODE:
-        async with async_session() as traffic_session:
-            if config.server_id:
-                # Мультисервер
-                server = await WireGuardMultiService.get_server_by_id(traffic_session, config.server_id)
-                if server:
-                    traffic_stats = await WireGuardMultiService.get_traffic_stats(server)
-                else:
-                    traffic_stats = {}
-            else:
-                # Локальный сервер
-                traffic_stats = await WireGuardService.get_traffic_stats()
-            
-            if config.public_key in traffic_stats:
-                stats = traffic_stats[config.public_key]
-                rx = format_bytes(stats['received'])
-                tx = format_bytes(stats['sent'])
-                traffic_info = f"\n📊 Трафик: ⬇️{rx} ⬆️{tx}"
+        from services.traffic_history import TrafficHistory
+        
+        now = datetime.utcnow()
+        day = (await TrafficHistory.get_usage(now - timedelta(hours=24), config_ids=[config.id])).get(config.id)
+        month = (await TrafficHistory.get_usage(now - timedelta(days=30), config_ids=[config.id])).get(config.id)
+        if month:
+            traffic_info = (
+                f"\n📊 Трафик за 30 дн.: ⬇️{month.format_received()} ⬆️{month.format_sent()}"
+                f"\n📅 За сутки: {day.format_total() if day else format_bytes(0)}"
+            )
     
     await callback.message.edit_text(
         f"📱 Конфиг: {config.name}\n\n"
@@ -671,7 +655,7 @@ async def admin_toggle_config(callback: CallbackQuery):
                 if server:
                     # Для V2Ray используем отдельную функцию
                     if config.name.startswith("v2ray_") or getattr(config, 'protocol_type', '') == 'v2ray':
-                        success, msg = await WireGuardMultiService.disable_v2ray_config(config.name, server)
+                        success, msg = await WireGuardMultiService.disable_v2ray_config(config.remote_name, server)
                     else:
                         success, msg = await WireGuardMultiService.disable_config(config.public_key, server)
                 else:
@@ -695,7 +679,7 @@ async def admin_toggle_config(callback: CallbackQuery):
                 if server:
                     # Для V2Ray используем отдельную функцию
                     if config.name.startswith("v2ray_") or getattr(config, 'protocol_type', '') == 'v2ray':
-                        success, msg = await WireGuardMultiService.enable_v2ray_config(config.name, server)
+                        success, msg = await WireGuardMultiService.enable_v2ray_config(config.remote_name, server)
                     else:
                         success, msg = await WireGuardMultiService.enable_config(
                             config.public_key, config.preshared_key, config.allowed_ips, server
@@ -751,7 +735,7 @@ async def admin_delete_config(callback: CallbackQuery):
         if config.server_id:
             server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
             if server:
-                await WireGuardMultiService.delete_config(config_name, server, config.public_key)
+                await WireGuardMultiService.delete_config(config.remote_name, server, config.public_key)
         else:
             await WireGuardService.delete_config(config_name)
         
@@ -1087,18 +1071,8 @@ async def admin_approve_payment(callback: CallbackQuery, bot: Bot):
                 existing_config_ids.append((cfg.id, cfg.public_key, cfg.preshared_key, cfg.allowed_ips))
     
     config_created = False
-    config_name = None
-    config_data = None
-    server_id = None
     
-    if not has_config:
-        config_name = user_username if user_username else f"user{user_telegram_id}"
-        success, config_data, server_id, msg = await create_config_multi_admin(config_name)
-        if success:
-            config_created = True
-        else:
-            logger.error(f"Ошибка создания конфига: {msg}")
-    else:
+    if has_config:
         for cfg_id, pub_key, psk, allowed_ips in existing_config_ids:
             success, msg = await WireGuardService.enable_config(pub_key, psk, allowed_ips)
             if success:
@@ -1137,19 +1111,6 @@ async def admin_approve_payment(callback: CallbackQuery, bot: Bot):
             )
             session.add(subscription)
         
-        if config_created and config_data:
-            config = Config(
-                user_id=user_id,
-                server_id=server_id,
-                name=config_name,
-                public_key=config_data.public_key,
-                preshared_key=config_data.preshared_key,
-                allowed_ips=config_data.allowed_ips,
-                client_ip=config_data.client_ip,
-                is_active=True
-            )
-            session.add(config)
-        
         # Отмечаем первую оплату и начисляем бонус рефереру
         stmt_user = select(User).where(User.id == user_id)
         result_user = await session.execute(stmt_user)
@@ -1168,6 +1129,18 @@ async def admin_approve_payment(callback: CallbackQuery, bot: Bot):
         
         await session.commit()
     
+    if not has_config:
+        # Конфиг создаёт очередь заданий и отправляет _on_payment_config_ready
+        config_name = user_username if user_username else f"user{user_telegram_id}"
+        await ProvisioningService.enqueue(
+            user_id, config_name, "wg",
+            on_complete="payment",
+            payload={"chat_id": user_telegram_id},
+            idempotency_key=f"payment:{payment_id}",
+            bot_id=bot.id
+        )
+        config_created = True
+    
     # Уведомляем реферера о начислении бонуса
     if referrer_telegram_id:
         bonus = payment_amount * (referrer_percent / 100)
@@ -1223,24 +1196,6 @@ async def admin_approve_payment(callback: CallbackQuery, bot: Bot):
         
         await bot.send_message(user_telegram_id, msg_text, parse_mode="Markdown")
         
-        if config_created and not LOCAL_MODE:
-            config_path = WireGuardService.get_config_file_path(config_name)
-            qr_path = WireGuardService.get_qr_file_path(config_name)
-            
-            if os.path.exists(config_path):
-                await bot.send_document(
-                    user_telegram_id,
-                    FSInputFile(config_path),
-                    caption="📄 Твой WireGuard конфиг"
-                )
-            
-            if os.path.exists(qr_path):
-                await bot.send_photo(
-                    user_telegram_id,
-                    FSInputFile(qr_path),
-                    caption="📷 QR-код для быстрой настройки"
-                )
-        
         menu_text = (
             "👋 Привет!\n\n"
             "📱 *Конфиги* — информация о подключении, QR-коды и доп. конфигурации\n"
@@ -1257,6 +1212,26 @@ async def admin_approve_payment(callback: CallbackQuery, bot: Bot):
         logger.error(f"Ошибка отправки уведомления пользователю: {e}")
 
 
+@completion_callback("payment")
+async def _on_payment_config_ready(bot: Bot, job, config_data, error):
+    """Результат задания конфига после подтверждения оплаты"""
+    chat_id = job.payload_data["chat_id"]
+    if error is not None:
+        logger.error(f"Ошибка создания конфига: {error}")
+        await bot.send_message(
+            chat_id,
+            "❌ Не удалось создать конфиг\n\nНапиши @agdelesha для помощи.",
+            parse_mode=None
+        )
+        return
+    
+    from handlers.user import send_config_file
+    await send_config_file(
+        bot, chat_id, job.config_name, config_data, config_data.server_id,
+        caption="📄 Твой WireGuard конфиг"
+    )
+
+
 @router.callback_query(F.data.startswith("admin_reject_"))
 async def admin_reject_payment(callback: CallbackQuery, bot: Bot):
     if not is_admin(callback.from_user.id):
@@ -1480,7 +1455,8 @@ async def admin_gift_subscription(callback: CallbackQuery, bot: Bot):
                     preshared_key=config_data.preshared_key,
                     allowed_ips=config_data.allowed_ips,
                     client_ip=config_data.client_ip,
-                    is_active=True
+                    is_active=True,
+                    config_content=config_data.config_content
                 )
                 session.add(config)
                 config_created = True
@@ -1582,7 +1558,8 @@ async def admin_add_config(callback: CallbackQuery, bot: Bot):
             preshared_key=config_data.preshared_key,
             allowed_ips=config_data.allowed_ips,
             client_ip=config_data.client_ip,
-            is_active=True
+            is_active=True,
+            config_content=config_data.config_content
         )
         session.add(config)
         await session.commit()
@@ -1677,6 +1654,7 @@ async def admin_confirm_delete(callback: CallbackQuery):
         
         # Удаляем записи из очереди конфигов
         from database.models import ConfigQueue, Subscription
+        from services.config_queue import ConfigQueueService
         queue_stmt = select(ConfigQueue).where(ConfigQueue.user_id == user_id)
         queue_result = await session.execute(queue_stmt)
         for queue_item in queue_result.scalars().all():
@@ -1688,7 +1666,7 @@ async def admin_confirm_delete(callback: CallbackQuery):
                 if config.server_id:
                     server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
                     if server:
-                        await WireGuardMultiService.delete_config(config.name, server, config.public_key)
+                        await WireGuardMultiService.delete_config(config.remote_name, server, config.public_key)
                 else:
                     await WireGuardService.delete_config(config.name)
             except Exception as e:
@@ -1708,6 +1686,7 @@ async def admin_confirm_delete(callback: CallbackQuery):
         user.is_blocked = True
         user.failed_notifications = 0
         await session.commit()
+        ConfigQueueService.invalidate_summary()
         
         await callback.answer("🗑 Пользователь деактивирован")
         
@@ -1742,6 +1721,7 @@ async def admin_delete_and_block(callback: CallbackQuery):
         
         # Удаляем записи из очереди конфигов
         from database.models import ConfigQueue, Subscription
+        from services.config_queue import ConfigQueueService
         queue_stmt = select(ConfigQueue).where(ConfigQueue.user_id == user_id)
         queue_result = await session.execute(queue_stmt)
         for queue_item in queue_result.scalars().all():
@@ -1753,7 +1733,7 @@ async def admin_delete_and_block(callback: CallbackQuery):
                 if config.server_id:
                     server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
                     if server:
-                        await WireGuardMultiService.delete_config(config.name, server, config.public_key)
+                        await WireGuardMultiService.delete_config(config.remote_name, server, config.public_key)
                 else:
                     await WireGuardService.delete_config(config.name)
             except Exception as e:
@@ -1774,6 +1754,7 @@ async def admin_delete_and_block(callback: CallbackQuery):
         user.is_blocked = True
         user.failed_notifications = 0
         await session.commit()
+        ConfigQueueService.invalidate_summary()
         
         await callback.answer("🚫 Пользователь деактивирован и заблокирован")
         
@@ -1845,6 +1826,7 @@ async def admin_confirm_full_delete(callback: CallbackQuery):
         
         # Удаляем записи из очереди конфигов
         from database.models import ConfigQueue, Subscription, Payment
+        from services.config_queue import ConfigQueueService
         queue_stmt = select(ConfigQueue).where(ConfigQueue.user_id == user_id)
         queue_result = await session.execute(queue_stmt)
         for queue_item in queue_result.scalars().all():
@@ -1856,7 +1838,7 @@ async def admin_confirm_full_delete(callback: CallbackQuery):
                 if config.server_id:
                     server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
                     if server:
-                        await WireGuardMultiService.delete_config(config.name, server, config.public_key)
+                        await WireGuardMultiService.delete_config(config.remote_name, server, config.public_key)
                 else:
                     await WireGuardService.delete_config(config.name)
             except Exception as e:
@@ -1881,6 +1863,7 @@ async def admin_confirm_full_delete(callback: CallbackQuery):
         # Удаляем самого пользователя
         await session.delete(user)
         await session.commit()
+        ConfigQueueService.invalidate_summary()
         
         await callback.answer("🗑 Пользователь полностью удалён")
         
@@ -2306,7 +2289,8 @@ async def cmd_gift(message: Message, bot: Bot):
                     preshared_key=config_data.preshared_key,
                     allowed_ips=config_data.allowed_ips,
                     client_ip=config_data.client_ip,
-                    is_active=True
+                    is_active=True,
+                    config_content=config_data.config_content
                 )
                 session.add(config)
                 config_created = True
@@ -2420,7 +2404,8 @@ async def admin_approve_config_request(callback: CallbackQuery, bot: Bot):
             preshared_key=config_data.preshared_key,
             allowed_ips=config_data.allowed_ips,
             client_ip=config_data.client_ip,
-            is_active=True
+            is_active=True,
+            config_content=config_data.config_content
         )
         session.add(config)
         await session.commit()
@@ -3427,11 +3412,8 @@ async def admin_servers_list(callback: CallbackQuery, state: FSMContext):
     async with async_session() as session:
         servers = await WireGuardMultiService.get_all_servers(session)
         
-        # Получаем количество клиентов для каждого сервера
-        client_counts = {}
-        for server in servers:
-            count = await WireGuardMultiService.get_server_client_count(session, server.id)
-            client_counts[server.id] = count
+        # Количество клиентов — из счётчиков серверов
+        client_counts = {server.id: server.client_count for server in servers}
     
     # Получаем количество в очереди
     queue_count = await ConfigQueueService.get_waiting_count()
@@ -3490,13 +3472,37 @@ async def admin_server_detail(callback: CallbackQuery):
         f"*Пароль:* `{server.ssh_password}`\n"
         f"*SSH:* {server.ssh_user}@{server.host}:{server.ssh_port}\n"
         f"*Статус:* {status}\n"
-        f"*Клиентов:* {client_count}/{server.max_clients}\n"
+        f"*Клиентов:* {client_count}/{server.max_clients} ({server.fill_percent:.0f}%)\n"
+        f"*По протоколам:* WG {server.active_wg or 0}, AWG {server.active_awg or 0}, V2Ray {server.active_v2ray or 0}\n"
         f"*Приоритет:* {server.priority}\n"
         f"*Интерфейс:* {server.wg_interface}\n"
         f"*Протоколы:* {protocols_str}\n"
         f"*Создан:* {format_date_moscow(server.created_at)}"
     )
     
+    # Нагрузка SSH очереди сервера
+    from services.bulkhead import bulkheads
+    queue_stats = bulkheads.get_server_stats(server_id)
+    if queue_stats:
+        queued = sum(queue_stats['queued'].values())
+        user_wait = queue_stats['wait']['user']
+        text += (
+            f"\n*SSH операций:* {queue_stats['active']}/{queue_stats['limit']}, в очереди {queued}"
+            f"\n*Ожидание (польз.):* ~{user_wait['avg_ms']} мс, макс {user_wait['max_ms']} мс"
+        )
+    
+    # Последний сбор трафика с сервера
+    from services.traffic import get_collection_result
+    collection = get_collection_result(server_id)
+    if collection:
+        state = "✅" if collection.ok else f"❌ {collection.error}"
+        text += f"\n*Сбор трафика:* {collection.duration_ms:.0f} мс, {state}"
+    
+    # Заполненность подсетей клиентов (IPAM)
+    from services.ipam import IpamService
+    for protocol, (used, capacity) in (await IpamService.get_usage(server_id)).items():
+        text += f"\n*Адреса {protocol.upper()}:* {used}/{capacity}"
+    
     await callback.message.edit_text(
         text,
         parse_mode="Markdown",
@@ -3708,6 +3714,10 @@ async def admin_server_check(callback: CallbackQuery):
             await callback.message.edit_text("❌ Сервер не найден")
             return
         
+        # Ручная проверка идёт в обход circuit breaker'а: её результат и задаёт новое состояние
+        from services.circuit_breaker import breakers
+        breakers.forget(server)
+        
         # Проверяем SSH
         ssh_ok, ssh_msg = await WireGuardMultiService.check_server_connection(server)
         
@@ -3717,6 +3727,15 @@ async def admin_server_check(callback: CallbackQuery):
         else:
             wg_ok, wg_msg = False, "SSH недоступен"
         
+        # Перепроверяем возможности сервера (протоколы, порты)
+        from services.capabilities import CapabilityService
+        CapabilityService.invalidate(server)
+        protocols_str = "—"
+        if ssh_ok:
+            caps = await CapabilityService.refresh(server)
+            names = {"wg": "WG", "awg": "AWG", "v2ray": "V2Ray"}
+            protocols_str = ", ".join(names[p] for p in caps.protocols()) or "—"
+        
         client_count = await WireGuardMultiService.get_server_client_count(session, server_id)
     
     status = "🟢 Активен" if server.is_active else "🔴 Отключен"
@@ -3730,7 +3749,8 @@ async def admin_server_check(callback: CallbackQuery):
         f"*Клиентов:* {client_count}/{server.max_clients}\n\n"
         f"*Проверка подключения:*\n"
         f"{ssh_status} SSH: {ssh_msg}\n"
-        f"{wg_status} WireGuard: {wg_msg}"
+        f"{wg_status} WireGuard: {wg_msg}\n"
+        f"*Протоколы:* {protocols_str}"
     )
     
     await callback.message.edit_text(
@@ -3842,18 +3862,28 @@ async def admin_server_confirm_delete(callback: CallbackQuery):
         for config in configs:
             await session.delete(config)
         
+        from services.warm_pool import WarmPoolService
+        from services.ipam import IpamService
+        await WarmPoolService.discard_server(session, server.id)
+        await IpamService.discard_server(session, server.id)
+        
         await session.delete(server)
         await session.commit()
     
+    # Закрываем SSH соединения к удалённому серверу
+    from services.ssh_pool import ssh_pool
+    from services.remote_agent import AgentRegistry
+    from services.circuit_breaker import breakers
+    AgentRegistry.invalidate(server)
+    breakers.forget(server)
+    await ssh_pool.close_server(server)
+    
     await callback.answer(f"✅ Сервер {server_name} удален, {deleted_count} конфигов удалено")
     
     # Возвращаемся к списку серверов
     async with async_session() as session:
         servers = await WireGuardMultiService.get_all_servers(session)
-        client_counts = {}
-        for s in servers:
-            count = await WireGuardMultiService.get_server_client_count(session, s.id)
-            client_counts[s.id] = count
+        client_counts = {s.id: s.client_count for s in servers}
     
     await callback.message.edit_text(
         f"🖥 *Серверы ({len(servers)}):*" if servers else "🖥 *Серверы*\n\nСерверов пока нет.",
@@ -3904,85 +3934,50 @@ async def admin_server_stats(callback: CallbackQuery):
 
 @router.callback_query(F.data.startswith("admin_server_cleanup_"))
 async def admin_server_cleanup(callback: CallbackQuery):
-    """Очистка мёртвых пиров (есть на сервере, но нет в БД)"""
+    """Сверка сервера с БД: мёртвые пиры, пропавшие и рассогласованные конфиги (все протоколы)"""
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
+    from services.reconciliation import ReconciliationService
+    
     server_id = int(callback.data.replace("admin_server_cleanup_", ""))
-    await callback.answer("⏳ Анализирую пиры...")
+    await callback.answer("⏳ Сверяю сервер с БД...")
     
     async with async_session() as session:
         server = await WireGuardMultiService.get_server_by_id(session, server_id)
         if not server:
             await callback.message.edit_text("❌ Сервер не найден")
             return
-        
-        # Получаем пиры с сервера
-        try:
-            success, stdout, stderr = await WireGuardMultiService._ssh_execute(
-                server, f"wg show {server.wg_interface} peers"
-            )
-            if not success:
-                await callback.message.edit_text(
-                    f"❌ Ошибка получения пиров: {stderr}",
-                    reply_markup=get_server_detail_kb(server_id, server.is_active)
-                )
-                return
-            
-            server_peers = set(stdout.strip().split('\n')) if stdout.strip() else set()
-        except Exception as e:
-            await callback.message.edit_text(
-                f"❌ Ошибка подключения: {e}",
-                reply_markup=get_server_detail_kb(server_id, server.is_active)
-            )
-            return
-        
-        # Получаем public_key из БД для этого сервера
-        stmt = select(Config.public_key).where(Config.server_id == server_id)
-        result = await session.execute(stmt)
-        db_keys = set(row[0] for row in result.fetchall() if row[0])
-        
-        # Находим мёртвые пиры (есть на сервере, но нет в БД)
-        dead_peers = server_peers - db_keys
-        dead_peers.discard('')  # Убираем пустые строки
-        
-        if not dead_peers:
-            await callback.message.edit_text(
-                f"✅ На сервере *{server.name}* нет мёртвых пиров.\n\n"
-                f"Пиров на сервере: {len(server_peers)}\n"
-                f"Конфигов в БД: {len(db_keys)}",
-                parse_mode="Markdown",
-                reply_markup=get_server_detail_kb(server_id, server.is_active)
-            )
-            return
-        
-        # Удаляем мёртвые пиры
-        removed = 0
-        for peer_key in dead_peers:
-            try:
-                await WireGuardMultiService._ssh_execute(
-                    server, f"wg set {server.wg_interface} peer {peer_key} remove"
-                )
-                removed += 1
-            except Exception as e:
-                logger.error(f"Ошибка удаления пира {peer_key}: {e}")
-        
-        # Сохраняем конфиг
-        await WireGuardMultiService._ssh_execute(
-            server, f"wg-quick save {server.wg_interface}"
-        )
-        
-        await callback.message.edit_text(
-            f"🧹 *Очистка завершена*\n\n"
-            f"Сервер: *{server.name}*\n"
-            f"Удалено мёртвых пиров: *{removed}*\n\n"
-            f"Было пиров: {len(server_peers)}\n"
-            f"Конфигов в БД: {len(db_keys)}\n"
-            f"Теперь пиров: {len(server_peers) - removed}",
-            parse_mode="Markdown",
-            reply_markup=get_server_detail_kb(server_id, server.is_active)
-        )
+    
+    reports = await ReconciliationService.run([server_id])
+    await callback.message.edit_text(
+        ReconciliationService.format_report(reports),
+        parse_mode="Markdown",
+        reply_markup=get_server_detail_kb(server_id, server.is_active)
+    )
+
+
+@router.callback_query(F.data == "admin_reconcile_all")
+async def admin_reconcile_all(callback: CallbackQuery):
+    """Сверка всех серверов с БД"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа", show_alert=True)
+        return
+    
+    from services.reconciliation import ReconciliationService
+    
+    await callback.answer("⏳ Сверяю все серверы...")
+    await callback.message.edit_text("⏳ Сверка серверов с БД...")
+    
+    reports = await ReconciliationService.run()
+    await callback.message.edit_text(
+        ReconciliationService.format_report(reports),
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="◀️ К серверам", callback_data="admin_servers")]
+        ])
+    )
 
 
 @router.callback_query(F.data.startswith("admin_server_install_"))
@@ -4475,17 +4470,11 @@ async def admin_server_migrate(callback: CallbackQuery):
         # Получаем другие активные серверы
         stmt = select(Server).where(
             Server.id != source_server_id,
-            Server.is_active == True
-        ).options(selectinload(Server.configs))
+            Server.is_active == True,
+            func.coalesce(Server.active_clients, 0) < Server.max_clients
+        )
         result = await session.execute(stmt)
-        target_servers = result.scalars().all()
-        
-        # Фильтруем серверы с достаточным количеством свободных мест
-        available_servers = []
-        for server in target_servers:
-            free_slots = server.max_clients - len(server.configs)
-            if free_slots > 0:
-                available_servers.append(server)
+        available_servers = result.scalars().all()
         
         if not available_servers:
             await callback.message.edit_text(
@@ -4495,13 +4484,27 @@ async def admin_server_migrate(callback: CallbackQuery):
             )
             return
     
+    # Лучшие по оценке PlacementEngine — первыми; серверы, которые он отсеял
+    # (например, с разомкнутым circuit breaker), остаются в конце списка
+    from services.placement import PlacementEngine
+    ranked = await PlacementEngine.rank(servers=available_servers, exclude=[source_server_id])
+    ranked_ids = {server.id for server, _ in ranked}
+    target_servers = [server for server, _ in ranked] + [
+        server for server in available_servers if server.id not in ranked_ids
+    ]
+    recommendation = ""
+    if ranked:
+        best, best_score = ranked[0]
+        recommendation = f"⭐ Рекомендуется: *{best.name}* (оценка {best_score:.2f})\n\n"
+    
     await callback.message.edit_text(
         f"🔀 *Миграция клиентов*\n\n"
         f"📤 С сервера: *{source_server.name}*\n"
         f"👥 Клиентов: *{client_count}*\n\n"
+        f"{recommendation}"
         f"Выберите сервер, на который перенести клиентов:",
         parse_mode="Markdown",
-        reply_markup=get_server_migrate_kb(source_server_id, available_servers)
+        reply_markup=get_server_migrate_kb(source_server_id, target_servers)
     )
 
 
@@ -4524,16 +4527,14 @@ async def admin_migrate_select_target(callback: CallbackQuery):
         result = await session.execute(stmt)
         source_server = result.scalar_one_or_none()
         
-        stmt = select(Server).where(Server.id == target_id).options(selectinload(Server.configs))
-        result = await session.execute(stmt)
-        target_server = result.scalar_one_or_none()
+        target_server = await session.get(Server, target_id)
         
         if not source_server or not target_server:
             await callback.message.edit_text("❌ Сервер не найден")
             return
         
         source_clients = len(source_server.configs)
-        target_free = target_server.max_clients - len(target_server.configs)
+        target_free = target_server.max_clients - target_server.client_count
         
         # Проверяем что хватает места
         can_migrate = min(source_clients, target_free)
@@ -4563,124 +4564,70 @@ async def admin_migrate_select_target(callback: CallbackQuery):
     )
 
 
+@router.callback_query(F.data.startswith("admin_migrate_dryrun_"))
+async def admin_migrate_dry_run(callback: CallbackQuery):
+    """Пробный прогон миграции — показать план без изменений"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа", show_alert=True)
+        return
+    
+    from services.migration import MigrationService
+    
+    # Формат: admin_migrate_dryrun_{source_id}_{target_id}
+    parts = callback.data.replace("admin_migrate_dryrun_", "").split("_")
+    source_id = int(parts[0])
+    target_id = int(parts[1])
+    await callback.answer()
+    
+    plan = await MigrationService.plan(source_id, target_id)
+    if plan is None:
+        await callback.message.edit_text("❌ Сервер не найден")
+        return
+    
+    protocols = "\n".join(f"   • {protocol}: {count}" for protocol, count in plan.by_protocol.items()) or "   —"
+    text = (
+        f"🧪 *Пробный прогон миграции*\n\n"
+        f"📤 С сервера: *{plan.source.name}*\n"
+        f"📥 На сервер: *{plan.target.name}* (свободно {plan.target_free})\n\n"
+        f"👥 Будет перенесено: *{len(plan.configs)}*\n{protocols}\n"
+    )
+    if plan.unsupported:
+        skipped = ", ".join(f"{protocol}: {count}" for protocol, count in plan.unsupported.items())
+        text += f"\n⚠️ Целевой сервер не поддерживает: {skipped}"
+    if plan.over_capacity:
+        text += f"\n⚠️ Не поместится: {plan.over_capacity}"
+    
+    await callback.message.edit_text(
+        text,
+        parse_mode="Markdown",
+        reply_markup=get_migrate_confirm_kb(source_id, target_id, len(plan.configs))
+    )
+
+
 @router.callback_query(F.data.startswith("admin_migrate_confirm_"))
 async def admin_migrate_confirm(callback: CallbackQuery, bot: Bot):
-    """Выполнение миграции клиентов"""
+    """Запуск миграции клиентов (выполняется в фоне, итог придёт сообщением)"""
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
+    from services.migration import MigrationService
+    
     # Формат: admin_migrate_confirm_{source_id}_{target_id}
     parts = callback.data.replace("admin_migrate_confirm_", "").split("_")
     source_id = int(parts[0])
     target_id = int(parts[1])
     
-    await callback.answer("⏳ Миграция началась...")
-    await callback.message.edit_text("⏳ *Миграция в процессе...*\n\nЭто может занять несколько минут.", parse_mode="Markdown")
-    
-    migrated = 0
-    failed = 0
-    notified = 0
-    
-    async with async_session() as session:
-        # Получаем серверы
-        stmt = select(Server).where(Server.id == source_id).options(selectinload(Server.configs))
-        result = await session.execute(stmt)
-        source_server = result.scalar_one_or_none()
-        
-        stmt = select(Server).where(Server.id == target_id)
-        result = await session.execute(stmt)
-        target_server = result.scalar_one_or_none()
-        
-        if not source_server or not target_server:
-            await callback.message.edit_text("❌ Сервер не найден")
-            return
-        
-        # Получаем конфиги с пользователями
-        configs_to_migrate = []
-        for config in source_server.configs:
-            stmt = select(Config).where(Config.id == config.id).options(selectinload(Config.user))
-            result = await session.execute(stmt)
-            config_with_user = result.scalar_one_or_none()
-            if config_with_user:
-                configs_to_migrate.append(config_with_user)
-        
-        target_free = target_server.max_clients - await WireGuardMultiService.get_server_client_count(session, target_id)
-        
-        for config in configs_to_migrate[:target_free]:
-            try:
-                user = config.user
-                config_name = config.name
-                
-                # 1. Удаляем старый конфиг с исходного сервера
-                try:
-                    await WireGuardMultiService.delete_config_from_server(
-                        source_server.host,
-                        source_server.ssh_user,
-                        source_server.ssh_password,
-                        source_server.ssh_port,
-                        config.public_key,
-                        source_server.wg_interface
-                    )
-                except Exception as e:
-                    logger.warning(f"Ошибка удаления конфига с исходного сервера: {e}")
-                
-                # 2. Создаём новый конфиг на целевом сервере
-                success, new_config_data, msg = await WireGuardMultiService.create_config(config_name, session, target_server)
-                
-                if not success:
-                    logger.error(f"Ошибка создания конфига на целевом сервере: {msg}")
-                    failed += 1
-                    continue
-                
-                # 3. Обновляем запись в БД
-                config.server_id = target_id
-                config.public_key = new_config_data.public_key
-                config.preshared_key = new_config_data.preshared_key
-                config.allowed_ips = new_config_data.allowed_ips
-                config.client_ip = new_config_data.client_ip
-                
-                await session.commit()
-                migrated += 1
-                
-                # 4. Уведомляем пользователя и отправляем новый конфиг
-                if user and user.telegram_id:
-                    try:
-                        await bot.send_message(
-                            user.telegram_id,
-                            f"🔄 *Обновление конфига*\n\n"
-                            f"Твой конфиг *{config_name}* был перенесён на новый сервер.\n"
-                            f"Старый конфиг больше не работает.\n\n"
-                            f"Сейчас отправлю новый конфиг 👇",
-                            parse_mode="Markdown"
-                        )
-                        
-                        # Отправляем новый конфиг с обычной клавиатурой клиента
-                        from handlers.user import send_config_file
-                        from keyboards.user_kb import get_main_menu_kb
-                        await send_config_file(
-                            bot, user.telegram_id, config_name, new_config_data, target_id,
-                            caption="📄 Твой новый WireGuard конфиг",
-                            reply_markup=get_main_menu_kb(user.telegram_id, True, True)
-                        )
-                        notified += 1
-                    except Exception as e:
-                        logger.error(f"Ошибка уведомления пользователя {user.telegram_id}: {e}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка миграции конфига {config.name}: {e}")
-                failed += 1
+    migration = await MigrationService.start(source_id, target_id, bot, callback.from_user.id)
+    if migration is None:
+        await callback.answer("❌ Нечего переносить или миграция с этого сервера уже идёт", show_alert=True)
+        return
     
-    # Результат
+    await callback.answer("⏳ Миграция началась...")
     await callback.message.edit_text(
-        f"✅ *Миграция завершена*\n\n"
-        f"📤 С сервера: *{source_server.name}*\n"
-        f"📥 На сервер: *{target_server.name}*\n\n"
-        f"✅ Перенесено: {migrated}\n"
-        f"❌ Ошибок: {failed}\n"
-        f"📨 Уведомлено: {notified}",
-        parse_mode="Markdown",
-        reply_markup=get_server_detail_kb(target_id, target_server.is_active, migrated > 0)
+        "⏳ *Миграция в процессе...*\n\n"
+        "Клиенты переносятся в фоне, итог придёт отдельным сообщением.",
+        parse_mode="Markdown"
     )
 
 
@@ -4833,8 +4780,9 @@ async def admin_server_config_detail(callback: CallbackQuery):
         traffic_info = ""
         if not LOCAL_MODE and not server_deleted and cfg_server:
             traffic_stats = await WireGuardMultiService.get_traffic_stats(cfg_server)
-            if config.public_key in traffic_stats:
-                stats = traffic_stats[config.public_key]
+            key = feed_key(config)
+            if key in traffic_stats:
+                stats = traffic_stats[key]
                 rx = format_bytes(stats['received'])
                 tx = format_bytes(stats['sent'])
                 traffic_info = f"\n📊 Трафик: ⬇️{rx} ⬆️{tx}"
@@ -4886,7 +4834,7 @@ async def admin_toggle_server_config(callback: CallbackQuery):
             if cfg_server:
                 # Для V2Ray используем отдельную функцию
                 if config.name.startswith("v2ray_") or getattr(config, 'protocol_type', '') == 'v2ray':
-                    success, msg = await WireGuardMultiService.disable_v2ray_config(config.name, cfg_server)
+                    success, msg = await WireGuardMultiService.disable_v2ray_config(config.remote_name, cfg_server)
                 else:
                     success, msg = await WireGuardMultiService.disable_config(config.public_key, cfg_server)
             else:
@@ -4904,7 +4852,7 @@ async def admin_toggle_server_config(callback: CallbackQuery):
             if cfg_server:
                 # Для V2Ray используем отдельную функцию
                 if config.name.startswith("v2ray_") or getattr(config, 'protocol_type', '') == 'v2ray':
-                    success, msg = await WireGuardMultiService.enable_v2ray_config(config.name, cfg_server)
+                    success, msg = await WireGuardMultiService.enable_v2ray_config(config.remote_name, cfg_server)
                 else:
                     success, msg = await WireGuardMultiService.enable_config(
                         config.public_key, config.preshared_key, config.allowed_ips, cfg_server
@@ -4979,7 +4927,7 @@ async def admin_delete_server_config(callback: CallbackQuery):
             if config.server_id:
                 cfg_server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
                 if cfg_server:
-                    await WireGuardMultiService.delete_config(config_name, cfg_server, config.public_key)
+                    await WireGuardMultiService.delete_config(config.remote_name, cfg_server, config.public_key)
             else:
                 await WireGuardService.delete_config(config_name)
         
@@ -24,6 +24,9 @@ from services.wireguard import WireGuardService
 from services.traffic import format_bytes, get_config_traffic, get_user_total_traffic
 from services.wireguard_multi import WireGuardMultiService
 from services.ocr import OCRService
+from services.qr import QrService
+from services.media_cache import MediaCache
+from services.provisioning import ProvisioningService, completion_callback
 from services.settings import is_password_required, is_channel_required, get_bot_password, is_phone_required, is_config_approval_required, get_setting, get_channel_name, get_max_configs, get_prices, get_referral_discount_percent
 from keyboards.admin_kb import get_payment_review_kb, get_config_request_kb, get_check_subscription_kb
 from utils import transliterate_ru_to_en, format_datetime_moscow, format_date_moscow, escape_markdown
@@ -207,16 +210,12 @@ async def create_config_multi(config_name: str, user_id: int, bot=None, user_tel
         # Проверяем доступность AWG на сервере
         has_awg = await WireGuardMultiService.check_awg_available(server)
         
-        if has_awg:
-            # Используем AmneziaWG (защищённый)
-            success, config_data, msg = await WireGuardMultiService.create_awg_config(config_name, server)
-            if success and config_data:
-                return True, config_data, config_data.server_id, msg, True
-        else:
-            # Используем обычный WireGuard
-            success, config_data, msg = await WireGuardMultiService.create_config(config_name, session, server)
-            if success and config_data:
-                return True, config_data, config_data.server_id, msg, False
+        # Выдаём заготовку из пула, если есть; иначе создаём на сервере
+        from services.warm_pool import WarmPoolService
+        protocol = "awg" if has_awg else "wg"
+        success, config_data, msg = await WarmPoolService.issue(config_name, server, protocol, session)
+        if success and config_data:
+            return True, config_data, config_data.server_id, msg, has_awg
         
         # Если не удалось создать из-за нехватки серверов - добавляем в очередь
         if "Нет доступных серверов" in msg and bot and user_telegram_id:
@@ -233,41 +232,11 @@ async def create_config_multi(config_name: str, user_id: int, bot=None, user_tel
         return False, None, None, msg, False
 
 
-async def create_config_with_protocol(config_name: str, user_id: int, protocol: str) -> tuple:
-    """
-    Создать конфиг с указанным протоколом.
-    Возвращает (success, config_data, server_id, error_msg, protocol_type)
-    
-    protocol: "wg", "awg", "v2ray"
-    """
-    async with async_session() as session:
-        # Используем умный выбор сервера с учётом заполненности и приоритета
-        target_server = await WireGuardMultiService.get_best_server_for_protocol(session, protocol)
-        
-        if not target_server:
-            return False, None, None, f"Нет серверов с поддержкой {protocol}", protocol
-        
-        # Создаём конфиг
-        if protocol == "v2ray":
-            success, config_data, msg = await WireGuardMultiService.create_v2ray_config(config_name, target_server)
-        elif protocol == "awg":
-            success, config_data, msg = await WireGuardMultiService.create_awg_config(config_name, target_server)
-        else:  # wg
-            success, config_data, msg = await WireGuardMultiService.create_config(config_name, session, target_server)
-        
-        if success and config_data:
-            return True, config_data, config_data.server_id, msg, protocol
-        
-        return False, None, None, msg, protocol
-
-
 async def send_config_file(bot: Bot, chat_id: int, config_name: str, config_data, server_id, caption: str, reply_markup=None):
     """
     Отправить конфиг-файл пользователю.
     Поддерживает как локальный сервер, так и мультисервер.
     """
-    import tempfile
-    
     if LOCAL_MODE:
         await bot.send_message(
             chat_id,
@@ -277,19 +246,21 @@ async def send_config_file(bot: Bot, chat_id: int, config_name: str, config_data
         return
     
     if server_id and hasattr(config_data, 'config_content') and config_data.config_content:
-        # Мультисервер — создаём временный файл из содержимого
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.conf', delete=False) as f:
-            f.write(config_data.config_content)
-            temp_path = f.name
-        try:
-            await bot.send_document(
-                chat_id,
-                FSInputFile(temp_path, filename=f"{config_name}.conf"),
-                caption=caption,
-                reply_markup=reply_markup
-            )
-        finally:
-            os.unlink(temp_path)
+        # Мультисервер — отправляем из памяти (повторно — по file_id)
+        await MediaCache.send_bytes(
+            bot, "document", chat_id,
+            config_data.config_content.encode('utf-8'), f"{config_name}.conf",
+            caption=caption,
+            reply_markup=reply_markup
+        )
+        
+        # QR-код для подключения с телефона (рисуется ботом)
+        await MediaCache.send_bytes(
+            bot, "photo", chat_id,
+            await QrService.get_png(config_data.config_content), f"{config_name}.png",
+            caption=f"📷 QR-код: {config_name}",
+            parse_mode=None
+        )
     else:
         # Локальный сервер
         config_path = WireGuardService.get_config_file_path(config_name)
@@ -338,12 +309,12 @@ async def cmd_akak(message: Message, bot: Bot):
     for i in range(1, 5):
         img_path = how_dir / f"{i}.jpg"
         if img_path.exists():
-            await bot.send_photo(message.from_user.id, FSInputFile(str(img_path)))
+            await MediaCache.send_path(bot, "photo", message.from_user.id, str(img_path))
     
     # Отправляем гифку
     gif_path = how_dir / "5.gif"
     if gif_path.exists():
-        await bot.send_animation(message.from_user.id, FSInputFile(str(gif_path)))
+        await MediaCache.send_path(bot, "animation", message.from_user.id, str(gif_path))
     
     # Показываем главное меню
     has_sub = await check_has_subscription(message.from_user.id)
@@ -740,12 +711,12 @@ async def how_to(callback: CallbackQuery, bot: Bot):
     for i in range(1, 5):
         img_path = how_dir / f"{i}.jpg"
         if img_path.exists():
-            await bot.send_photo(callback.from_user.id, FSInputFile(str(img_path)))
+            await MediaCache.send_path(bot, "photo", callback.from_user.id, str(img_path))
     
     # Отправляем гифку отдельно (5.gif)
     gif_path = how_dir / "5.gif"
     if gif_path.exists():
-        await bot.send_animation(callback.from_user.id, FSInputFile(str(gif_path)))
+        await MediaCache.send_path(bot, "animation", callback.from_user.id, str(gif_path))
     
     # Отправляем сообщение с кнопкой "да понял я, понял"
     await bot.send_message(
@@ -781,7 +752,7 @@ async def how_to_understood(callback: CallbackQuery, bot: Bot):
                     server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
                     if server:
                         protocol_type = getattr(config, 'protocol_type', 'wg') or 'wg'
-                        config_content = await WireGuardMultiService.fetch_config_content(config.name, server, protocol_type)
+                        config_content = await WireGuardMultiService.get_client_config(config, server)
                         if config_content:
                             if protocol_type == "v2ray":
                                 # V2Ray — отправляем ссылку текстом
@@ -791,19 +762,12 @@ async def how_to_understood(callback: CallbackQuery, bot: Bot):
                                     parse_mode="Markdown"
                                 )
                             else:
-                                import tempfile
-                                with tempfile.NamedTemporaryFile(mode='w', suffix='.conf', delete=False) as f:
-                                    f.write(config_content)
-                                    temp_path = f.name
-                                try:
-                                    await bot.send_document(
-                                        callback.from_user.id,
-                                        FSInputFile(temp_path, filename=f"{config.name}.conf"),
-                                        caption="📄 Вот твой конфиг",
-                                        parse_mode=None
-                                    )
-                                finally:
-                                    os.unlink(temp_path)
+                                await MediaCache.send_bytes(
+                                    bot, "document", callback.from_user.id,
+                                    config_content.encode('utf-8'), f"{config.name}.conf",
+                                    caption="📄 Вот твой конфиг",
+                                    parse_mode=None
+                                )
             else:
                 # Локальный сервер
                 config_path = WireGuardService.get_config_file_path(config.name)
@@ -913,24 +877,13 @@ async def funnel_get_config(callback: CallbackQuery, bot: Bot):
     
     from keyboards.user_kb import get_funnel_protocol_kb
     
-    # Показываем загрузку пока проверяем серверы
-    await callback.message.edit_text(
-        "⏳ Проверяю доступные протоколы...",
-        parse_mode="Markdown"
-    )
-    
-    # Проверяем доступность протоколов на серверах
+    # Доступность протоколов берём из кэша возможностей серверов
     has_wg = True
-    has_awg = False
-    has_v2ray = False
-    
     async with async_session() as session:
         servers = await WireGuardMultiService.get_all_servers(session)
-        for server in servers:
-            if await WireGuardMultiService.check_awg_available(server):
-                has_awg = True
-            if await WireGuardMultiService.check_v2ray_available(server):
-                has_v2ray = True
+    protocols = await WireGuardMultiService.get_available_protocols(servers)
+    has_awg = "awg" in protocols
+    has_v2ray = "v2ray" in protocols
     
     await callback.message.edit_text(
         "🌐 *Выбери уровень свободы:*\n\n"
@@ -954,27 +907,6 @@ async def funnel_protocol_selected(callback: CallbackQuery, bot: Bot):
         parse_mode="Markdown"
     )
     
-    # Активируем пробный период
-    async with async_session() as session:
-        stmt = select(User).where(User.telegram_id == callback.from_user.id)
-        result = await session.execute(stmt)
-        db_user = result.scalar_one_or_none()
-        
-        if db_user:
-            db_user.trial_used = True
-            
-            # Создаём подписку на 3 дня
-            prices = await get_prices()
-            trial_days = prices.get('trial_days', 3)
-            trial_sub = Subscription(
-                user_id=db_user.id,
-                tariff_type="trial",
-                days_total=trial_days,
-                expires_at=datetime.utcnow() + timedelta(days=trial_days)
-            )
-            session.add(trial_sub)
-            await session.commit()
-    
     # Создаём конфиг с выбранным протоколом
     username = callback.from_user.username or f"user{callback.from_user.id}"
     base_config_name = f"{protocol}_{username}"
@@ -1001,67 +933,87 @@ async def funnel_protocol_selected(callback: CallbackQuery, bot: Bot):
                     break
                 suffix += 1
     
-    # Создаём конфиг с нужным протоколом
-    success, config_data, server_id, error_msg, protocol_type = await create_config_with_protocol(
-        config_name, db_user_id, protocol
-    )
-    
-    if not success:
-        if error_msg == "QUEUE_ADDED":
-            await callback.message.edit_text(
-                "⏳ *Все серверы сейчас заняты*\n\n"
-                "Ты добавлен в очередь ожидания.\n"
-                "Как только появится свободное место — конфиг придёт автоматически!",
-                parse_mode="Markdown"
-            )
-            return
-        elif error_msg and error_msg.startswith("ALREADY_IN_QUEUE:"):
-            position = error_msg.split(":")[1]
-            await callback.message.edit_text(
-                f"⏳ *Ты уже в очереди*\n\n"
-                f"Твоя позиция: *{position}*",
-                parse_mode="Markdown"
-            )
-            return
-        
+    if db_user_id is None:
         await callback.message.edit_text(
-            f"❌ Ошибка создания конфига: {error_msg}\n\n"
+            "❌ Ошибка: пользователь не найден\n\n"
             "Напиши @agdelesha для помощи.",
             parse_mode="Markdown"
         )
         return
     
-    # Сохраняем конфиг в БД
-    async with async_session() as session:
-        stmt = select(User).where(User.telegram_id == callback.from_user.id)
-        result = await session.execute(stmt)
-        db_user = result.scalar_one_or_none()
-        
-        if db_user:
-            new_config = Config(
+    prices = await get_prices()
+    trial_days = prices.get('trial_days', 3)
+    
+    async def grant_trial(session) -> None:
+        """Пробный период (один раз, даже если задание перезапущено после ошибки)"""
+        db_user = await session.get(User, db_user_id)
+        if db_user and not db_user.trial_used:
+            db_user.trial_used = True
+            session.add(Subscription(
                 user_id=db_user.id,
-                server_id=server_id,
-                name=config_name,
-                public_key=config_data.public_key if hasattr(config_data, 'public_key') else "",
-                preshared_key=config_data.preshared_key if hasattr(config_data, 'preshared_key') else "",
-                allowed_ips=config_data.allowed_ips if hasattr(config_data, 'allowed_ips') else "",
-                client_ip=config_data.client_ip if hasattr(config_data, 'client_ip') else "",
-                is_active=True,
-                protocol_type=protocol
-            )
-            session.add(new_config)
-            await session.commit()
+                tariff_type="trial",
+                days_total=trial_days,
+                expires_at=datetime.utcnow() + timedelta(days=trial_days)
+            ))
+    
+    # Конфиг создаёт очередь заданий, результат придёт в _on_trial_config_ready.
+    # Пробный период записывается той же транзакцией, что и задание: повторное
+    # нажатие не создаст вторую подписку, а конфиг не выйдет без подписки
+    job, created = await ProvisioningService.enqueue(
+        db_user_id, config_name, protocol,
+        on_complete="trial",
+        payload={
+            "chat_id": callback.from_user.id,
+            "username": username,
+            "first_name": callback.from_user.first_name
+        },
+        idempotency_key=f"trial:{db_user_id}",
+        bot_id=bot.id,
+        retry_failed=True,
+        prepare=grant_trial
+    )
+    
+    if not created:
+        if job.status == "waiting":
+            from services.config_queue import ConfigQueueService
+            position = await ConfigQueueService.get_user_queue_position(db_user_id)
+            text = f"⏳ *Ты уже в очереди*\n\nТвоя позиция: *{position}*"
+        elif job.status == "completed":
+            text = "✅ *Конфиг уже выдан*\n\nОн в разделе «Мои конфиги»."
+        elif job.status == "failed":
+            text = "❌ *Ошибка создания конфига*\n\nНапиши @agdelesha для помощи."
+        else:
+            text = "⏳ *Конфиг уже создаётся*\n\nПришлю его, как только он будет готов."
+        await callback.message.edit_text(text, parse_mode="Markdown")
+
+
+@completion_callback("trial")
+async def _on_trial_config_ready(bot: Bot, job, config_data, error):
+    """Результат задания пробного конфига: приветствие, конфиг и главное меню"""
+    data = job.payload_data
+    chat_id = data["chat_id"]
+    protocol = job.protocol_type
+    config_name = job.config_name
+    
+    if error is not None:
+        await bot.send_message(
+            chat_id,
+            f"❌ Ошибка создания конфига: {error}\n\n"
+            "Напиши @agdelesha для помощи.",
+            parse_mode=None
+        )
+        return
     
     # Генерируем приветствие через DeepSeek
     from services.ai_assistant import generate_welcome_instruction
-    welcome_text = await generate_welcome_instruction(protocol, username)
+    welcome_text = await generate_welcome_instruction(protocol, data.get("username"))
     
     prices = await get_prices()
     trial_days = prices.get('trial_days', 3)
     
     # Отправляем приветствие
     await bot.send_message(
-        callback.from_user.id,
+        chat_id,
         f"🎉 {welcome_text}\n\n"
         f"⏰ Через {trial_days} дня пробный период закончится."
     )
@@ -1071,7 +1023,7 @@ async def funnel_protocol_selected(callback: CallbackQuery, bot: Bot):
         # Для V2Ray отправляем ссылку (она хранится в config_content)
         vless_link = config_data.config_content if hasattr(config_data, 'config_content') else ""
         await bot.send_message(
-            callback.from_user.id,
+            chat_id,
             f"🔗 *Твоя ссылка для подключения:*\n\n`{vless_link}`\n\n"
             "Скопируй и добавь в приложение.",
             parse_mode="Markdown"
@@ -1080,7 +1032,7 @@ async def funnel_protocol_selected(callback: CallbackQuery, bot: Bot):
         # Для AWG отправляем текст конфига
         config_content = config_data.config_content if hasattr(config_data, 'config_content') else ""
         await bot.send_message(
-            callback.from_user.id,
+            chat_id,
             f"🛡 *Твой AmneziaWG конфиг:*\n\n"
             f"```\n{config_content}\n```\n\n"
             "Скопируй и импортируй в AmneziaVPN.",
@@ -1090,13 +1042,13 @@ async def funnel_protocol_selected(callback: CallbackQuery, bot: Bot):
     else:
         # Для обычного WG отправляем файл
         await send_config_file(
-            bot, callback.from_user.id, config_name, config_data, server_id,
+            bot, chat_id, config_name, config_data, config_data.server_id,
             caption="📄 Твой конфиг",
             reply_markup=get_after_config_kb()
         )
     
     # Показываем главное меню
-    user_name = callback.from_user.first_name or "друг"
+    user_name = data.get("first_name") or "друг"
     menu_text = (
         f"Привет, {user_name}! 👋\n\n"
         f"📱 *Конфиги* — твои подключения и QR-коды\n"
@@ -1104,10 +1056,10 @@ async def funnel_protocol_selected(callback: CallbackQuery, bot: Bot):
         f"💬 Есть вопросы? Просто напиши — AI-помощник на связи!"
     )
     await bot.send_message(
-        callback.from_user.id,
+        chat_id,
         menu_text,
         parse_mode="Markdown",
-        reply_markup=get_main_menu_kb(callback.from_user.id, True)
+        reply_markup=get_main_menu_kb(chat_id, True)
     )
 
 
@@ -1116,26 +1068,16 @@ async def get_vpn(callback: CallbackQuery, state: FSMContext):
     """Получить конфиг - сразу переходим к выбору протокола"""
     await callback.answer()
     
-    # Показываем индикатор загрузки
-    await callback.message.edit_text(
-        "⏳ *Загрузка...*\n\nПроверяю доступные протоколы",
-        parse_mode="Markdown"
-    )
-    
-    # Проверяем доступные протоколы на серверах
+    # Доступные протоколы — из кэша возможностей серверов
     from keyboards.user_kb import get_protocol_choice_kb
     from services.wireguard_multi import WireGuardMultiService
     
     async with async_session() as session:
         servers = await WireGuardMultiService.get_all_servers(session)
-        has_wg = len(servers) > 0
-        has_awg = False
-        has_v2ray = False
-        for srv in servers:
-            if await WireGuardMultiService.check_awg_available(srv):
-                has_awg = True
-            if await WireGuardMultiService.check_v2ray_available(srv):
-                has_v2ray = True
+    has_wg = len(servers) > 0
+    protocols = await WireGuardMultiService.get_available_protocols(servers)
+    has_awg = "awg" in protocols
+    has_v2ray = "v2ray" in protocols
     
     if not has_wg and not has_awg and not has_v2ray:
         await callback.message.edit_text(
@@ -1219,7 +1161,9 @@ async def tariff_trial(callback: CallbackQuery, bot: Bot):
             preshared_key=config_data.preshared_key,
             allowed_ips=config_data.allowed_ips,
             client_ip=config_data.client_ip,
-            is_active=True
+            is_active=True,
+            peer_name=getattr(config_data, 'peer_name', None),
+            config_content=getattr(config_data, 'config_content', None)
         )
         session.add(config)
         
@@ -1642,7 +1586,9 @@ async def process_receipt(message: Message, state: FSMContext, bot: Bot):
                     preshared_key=config_data.preshared_key,
                     allowed_ips=config_data.allowed_ips,
                     client_ip=config_data.client_ip,
-                    is_active=True
+                    is_active=True,
+                    peer_name=getattr(config_data, 'peer_name', None),
+                    config_content=getattr(config_data, 'config_content', None)
                 )
                 session.add(config)
             
@@ -1898,18 +1844,16 @@ async def config_detail(callback: CallbackQuery):
         
         traffic_text = ""
         if config.public_key and not server_deleted:
-            # Получаем трафик с правильного сервера
-            if config.server_id and server:
-                traffic_stats = await WireGuardMultiService.get_traffic_stats(server)
-            else:
-                traffic_stats = await WireGuardService.get_traffic_stats()
+            from services.traffic_history import TrafficHistory
             
-            if config.public_key in traffic_stats:
-                stats = traffic_stats[config.public_key]
-                received = format_bytes(stats['received'])
-                sent = format_bytes(stats['sent'])
-                total = format_bytes(stats['received'] + stats['sent'])
-                traffic_text = f"\n\n📊 *Трафик:*\n⬇️ Получено: {received}\n⬆️ Отправлено: {sent}\n📈 Всего: {total}"
+            # Трафик за 30 дней — из истории трафика (пишется планировщиком каждые 5 минут)
+            usage = await TrafficHistory.get_usage(datetime.utcnow() - timedelta(days=30), config_ids=[config.id])
+            stats = usage.get(config.id)
+            if stats:
+                traffic_text = (
+                    f"\n\n📊 *Трафик за 30 дней:*\n⬇️ Получено: {stats.format_received()}"
+                    f"\n⬆️ Отправлено: {stats.format_sent()}\n📈 Всего: {stats.format_total()}"
+                )
         
         server_warning = ""
         if server_deleted:
@@ -1949,19 +1893,14 @@ async def download_config(callback: CallbackQuery, bot: Bot):
         
         # Проверяем, это конфиг с удалённого сервера или локальный
         if config.server_id:
-            # Мультисервер — получаем конфиг по SSH
+            # Мультисервер — конфиг из БД (старые конфиги — с сервера по SSH)
             server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
             if not server:
                 await callback.answer("❌ Сервер не найден", show_alert=True)
                 return
             
             protocol_type = getattr(config, 'protocol_type', 'wg') or 'wg'
-            config_content = await WireGuardMultiService.fetch_config_content(config.name, server, protocol_type)
-            
-            # Если файл не найден — пробуем пересоздать (только для WG/AWG)
-            if not config_content and protocol_type not in ("v2ray",):
-                await callback.answer("⏳ Пересоздаю конфиг...", show_alert=False)
-                config_content = await WireGuardMultiService.regenerate_config_file(config.name, server)
+            config_content = await WireGuardMultiService.get_client_config(config, server)
             
             if config_content:
                 if protocol_type == "v2ray":
@@ -1973,20 +1912,13 @@ async def download_config(callback: CallbackQuery, bot: Bot):
                     )
                     await callback.answer("✅ Конфиг отправлен")
                 else:
-                    import tempfile
-                    with tempfile.NamedTemporaryFile(mode='w', suffix='.conf', delete=False) as f:
-                        f.write(config_content)
-                        temp_path = f.name
-                    try:
-                        await bot.send_document(
-                            callback.from_user.id,
-                            FSInputFile(temp_path, filename=f"{config.name}.conf"),
-                            caption=f"📄 Конфиг: {config.name}",
-                            parse_mode=None
-                        )
-                        await callback.answer("✅ Конфиг отправлен")
-                    finally:
-                        os.unlink(temp_path)
+                    await MediaCache.send_bytes(
+                        bot, "document", callback.from_user.id,
+                        config_content.encode('utf-8'), f"{config.name}.conf",
+                        caption=f"📄 Конфиг: {config.name}",
+                        parse_mode=None
+                    )
+                    await callback.answer("✅ Конфиг отправлен")
             else:
                 await callback.answer("❌ Не удалось получить конфиг с сервера", show_alert=True)
         else:
@@ -2031,11 +1963,7 @@ async def show_config(callback: CallbackQuery, bot: Bot):
                 await callback.answer("❌ Сервер не найден", show_alert=True)
                 return
             
-            config_content = await WireGuardMultiService.fetch_config_content(config.name, server, protocol_type)
-            
-            if not config_content and protocol_type not in ("v2ray",):
-                await callback.answer("⏳ Пересоздаю конфиг...", show_alert=False)
-                config_content = await WireGuardMultiService.regenerate_config_file(config.name, server)
+            config_content = await WireGuardMultiService.get_client_config(config, server)
             
             if config_content:
                 if protocol_type == "v2ray":
@@ -2082,28 +2010,18 @@ async def qr_config(callback: CallbackQuery, bot: Bot):
         
         # Проверяем, это конфиг с удалённого сервера или локальный
         if config.server_id:
-            # Мультисервер — получаем QR по SSH
+            # Мультисервер — QR рисуем из сохранённого конфига
             server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
             if not server:
                 await callback.answer("❌ Сервер не найден", show_alert=True)
                 return
             
-            protocol_type = getattr(config, 'protocol_type', 'wg') or 'wg'
-            qr_content = await WireGuardMultiService.fetch_qr_content(config.name, server, protocol_type)
-            
-            # Если QR не найден — пробуем пересоздать конфиг (QR создастся вместе с ним, только для WG/AWG)
-            if not qr_content and protocol_type not in ("v2ray",):
-                await callback.answer("⏳ Пересоздаю конфиг...", show_alert=False)
-                config_content = await WireGuardMultiService.regenerate_config_file(config.name, server)
-                if config_content:
-                    qr_content = await WireGuardMultiService.fetch_qr_content(config.name, server, protocol_type)
+            qr_content = await WireGuardMultiService.get_client_qr(config, server)
             
             if qr_content:
-                import tempfile
-                from aiogram.types import BufferedInputFile
-                await bot.send_photo(
-                    callback.from_user.id,
-                    BufferedInputFile(qr_content, filename=f"{config.name}.png"),
+                await MediaCache.send_bytes(
+                    bot, "photo", callback.from_user.id,
+                    qr_content, f"{config.name}.png",
                     caption=f"📷 QR-код: {config.name}",
                     parse_mode=None
                 )
@@ -2176,11 +2094,11 @@ async def user_confirm_delete_config(callback: CallbackQuery):
             if server:
                 try:
                     if protocol_type == "v2ray":
-                        await WireGuardMultiService.delete_v2ray_config(config_name, server)
+                        await WireGuardMultiService.delete_v2ray_config(config.remote_name, server)
                     elif protocol_type == "awg":
-                        await WireGuardMultiService.delete_awg_config(config_name, server, config.public_key)
+                        await WireGuardMultiService.delete_awg_config(config.remote_name, server, config.public_key)
                     else:
-                        await WireGuardMultiService.delete_config(config_name, server, config.public_key)
+                        await WireGuardMultiService.delete_config(config.remote_name, server, config.public_key)
                 except Exception as e:
                     logger.error(f"Ошибка удаления конфига с сервера: {e}")
         
@@ -2312,25 +2230,15 @@ async def request_extra_config(callback: CallbackQuery, state: FSMContext, bot:
             )
             return
     
-    # Показываем индикатор загрузки
-    await callback.message.edit_text(
-        "⏳ *Загрузка...*\n\nПроверяю доступные протоколы",
-        parse_mode="Markdown"
-    )
-    
-    # Проверяем доступные протоколы на серверах
+    # Доступные протоколы — из кэша возможностей серверов
     from keyboards.user_kb import get_protocol_choice_kb
     from services.wireguard_multi import WireGuardMultiService
     
     async with async_session() as session:
         servers = await WireGuardMultiService.get_all_servers(session)
-        has_awg = False
-        has_v2ray = False
-        for srv in servers:
-            if await WireGuardMultiService.check_awg_available(srv):
-                has_awg = True
-            if await WireGuardMultiService.check_v2ray_available(srv):
-                has_v2ray = True
+    protocols = await WireGuardMultiService.get_available_protocols(servers)
+    has_awg = "awg" in protocols
+    has_v2ray = "v2ray" in protocols
     
     await callback.message.edit_text(
         "📱 *Дополнительный конфиг*\n\n"
@@ -2446,78 +2354,84 @@ async def process_device_request(message: Message, state: FSMContext, bot: Bot):
             "⏳ Создаю конфиг, подожди несколько секунд..."
         )
         
-        # Создаём конфиг в зависимости от выбранного протокола
-        success, config_data, server_id, msg, protocol_type = await create_config_with_protocol(
-            config_name, user_id, selected_protocol
+        # Конфиг создаёт очередь заданий, результат придёт в _on_device_config_ready
+        await ProvisioningService.enqueue(
+            user_id, config_name, selected_protocol,
+            on_complete="device",
+            payload={
+                "chat_id": message.chat.id,
+                "device_name": device_name,
+                "wait_message_id": wait_msg.message_id
+            },
+            idempotency_key=f"device:{telegram_id}:{message.message_id}",
+            bot_id=bot.id
+        )
+
+
+@completion_callback("device")
+async def _on_device_config_ready(bot: Bot, job, config_data, error):
+    """Результат задания дополнительного конфига"""
+    data = job.payload_data
+    chat_id = data["chat_id"]
+    device_name = data.get("device_name")
+    protocol_type = job.protocol_type
+    
+    # Удаляем сообщение "подождите"
+    try:
+        await bot.delete_message(chat_id, data["wait_message_id"])
+    except:
+        pass
+    
+    if error is not None:
+        await bot.send_message(
+            chat_id,
+            f"❌ Ошибка создания конфига: {error}\n\n"
+            "Напиши @agdelesha для помощи.",
+            parse_mode=None,
+            reply_markup=get_main_menu_kb(chat_id, True)
+        )
+        return
+    
+    # Отправляем конфиг пользователю
+    if protocol_type == "v2ray":
+        # Для V2Ray отправляем ссылку как текст (с клавиатурой сразу)
+        await bot.send_message(
+            chat_id,
+            f"🚀 *V2Ray/VLESS конфиг создан!*\n\n"
+            f"📱 Устройство: {device_name}\n\n"
+            f"📋 Ссылка для импорта:\n`{config_data.config_content}`\n\n"
+            f"⚠️ Скопируй ссылку и импортируй в приложение:\n"
+            f"• Android: V2RayNG\n"
+            f"• iOS: Streisand, V2Box\n"
+            f"• Windows: V2RayN\n"
+            f"• Mac: V2RayU",
+            parse_mode="Markdown",
+            reply_markup=get_main_menu_kb(chat_id, True)
+        )
+    elif protocol_type == "awg":
+        # Для AWG отправляем текст конфига
+        await bot.send_message(
+            chat_id,
+            f"🛡 *AmneziaWG конфиг создан!*\n\n"
+            f"📱 Устройство: {device_name}\n\n"
+            f"```\n{config_data.config_content}\n```\n\n"
+            f"⚠️ Скопируй и импортируй в AmneziaVPN\n"
+            f"Скачать: https://amnezia.org/ru/downloads",
+            parse_mode="Markdown",
+            reply_markup=get_main_menu_kb(chat_id, True)
+        )
+    else:
+        # Для обычного WG отправляем файл
+        caption = f"📄 Твой WireGuard конфиг для {device_name}\n\n📷 QR-код можно найти в меню «Конфиги»"
+        await send_config_file(
+            bot, chat_id, job.config_name, config_data, config_data.server_id,
+            caption=caption
+        )
+        await bot.send_message(
+            chat_id,
+            "✅ Конфиг создан!",
+            reply_markup=get_main_menu_kb(chat_id, True)
         )
-        
-        # Удаляем сообщение "подождите"
-        try:
-            await wait_msg.delete()
-        except:
-            pass
-        
-        if not success:
-            await message.answer(
-                f"❌ Ошибка создания конфига: {msg}\n\n"
-                "Напиши @agdelesha для помощи.",
-                reply_markup=get_main_menu_kb(message.from_user.id, True)
-            )
-            return
-        
-        # Сохраняем конфиг в БД
-        async with async_session() as session:
-            new_config = Config(
-                user_id=user_id,
-                server_id=server_id,
-                name=config_name,
-                public_key=config_data.public_key,
-                preshared_key=config_data.preshared_key or "",
-                allowed_ips=config_data.allowed_ips or "",
-                client_ip=config_data.client_ip or "",
-                is_active=True,
-                protocol_type=protocol_type
-            )
-            session.add(new_config)
-            await session.commit()
-        
-        # Отправляем конфиг пользователю
-        if protocol_type == "v2ray":
-            # Для V2Ray отправляем ссылку как текст (с клавиатурой сразу)
-            await message.answer(
-                f"🚀 *V2Ray/VLESS конфиг создан!*\n\n"
-                f"📱 Устройство: {device_name}\n\n"
-                f"📋 Ссылка для импорта:\n`{config_data.config_content}`\n\n"
-                f"⚠️ Скопируй ссылку и импортируй в приложение:\n"
-                f"• Android: V2RayNG\n"
-                f"• iOS: Streisand, V2Box\n"
-                f"• Windows: V2RayN\n"
-                f"• Mac: V2RayU",
-                parse_mode="Markdown",
-                reply_markup=get_main_menu_kb(message.from_user.id, True)
-            )
-        elif protocol_type == "awg":
-            # Для AWG отправляем текст конфига
-            await message.answer(
-                f"🛡 *AmneziaWG конфиг создан!*\n\n"
-                f"📱 Устройство: {device_name}\n\n"
-                f"```\n{config_data.config_content}\n```\n\n"
-                f"⚠️ Скопируй и импортируй в AmneziaVPN\n"
-                f"Скачать: https://amnezia.org/ru/downloads",
-                parse_mode="Markdown",
-                reply_markup=get_main_menu_kb(message.from_user.id, True)
-            )
-        else:
-            # Для обычного WG отправляем файл
-            caption = f"📄 Твой WireGuard конфиг для {device_name}\n\n📷 QR-код можно найти в меню «Конфиги»"
-            await send_config_file(
-                bot, message.from_user.id, config_name, config_data, server_id,
-                caption=caption
-            )
-            await message.answer(
-                "✅ Конфиг создан!",
-                reply_markup=get_main_menu_kb(message.from_user.id, True)
-            )
 
 
 @router.callback_query(F.data == "cancel_device_input")
@@ -2858,7 +2772,9 @@ async def activate_trial_from_ai(message: Message, bot: Bot):
                 preshared_key=config_data.preshared_key,
                 allowed_ips=config_data.allowed_ips,
                 client_ip=config_data.client_ip,
-                is_active=True
+                is_active=True,
+                peer_name=getattr(config_data, 'peer_name', None),
+                config_content=getattr(config_data, 'config_content', None)
             )
             session.add(new_config)
             await session.commit()
@@ -3033,6 +2949,7 @@ async def upgrade_config_to_awg(callback: CallbackQuery, bot: Bot):
             return
         
         old_config_name = config.name
+        old_remote_name = config.remote_name
         old_public_key = config.public_key
         
         # Создаём новый AWG конфиг с тем же именем + суффикс _awg
@@ -3050,12 +2967,13 @@ async def upgrade_config_to_awg(callback: CallbackQuery, bot: Bot):
         
         # Удаляем старый конфиг с сервера WireGuard
         try:
-            await WireGuardMultiService.delete_config(old_config_name, server, old_public_key)
+            await WireGuardMultiService.delete_config(old_remote_name, server, old_public_key)
         except Exception as e:
             logger.error(f"Ошибка удаления старого конфига: {e}")
         
         # Обновляем запись в БД
         config.name = new_config_name
+        config.peer_name = None
         config.public_key = awg_data.public_key
         config.preshared_key = awg_data.preshared_key
         config.allowed_ips = awg_data.allowed_ips
@@ -3084,20 +3002,18 @@ async def upgrade_config_to_awg(callback: CallbackQuery, bot: Bot):
         )
         
         # Отправляем файл конфига
-        from aiogram.types import BufferedInputFile
-        
-        await bot.send_document(
-            callback.from_user.id,
-            document=BufferedInputFile(awg_data.config_content.encode('utf-8'), filename=f"{new_config_name}.conf"),
+        await MediaCache.send_bytes(
+            bot, "document", callback.from_user.id,
+            awg_data.config_content.encode('utf-8'), f"{new_config_name}.conf",
             caption=f"📥 Защищённый конфиг `{new_config_name}`\n\n⚠️ Используй *AmneziaVPN* для подключения!\nСкачай: https://amnezia.org/ru/downloads",
             parse_mode="Markdown"
         )
         
-        # Отправляем QR-код если есть
-        if awg_data.qr_content:
-            await bot.send_photo(
-                callback.from_user.id,
-                photo=BufferedInputFile(awg_data.qr_content, filename=f"{new_config_name}_qr.png"),
+        # Отправляем QR-код (рисует бот)
+        if awg_data.config_content:
+            await MediaCache.send_bytes(
+                bot, "photo", callback.from_user.id,
+                await QrService.get_png(awg_data.config_content), f"{new_config_name}_qr.png",
                 caption=f"📷 QR-код для `{new_config_name}`",
                 parse_mode="Markdown"
             )
@@ -311,6 +311,7 @@ def get_servers_list_kb(servers: list, client_counts: dict = None, queue_count:
     buttons.append([InlineKeyboardButton(text="➕ Добавить сервер", callback_data="admin_server_add")])
     queue_badge = f" ({queue_count})" if queue_count > 0 else ""
     buttons.append([InlineKeyboardButton(text=f"⏳ Очередь конфигов{queue_badge}", callback_data="admin_config_queue")])
+    buttons.append([InlineKeyboardButton(text="🔎 Сверка серверов", callback_data="admin_reconcile_all")])
     buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_menu")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
@@ -326,7 +327,7 @@ def get_server_detail_kb(server_id: int, is_active: bool, has_clients: bool = Tr
         [InlineKeyboardButton(text="✏️ Редактировать", callback_data=f"admin_server_edit_{server_id}")],
         [InlineKeyboardButton(text="📊 Статистика", callback_data=f"admin_server_stats_{server_id}")],
         [InlineKeyboardButton(text="🔀 Мигрировать клиентов", callback_data=f"admin_server_migrate_{server_id}")],
-        [InlineKeyboardButton(text="🧹 Очистить мёртвые пиры", callback_data=f"admin_server_cleanup_{server_id}")],
+        [InlineKeyboardButton(text="🔎 Сверка с БД", callback_data=f"admin_server_cleanup_{server_id}")],
         [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"admin_server_delete_{server_id}")],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_servers")],
     ]
@@ -348,7 +349,7 @@ def get_server_migrate_kb(source_server_id: int, target_servers: list) -> Inline
     """Клавиатура выбора целевого сервера для миграции"""
     buttons = []
     for server in target_servers:
-        free_slots = server.max_clients - len(server.configs)
+        free_slots = server.max_clients - server.client_count
         buttons.append([InlineKeyboardButton(
             text=f"➡️ {server.name} (свободно: {free_slots})",
             callback_data=f"admin_migrate_to_{source_server_id}_{server.id}"
@@ -363,6 +364,9 @@ def get_migrate_confirm_kb(source_id: int, target_id: int, count: int) -> Inline
         [
             InlineKeyboardButton(text=f"✅ Да, мигрировать {count} клиентов", callback_data=f"admin_migrate_confirm_{source_id}_{target_id}"),
         ],
+        [
+            InlineKeyboardButton(text="🧪 Пробный прогон", callback_data=f"admin_migrate_dryrun_{source_id}_{target_id}"),
+        ],
         [
             InlineKeyboardButton(text="❌ Отмена", callback_data=f"admin_server_{source_id}"),
         ],
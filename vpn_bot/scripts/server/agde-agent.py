@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+agde-agent — агент управления VPN сервером для бота.
+
+Запускается ботом по SSH один раз и живёт, пока открыт канал.
+Протокол: JSON по строке на сообщение (stdin -> stdout).
+  -> {"id": 1, "method": "dump", "params": {"interface": "wg0"}}
+  <- {"id": 1, "ok": true, "result": "..."}
+  <- {"id": 2, "ok": false, "error": "..."}
+Запросы выполняются параллельно, ответы могут приходить не по порядку.
+
+Установка: /usr/local/bin/agde-agent.py (делает install_wireguard или setup_xray.sh).
+Требуется только python3 без сторонних пакетов.
+"""
+
+import base64
+import json
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+VERSION = 3
+MAX_WORKERS = 4
+COMMAND_TIMEOUT = 60
+
+_write_lock = threading.Lock()
+
+
+class AgentError(Exception):
+    """Ошибка выполнения запроса (уходит клиенту в поле error)"""
+
+
+def _run(argv, input_text=None, timeout=COMMAND_TIMEOUT):
+    """Запустить команду без shell и вернуть stdout; при ошибке — AgentError"""
+    proc = subprocess.run(
+        argv,
+        input=input_text,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=timeout
+    )
+    if proc.returncode != 0:
+        raise AgentError(proc.stderr.strip() or "{} завершился с кодом {}".format(argv[0], proc.returncode))
+    return proc.stdout
+
+
+def _clean_ips(allowed_ips):
+    """WireGuard не понимает пробелы после запятых в allowed-ips"""
+    return ",".join(part.strip() for part in allowed_ips.split(",") if part.strip())
+
+
+# ============ Методы ============
+
+def ping():
+    return {"version": VERSION}
+
+
+def add_peer(interface, public_key, allowed_ips, preshared_key=None, tool="wg"):
+    argv = [tool, "set", interface, "peer", public_key]
+    if preshared_key:
+        argv += ["preshared-key", "/dev/stdin"]
+    argv += ["allowed-ips", _clean_ips(allowed_ips)]
+    _run(argv, input_text=preshared_key)
+    return True
+
+
+def remove_peer(interface, public_key, tool="wg"):
+    _run([tool, "set", interface, "peer", public_key, "remove"])
+    return True
+
+
+def remove_peers(interface, public_keys, save=False, tool="wg"):
+    """
+    Убрать несколько пиров одним вызовом wg set.
+    Если общий вызов упал (например, битый ключ) — удаляем по одному и сообщаем об ошибках.
+    """
+    removed, failed = [], {}
+    if public_keys:
+        argv = [tool, "set", interface]
+        for key in public_keys:
+            argv += ["peer", key, "remove"]
+        try:
+            _run(argv)
+            removed = list(public_keys)
+        except AgentError:
+            for key in public_keys:
+                try:
+                    _run([tool, "set", interface, "peer", key, "remove"])
+                    removed.append(key)
+                except AgentError as e:
+                    failed[key] = str(e)
+    result = {"removed": removed, "failed": failed}
+    if save and removed:
+        # Пиры уже убраны из интерфейса — ошибка сохранения на это не влияет
+        try:
+            _run(["{}-quick".format(tool), "save", interface])
+        except AgentError as e:
+            result["save_error"] = str(e)
+    return result
+
+
+def save(interface, tool="wg"):
+    _run(["{}-quick".format(tool), "save", interface])
+    return True
+
+
+def dump(interface, tool="wg"):
+    return _run([tool, "show", interface, "dump"])
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("ascii")
+
+
+def run(argv, timeout=COMMAND_TIMEOUT):
+    """Запустить скрипт (без shell); ненулевой код выхода — не ошибка агента"""
+    proc = subprocess.run(
+        argv,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=timeout
+    )
+    return {"exit_status": proc.returncode, "stdout": proc.stdout, "stderr": proc.stderr}
+
+
+METHODS = {
+    "ping": ping,
+    "add_peer": add_peer,
+    "enable_peer": add_peer,
+    "remove_peer": remove_peer,
+    # Отключение = пир убирается из интерфейса, но остаётся в конфиге на диске
+    "disable_peer": remove_peer,
+    "remove_peers": remove_peers,
+    "save": save,
+    "dump": dump,
+    "read_file": read_file,
+    "run": run,
+}
+
+
+# ============ Цикл обработки ============
+
+def _reply(message):
+    data = json.dumps(message, ensure_ascii=False)
+    with _write_lock:
+        sys.stdout.write(data + "\n")
+        sys.stdout.flush()
+
+
+def _handle(request):
+    req_id = request.get("id")
+    method = METHODS.get(request.get("method"))
+    if method is None:
+        _reply({"id": req_id, "ok": False, "error": "Неизвестный метод: {}".format(request.get("method"))})
+        return
+    try:
+        result = method(**(request.get("params") or {}))
+        _reply({"id": req_id, "ok": True, "result": result})
+    except subprocess.TimeoutExpired:
+        _reply({"id": req_id, "ok": False, "error": "Таймаут выполнения команды"})
+    except Exception as e:
+        _reply({"id": req_id, "ok": False, "error": str(e)})
+
+
+def main():
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                _reply({"id": None, "ok": False, "error": "Некорректный JSON"})
+                continue
+            executor.submit(_handle, request)
+
+
+if __name__ == "__main__":
+    main()
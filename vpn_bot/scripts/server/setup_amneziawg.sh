@@ -101,10 +101,18 @@ CLIENT_PRIVATE_KEY=$(wg genkey)
 CLIENT_PUBLIC_KEY=$(echo "$CLIENT_PRIVATE_KEY" | wg pubkey)
 PRESHARED_KEY=$(wg genpsk)
 
-LAST_IP=$(grep -oP '10\.8\.1\.\K[0-9]+' $AWG_CONFIG | sort -n | tail -1)
-if [ -z "$LAST_IP" ]; then LAST_IP=1; fi
-NEW_IP=$((LAST_IP + 1))
-CLIENT_IP="10.8.1.$NEW_IP"
+# Адрес выдаёт бот (IPAM) вторым аргументом: 10.8.1.5/24
+if [ -n "$2" ]; then
+    CLIENT_IP="${2%/*}"
+    CLIENT_PREFIX=24
+    [[ "$2" == */* ]] && CLIENT_PREFIX="${2#*/}"
+else
+    LAST_IP=$(grep -oP '10\.8\.1\.\K[0-9]+' $AWG_CONFIG | sort -n | tail -1)
+    if [ -z "$LAST_IP" ]; then LAST_IP=1; fi
+    NEW_IP=$((LAST_IP + 1))
+    CLIENT_IP="10.8.1.$NEW_IP"
+    CLIENT_PREFIX=24
+fi
 
 cat >> $AWG_CONFIG << EOF
 
@@ -118,7 +126,7 @@ EOF
 cat > "$CLIENT_DIR/$USERNAME.conf" << EOF
 [Interface]
 PrivateKey = $CLIENT_PRIVATE_KEY
-Address = $CLIENT_IP/24
+Address = $CLIENT_IP/$CLIENT_PREFIX
 DNS = 1.1.1.1, 8.8.8.8
 Jc = $JC
 Jmin = $JMIN
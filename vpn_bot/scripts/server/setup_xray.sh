@@ -149,6 +149,15 @@ SCRIPT
 
 chmod +x /usr/local/bin/v2ray-new-conf.sh /usr/local/bin/v2ray-remove-client.sh
 
+# Агент управления для бота (если скрипт запущен из папки scripts/server)
+AGENT_SRC="$(dirname "$0")/agde-agent.py"
+if [ -f "$AGENT_SRC" ]; then
+    install -m 755 "$AGENT_SRC" /usr/local/bin/agde-agent.py
+    echo "Агент agde-agent установлен"
+else
+    echo "agde-agent.py не найден рядом со скриптом — бот будет работать через shell"
+fi
+
 # Запускаем Xray
 systemctl enable xray
 systemctl restart xray
@@ -1,6 +1,6 @@
 #!/bin/bash
 # Скрипт создания нового клиента WireGuard
-# Использование: ./wg-new-conf.sh <username>
+# Использование: ./wg-new-conf.sh <username> [client_ip/prefix]
 
 set -e
 
@@ -12,7 +12,7 @@ SERVER_PORT=$(grep ListenPort $WG_CONFIG | awk '{print $3}')
 
 USERNAME="$1"
 if [ -z "$USERNAME" ]; then
-    echo "Usage: $0 <username>"
+    echo "Usage: $0 <username> [client_ip/prefix]"
     exit 1
 fi
 
@@ -23,13 +23,21 @@ CLIENT_PRIVATE_KEY=$(wg genkey)
 CLIENT_PUBLIC_KEY=$(echo "$CLIENT_PRIVATE_KEY" | wg pubkey)
 PRESHARED_KEY=$(wg genpsk)
 
-# Находим следующий свободный IP
-LAST_IP=$(grep -oP '10\.0\.0\.\K[0-9]+' $WG_CONFIG | sort -n | tail -1)
-if [ -z "$LAST_IP" ]; then
-    LAST_IP=1
+# Адрес выдаёт бот (IPAM) вторым аргументом: 10.0.0.5/24;
+# без него — следующий после максимального в конфиге
+if [ -n "$2" ]; then
+    CLIENT_IP="${2%/*}"
+    CLIENT_PREFIX=24
+    [[ "$2" == */* ]] && CLIENT_PREFIX="${2#*/}"
+else
+    LAST_IP=$(grep -oP '10\.0\.0\.\K[0-9]+' $WG_CONFIG | sort -n | tail -1)
+    if [ -z "$LAST_IP" ]; then
+        LAST_IP=1
+    fi
+    NEW_IP=$((LAST_IP + 1))
+    CLIENT_IP="10.0.0.$NEW_IP"
+    CLIENT_PREFIX=24
 fi
-NEW_IP=$((LAST_IP + 1))
-CLIENT_IP="10.0.0.$NEW_IP"
 
 # Добавляем клиента в конфиг сервера
 cat >> $WG_CONFIG << EOF
@@ -46,7 +54,7 @@ EOF
 cat > "$CLIENT_DIR/$USERNAME.conf" << EOF
 [Interface]
 PrivateKey = $CLIENT_PRIVATE_KEY
-Address = $CLIENT_IP/24
+Address = $CLIENT_IP/$CLIENT_PREFIX
 DNS = 1.1.1.1, 8.8.8.8
 
 [Peer]
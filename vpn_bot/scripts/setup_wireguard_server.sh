@@ -115,13 +115,23 @@ PUBLIC_KEY=$(echo "$PRIVATE_KEY" | wg pubkey)
 PRESHARED_KEY=$(wg genpsk)
 
 # === Определение последнего IP ===
-LAST_IP=$(grep -rhPo "(?<=AllowedIPs = ${VPN_SUBNET}\.)[0-9]+" "$WG_CONF" "$CLIENT_DIR"/*.conf 2>/dev/null | sort -n | tail -n1)
-if [[ ! $LAST_IP =~ ^[0-9]+$ ]]; then
-  LAST_IP=1
+# Адрес выдаёт бот (IPAM) вторым аргументом: 10.7.0.5/24
+if [ -n "$2" ]; then
+  CLIENT_IPV4="${2%/*}"
+  CLIENT_PREFIX=24
+  [[ "$2" == */* ]] && CLIENT_PREFIX="${2#*/}"
+  IFS=. read -r _ _ OCTET3 OCTET4 <<< "$CLIENT_IPV4"
+  CLIENT_IPV6="fddd:2c4:2c4:2c4::${OCTET3}:${OCTET4}"
+else
+  LAST_IP=$(grep -rhPo "(?<=AllowedIPs = ${VPN_SUBNET}\.)[0-9]+" "$WG_CONF" "$CLIENT_DIR"/*.conf 2>/dev/null | sort -n | tail -n1)
+  if [[ ! $LAST_IP =~ ^[0-9]+$ ]]; then
+    LAST_IP=1
+  fi
+  NEXT_IP=$((LAST_IP + 1))
+  CLIENT_IPV4="${VPN_SUBNET}.${NEXT_IP}"
+  CLIENT_PREFIX=24
+  CLIENT_IPV6="fddd:2c4:2c4:2c4::${NEXT_IP}"
 fi
-NEXT_IP=$((LAST_IP + 1))
-CLIENT_IPV4="${VPN_SUBNET}.${NEXT_IP}"
-CLIENT_IPV6="fddd:2c4:2c4:2c4::${NEXT_IP}"
 
 CONFIG_FILE="$CLIENT_DIR/${USERNAME}.conf"
 QR_PNG="$CLIENT_DIR/${USERNAME}.png"
@@ -130,7 +140,7 @@ QR_PNG="$CLIENT_DIR/${USERNAME}.png"
 cat > "$CONFIG_FILE" <<EOF
 [Interface]
 PrivateKey = $PRIVATE_KEY
-Address = $CLIENT_IPV4/24, $CLIENT_IPV6/64
+Address = $CLIENT_IPV4/$CLIENT_PREFIX, $CLIENT_IPV6/64
 DNS = 1.1.1.1
 
 [Peer]
@@ -0,0 +1,109 @@
+"""
+Асинхронный кэш с объединением запросов (single-flight).
+
+Одновременные промахи по одному ключу ждут одну загрузку, а не запускают
+каждый свою (один `wg show` на сервер, сколько бы пользователей ни
+открыли «Мои конфиги» разом). Кроме TTL:
+
+- stale-while-revalidate — в течение stale_ttl после истечения TTL отдаём
+  старое значение сразу и обновляем его в фоне;
+- негативный кэш — загрузчик вернул None (сервер не ответил): negative_ttl
+  секунд отвечаем None без новых попыток.
+
+Загрузчик — корутина без аргументов, None означает неудачу; исключения
+доходят до ожидающих и не кэшируются.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+V = TypeVar("V")
+Loader = Callable[[], Awaitable[Optional[V]]]
+
+
+class AsyncCache(Generic[V]):
+    """TTL-кэш по ключу с single-flight загрузкой"""
+
+    def __init__(self, name: str, ttl: float, stale_ttl: float = 0.0, negative_ttl: float = 0.0):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self._values: Dict[Hashable, Tuple[V, float]] = {}  # ключ → (значение, когда получено)
+        self._misses: Dict[Hashable, float] = {}  # ключ → когда загрузка не удалась
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    def _missed(self, key: Hashable, now: float) -> bool:
+        missed_at = self._misses.get(key)
+        return missed_at is not None and now - missed_at < self.negative_ttl
+
+    async def get(self, key: Hashable, loader: Loader) -> Optional[V]:
+        """Значение из кэша или из загрузчика (одна загрузка на ключ одновременно)"""
+        now = time.monotonic()
+        entry = self._values.get(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = now - stored_at
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.stale_ttl:
+                if not self._missed(key, now):
+                    self.refresh_in_background(key, loader)
+                return value
+        if self._missed(key, now):
+            return None
+        return await self.refresh(key, loader)
+
+    async def refresh(self, key: Hashable, loader: Loader) -> Optional[V]:
+        """Загрузить сейчас, минуя кэш (присоединяется к уже идущей загрузке)"""
+        # shield: отмена одного ожидающего не отменяет загрузку для остальных
+        return await asyncio.shield(self._start(key, loader))
+
+    def refresh_in_background(self, key: Hashable, loader: Loader) -> None:
+        self._start(key, loader)
+
+    def _start(self, key: Hashable, loader: Loader) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Кэш {self.name}: ошибка загрузки {key}: {task.exception()}")
+
+    async def _load(self, key: Hashable, loader: Loader) -> Optional[V]:
+        value = await loader()
+        if value is None:
+            # Прежнее значение не трогаем — его ещё можно отдать как устаревшее
+            self._misses[key] = time.monotonic()
+        else:
+            self.set(key, value)
+        return value
+
+    def set(self, key: Hashable, value: V, age: float = 0.0) -> None:
+        """Положить значение, полученное в обход get (age — сколько секунд ему уже)"""
+        self._values[key] = (value, time.monotonic() - age)
+        self._misses.pop(key, None)
+
+    def peek(self, key: Hashable) -> Optional[V]:
+        """Последнее значение без загрузки, сколько бы ему ни было"""
+        entry = self._values.get(key)
+        return entry[0] if entry is not None else None
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Забыть ключ (или всё); идущая загрузка всё равно запишет свой результат"""
+        if key is None:
+            self._values.clear()
+            self._misses.clear()
+        else:
+            self._values.pop(key, None)
+            self._misses.pop(key, None)
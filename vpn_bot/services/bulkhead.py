@@ -0,0 +1,168 @@
+"""
+Ограничение параллельных SSH операций на каждый сервер (bulkhead).
+
+На один сервер одновременно выполняется не больше MAX_OPS_PER_SERVER операций,
+остальные ждут в очереди по приоритету: действия пользователей раньше
+админского мониторинга, а тот раньше фоновых задач (сбор трафика и т.п.).
+Приоритет берётся из контекста (contextvar), который выставляют
+middleware роутеров или сами фоновые задачи.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_OPS_PER_SERVER = 6
+# Ожидание дольше этого пишем в лог
+SLOW_WAIT_SECONDS = 5
+
+
+class OpPriority(IntEnum):
+    """Приоритет операции: меньше — важнее"""
+    USER = 0
+    ADMIN = 1
+    BACKGROUND = 2
+
+
+# Всё, что не пришло из хендлеров, считаем фоновым
+_current_priority: ContextVar[OpPriority] = ContextVar("ssh_op_priority", default=OpPriority.BACKGROUND)
+
+
+@contextmanager
+def operation_priority(priority: OpPriority):
+    """Выполнить блок с заданным приоритетом SSH операций"""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def current_priority() -> OpPriority:
+    return _current_priority.get()
+
+
+class ServerBulkhead:
+    """Очередь с приоритетами и лимитом параллельных операций для одного сервера"""
+
+    def __init__(self, name: str, limit: int = MAX_OPS_PER_SERVER):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        # (приоритет, порядковый номер, future) — FIFO внутри одного приоритета
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        # Статистика ожидания по приоритетам: [операций, суммарное ожидание, максимум]
+        self._wait_stats: Dict[OpPriority, List[float]] = {p: [0, 0.0, 0.0] for p in OpPriority}
+
+    def _record_wait(self, priority: OpPriority, wait: float) -> None:
+        stats = self._wait_stats[priority]
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+
+    async def acquire(self, priority: OpPriority) -> float:
+        """Занять слот; возвращает время ожидания в секундах"""
+        if self.active < self.limit and not self.queued():
+            self.active += 1
+            self._record_wait(priority, 0.0)
+            return 0.0
+
+        started = time.monotonic()
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (int(priority), next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот успели передать нам — отдаём следующему
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+        wait = time.monotonic() - started
+        self._record_wait(priority, wait)
+        return wait
+
+    def release(self) -> None:
+        """Освободить слот: передаём его первому живому ожидающему"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def queued(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def get_stats(self) -> Dict:
+        """Занятые слоты, глубина очереди и время ожидания по приоритетам"""
+        queued = {p.name.lower(): 0 for p in OpPriority}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                queued[OpPriority(priority).name.lower()] += 1
+
+        wait = {}
+        for priority, (count, total, maximum) in self._wait_stats.items():
+            wait[priority.name.lower()] = {
+                'count': int(count),
+                'avg_ms': int(total / count * 1000) if count else 0,
+                'max_ms': int(maximum * 1000)
+            }
+
+        return {
+            'active': self.active,
+            'limit': self.limit,
+            'queued': queued,
+            'wait': wait
+        }
+
+
+class BulkheadRegistry:
+    """Bulkhead'ы по серверам"""
+
+    def __init__(self):
+        self._bulkheads: Dict[int, ServerBulkhead] = {}
+
+    def _get(self, server) -> ServerBulkhead:
+        bulkhead = self._bulkheads.get(server.id)
+        if bulkhead is None:
+            bulkhead = ServerBulkhead(server.name)
+            self._bulkheads[server.id] = bulkhead
+        return bulkhead
+
+    @asynccontextmanager
+    async def slot(self, server, priority: Optional[OpPriority] = None):
+        """
+        Выполнить операцию с сервером в пределах его лимита.
+        Использование: async with bulkheads.slot(server): ...
+        """
+        bulkhead = self._get(server)
+        priority = current_priority() if priority is None else priority
+        wait = await bulkhead.acquire(priority)
+        if wait > SLOW_WAIT_SECONDS:
+            logger.info(f"SSH очередь {server.name}: {priority.name} ждал {wait:.1f}с")
+        try:
+            yield
+        finally:
+            bulkhead.release()
+
+    def get_server_stats(self, server_id: int) -> Optional[Dict]:
+        bulkhead = self._bulkheads.get(server_id)
+        return bulkhead.get_stats() if bulkhead else None
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Статистика по всем серверам: {имя сервера: stats}"""
+        return {b.name: b.get_stats() for b in self._bulkheads.values()}
+
+
+# Глобальный реестр
+bulkheads = BulkheadRegistry()
@@ -0,0 +1,183 @@
+"""
+Кэш возможностей серверов: какие протоколы установлены, интерфейсы, внешний адрес, порты
+и публичный ключ WireGuard.
+
+Раньше меню выбора протокола проверяло AWG и V2Ray по SSH на каждом сервере
+при каждом открытии. Теперь результат проверки хранится в памяти (TTL)
+и в колонках Server, а устаревшие данные обновляются в фоне.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import select, update
+
+from database import async_session
+from database.models import Server
+from services.async_cache import AsyncCache
+
+logger = logging.getLogger(__name__)
+
+CAPABILITIES_TTL_SECONDS = 600  # После 10 минут данные обновляются в фоне
+
+
+@dataclass
+class ServerCapabilities:
+    """Возможности одного сервера"""
+    wg: bool = False
+    awg: bool = False
+    v2ray: bool = False
+    wg_interface: Optional[str] = None
+    awg_interface: Optional[str] = None
+    endpoint: Optional[str] = None
+    wg_public_key: Optional[str] = None
+    wg_port: Optional[int] = None
+    awg_port: Optional[int] = None
+    v2ray_port: Optional[int] = None
+    checked_at: float = 0.0  # unix-время проверки, 0 — не проверялось
+
+    def supports(self, protocol: str) -> bool:
+        return {"wg": self.wg, "awg": self.awg, "v2ray": self.v2ray}.get(protocol, False)
+
+    def protocols(self) -> List[str]:
+        return [p for p in ("wg", "awg", "v2ray") if self.supports(p)]
+
+    @classmethod
+    def from_server(cls, server: Server) -> Optional["ServerCapabilities"]:
+        """Сохранённые в БД возможности (None — сервер ещё не проверялся)"""
+        checked_at = getattr(server, "capabilities_checked_at", None)
+        if checked_at is None:
+            return None
+        return cls(
+            wg=bool(server.has_wg),
+            awg=bool(server.has_awg),
+            v2ray=bool(server.has_v2ray),
+            wg_interface=server.wg_interface,
+            awg_interface=server.awg_interface,
+            endpoint=server.public_endpoint,
+            wg_public_key=server.wg_public_key,
+            wg_port=server.wg_port,
+            awg_port=server.awg_port,
+            v2ray_port=server.v2ray_port,
+            checked_at=(checked_at - datetime(1970, 1, 1)).total_seconds()
+        )
+
+    def to_columns(self) -> Dict:
+        return {
+            "has_wg": self.wg,
+            "has_awg": self.awg,
+            "has_v2ray": self.v2ray,
+            "awg_interface": self.awg_interface,
+            "public_endpoint": self.endpoint,
+            "wg_public_key": self.wg_public_key,
+            "wg_port": self.wg_port,
+            "awg_port": self.awg_port,
+            "v2ray_port": self.v2ray_port,
+            "capabilities_checked_at": datetime.utcfromtimestamp(self.checked_at)
+        }
+
+
+CAPABILITIES_NEGATIVE_SECONDS = 60  # Столько не проверяем заново сервер, который не ответил
+
+# {server_id: возможности}; устаревшие отдаются сразу и обновляются в фоне,
+# параллельные проверки одного сервера объединяются
+_cache: AsyncCache[ServerCapabilities] = AsyncCache(
+    "capabilities", CAPABILITIES_TTL_SECONDS, float("inf"), CAPABILITIES_NEGATIVE_SECONDS
+)
+# Серверы, чьи сохранённые в БД данные больше не годятся (переустановка, ручная проверка)
+_invalidated: Set[int] = set()
+
+
+class CapabilityService:
+    """Возможности серверов с кэшем в памяти и в БД"""
+
+    @classmethod
+    async def get(cls, server: Server) -> ServerCapabilities:
+        """
+        Вернуть возможности сервера.
+        Свежий кэш — сразу; устаревший — сразу, с фоновым обновлением;
+        если данных нет вовсе — проверяем сервер.
+        """
+        if _cache.peek(server.id) is None and server.id not in _invalidated:
+            caps = ServerCapabilities.from_server(server)
+            if caps is not None:
+                _cache.set(server.id, caps, age=time.time() - caps.checked_at)
+
+        caps = await _cache.get(server.id, lambda: cls._probe_and_store(server))
+        return caps or cls._fallback(server)
+
+    @classmethod
+    def peek(cls, server: Server) -> Optional[ServerCapabilities]:
+        """Возможности без обращения к серверу (None — неизвестно)"""
+        caps = _cache.peek(server.id)
+        if caps is None and server.id not in _invalidated:
+            caps = ServerCapabilities.from_server(server)
+        return caps
+
+    @classmethod
+    def invalidate(cls, server: Server) -> None:
+        """Сбросить кэш сервера — следующий get() проверит его заново"""
+        _cache.invalidate(server.id)
+        _invalidated.add(server.id)
+
+    @classmethod
+    async def refresh(cls, server: Server) -> ServerCapabilities:
+        """Проверить сервер сейчас (параллельные вызовы ждут одну проверку)"""
+        caps = await _cache.refresh(server.id, lambda: cls._probe_and_store(server))
+        return caps or cls._fallback(server)
+
+    @classmethod
+    def refresh_in_background(cls, server: Server) -> None:
+        _cache.refresh_in_background(server.id, lambda: cls._probe_and_store(server))
+
+    @staticmethod
+    def _fallback(server: Server) -> ServerCapabilities:
+        """
+        Сервер не ответил: прежние данные, а если их нет — считаем доступным
+        только WireGuard (в кэш не попадает)
+        """
+        return _cache.peek(server.id) or ServerCapabilities(wg=True, wg_interface=server.wg_interface)
+
+    @classmethod
+    async def _probe_and_store(cls, server: Server) -> Optional[ServerCapabilities]:
+        from services.wireguard_multi import WireGuardMultiService
+
+        caps = await WireGuardMultiService.probe_capabilities(server)
+        if caps is None:
+            return None
+
+        _invalidated.discard(server.id)
+
+        try:
+            async with async_session() as session:
+                await session.execute(
+                    update(Server).where(Server.id == server.id).values(**caps.to_columns())
+                )
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить возможности сервера {server.name}: {e}")
+
+        logger.info(f"Возможности сервера {server.name}: {', '.join(caps.protocols()) or 'нет'}")
+        return caps
+
+    @classmethod
+    async def refresh_all(cls, only_stale: bool = True) -> None:
+        """Обновить возможности всех активных серверов (фоновая задача)"""
+        async with async_session() as session:
+            result = await session.execute(select(Server).where(Server.is_active == True))
+            servers = result.scalars().all()
+
+        now = time.time()
+        targets = []
+        for server in servers:
+            caps = cls.peek(server)
+            if only_stale and caps is not None and now - caps.checked_at < CAPABILITIES_TTL_SECONDS:
+                continue
+            targets.append(server)
+
+        if targets:
+            await asyncio.gather(*(cls.refresh(server) for server in targets), return_exceptions=True)
@@ -0,0 +1,153 @@
+"""
+Circuit breaker для VPN серверов.
+
+Если сервер несколько раз подряд не отвечает по SSH, breaker "размыкается":
+операции с ним сразу завершаются ошибкой, а выбор сервера его пропускает.
+После паузы пропускается одна пробная операция (half-open): успех
+замыкает breaker, неудача снова размыкает его на паузу.
+Состояние общее для SSH операций, выбора сервера и UptimeMonitor.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+FAILURE_THRESHOLD = 3  # Ошибок подряд до размыкания
+COOLDOWN_SECONDS = 60  # Пауза до пробной операции
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Сервер помечен недоступным — операция не выполнялась"""
+
+
+@dataclass
+class CircuitBreaker:
+    """Состояние breaker'а одного сервера"""
+    name: str
+    state: str = STATE_CLOSED
+    failures: int = 0
+    opened_at: float = 0.0
+    probe_in_flight: bool = False
+    last_error: Optional[str] = None
+
+    def _cooldown_passed(self) -> bool:
+        return time.monotonic() - self.opened_at >= COOLDOWN_SECONDS
+
+    def is_available(self) -> bool:
+        """Можно ли выбирать сервер (без захвата пробной операции)"""
+        if self.state == STATE_OPEN:
+            return self._cooldown_passed()
+        if self.state == STATE_HALF_OPEN:
+            return not self.probe_in_flight
+        return True
+
+    def allow_request(self) -> bool:
+        """Разрешить операцию; в half-open пропускается только одна пробная"""
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN:
+            if not self._cooldown_passed():
+                return False
+            self.state = STATE_HALF_OPEN
+        if self.probe_in_flight:
+            return False
+        self.probe_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != STATE_CLOSED:
+            logger.info(f"Сервер {self.name} снова доступен (breaker замкнут)")
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.probe_in_flight = False
+        self.last_error = None
+
+    def record_failure(self, error: str) -> None:
+        self.failures += 1
+        self.last_error = error
+        self.probe_in_flight = False
+        if self.state == STATE_HALF_OPEN or self.failures >= FAILURE_THRESHOLD:
+            self.trip(error)
+
+    def trip(self, error: str) -> None:
+        """Разомкнуть breaker немедленно"""
+        if self.state != STATE_OPEN:
+            logger.warning(f"Сервер {self.name} помечен недоступным на {COOLDOWN_SECONDS}с: {error}")
+        self.state = STATE_OPEN
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+        self.last_error = error
+
+
+class BreakerRegistry:
+    """Breaker'ы по серверам (ключ — server.id)"""
+
+    def __init__(self):
+        self._breakers: Dict[int, CircuitBreaker] = {}
+
+    def get(self, server) -> CircuitBreaker:
+        breaker = self._breakers.get(server.id)
+        if breaker is None:
+            breaker = CircuitBreaker(name=server.name)
+            self._breakers[server.id] = breaker
+        return breaker
+
+    def is_available(self, server) -> bool:
+        breaker = self._breakers.get(server.id)
+        return breaker.is_available() if breaker else True
+
+    def check(self, server) -> None:
+        """Захватить разрешение на операцию или бросить CircuitOpenError"""
+        breaker = self.get(server)
+        if not breaker.allow_request():
+            raise CircuitOpenError(f"Сервер {server.name} временно недоступен")
+
+    def record_success(self, server) -> None:
+        self.get(server).record_success()
+
+    def record_failure(self, server, error: str) -> None:
+        self.get(server).record_failure(error)
+
+    def release_probe(self, server) -> None:
+        """Операция завершилась без вердикта о доступности — отпускаем пробу"""
+        breaker = self._breakers.get(server.id)
+        if breaker:
+            breaker.probe_in_flight = False
+
+    def report_ping(self, server, is_up: bool, error: Optional[str] = None) -> None:
+        """
+        Результат внешней проверки (UptimeMonitor).
+        Ping может быть закрыт файрволом, поэтому его падение размыкает breaker
+        только если уже были ошибки SSH. Ответ на ping после размыкания
+        разрешает пробную SSH операцию, не дожидаясь конца паузы.
+        """
+        breaker = self.get(server)
+        if not is_up:
+            if breaker.failures > 0:
+                breaker.trip(error or "ping не проходит")
+        elif breaker.state == STATE_OPEN:
+            breaker.state = STATE_HALF_OPEN
+            breaker.probe_in_flight = False
+
+    def get_state(self, server_id: int) -> str:
+        breaker = self._breakers.get(server_id)
+        return breaker.state if breaker else STATE_CLOSED
+
+    def get_open(self) -> List[str]:
+        """Имена серверов с разомкнутым breaker'ом"""
+        return [b.name for b in self._breakers.values() if b.state != STATE_CLOSED]
+
+    def forget(self, server) -> None:
+        """Сбросить состояние (сервер удалён или переустановлен)"""
+        self._breakers.pop(server.id, None)
+
+
+# Глобальный реестр
+breakers = BreakerRegistry()
@@ -0,0 +1,91 @@
+"""
+Сбор счётчиков трафика со всех протоколов сервера.
+
+Каждый коллектор знает команду, которая выводит его счётчики, и как её
+разобрать. WireGuardMultiService.collect_counters склеивает команды всех
+коллекторов в один SSH запрос (по секции на протокол) и сливает ответы
+в общую ленту {ключ: {'received', 'sent'}}:
+
+- wg, awg — `show <iface> dump`, ключ — public_key пира;
+- v2ray — счётчики клиентов Xray по email (имя пира конфига).
+
+Счётчики накопительные и обнуляются при перезапуске интерфейса или Xray —
+это ловит обычная проверка «счётчик меньше прошлого» при накоплении.
+"""
+
+import shlex
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+from database.models import Config, Server
+from services.wg_dump import PeerTable, parse_wg_dump
+
+
+class TrafficCollector(ABC):
+    """Источник счётчиков трафика одного протокола"""
+    protocol = "base"
+
+    @abstractmethod
+    def command(self, server: Server) -> str:
+        ...
+
+    @abstractmethod
+    def parse(self, server: Server, output: str) -> Dict[str, Dict[str, int]]:
+        ...
+
+
+class WgDumpCollector(TrafficCollector):
+    protocol = "wg"
+
+    def command(self, server: Server) -> str:
+        return f"wg show {shlex.quote(server.wg_interface)} dump"
+
+    def table(self, server: Server, output: str) -> PeerTable:
+        return PeerTable(server.id, parse_wg_dump(output))
+
+    def parse(self, server: Server, output: str) -> Dict[str, Dict[str, int]]:
+        return self.table(server, output).traffic()
+
+
+class AwgDumpCollector(WgDumpCollector):
+    protocol = "awg"
+
+    def command(self, server: Server) -> str:
+        interface = shlex.quote(server.awg_interface or "awg0")
+        return f"awg show {interface} dump || wg show {interface} dump"
+
+
+class XrayStatsCollector(TrafficCollector):
+    """
+    Счётчики клиентов Xray по email. Статистику Xray (statsquery -reset)
+    каждые несколько секунд забирает X-UI и копит в client_traffics —
+    читаем накопленное, а не сам API, чтобы не отнимать трафик у панели.
+    """
+    protocol = "v2ray"
+
+    def command(self, server: Server) -> str:
+        from services.wireguard_multi import XUI_DB
+        return f"sqlite3 -separator ' ' {XUI_DB} \"SELECT email, up, down FROM client_traffics\""
+
+    def parse(self, server: Server, output: str) -> Dict[str, Dict[str, int]]:
+        counters = {}
+        for line in output.splitlines():
+            try:
+                email, up, down = line.rsplit(" ", 2)
+                # up — от клиента к серверу, как transfer-rx у WireGuard
+                counters[email] = {'received': int(up), 'sent': int(down)}
+            except ValueError:
+                continue
+        return counters
+
+
+COLLECTORS: List[TrafficCollector] = [WgDumpCollector(), AwgDumpCollector(), XrayStatsCollector()]
+
+
+def feed_key(config: Config) -> Optional[str]:
+    """Ключ конфига в ленте счётчиков (None — конфигу нечего искать)"""
+    if config.protocol_type == "v2ray":
+        return config.remote_name
+    if not config.public_key or config.public_key == "UNKNOWN":
+        return None
+    return config.public_key
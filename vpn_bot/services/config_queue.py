@@ -3,22 +3,41 @@
 Управляет очередью пользователей, ожидающих конфиги когда все серверы заполнены
 """
 
+import asyncio
 import logging
 from datetime import datetime
-from typing import Optional, List, Tuple
-from sqlalchemy import select, func
+from typing import Dict, Optional, List, Tuple
+from sqlalchemy import select, update, func
 from sqlalchemy.orm import selectinload
 
-from database import async_session, ConfigQueue, User, Server, Config
+from database import async_session, ConfigQueue, User, Server
 from database.models import ConfigQueue
 from config import ADMIN_ID
 
 logger = logging.getLogger(__name__)
 
 
+# Сводка очереди в памяти: меняется при постановке и выборке, чтобы не
+# пересчитывать очередь на каждый запрос. None — не загружена (или сброшена).
+_waiting_count: Optional[int] = None
+
+
 class ConfigQueueService:
     """Сервис управления очередью конфигов"""
     
+    @staticmethod
+    def track_waiting(delta: int) -> None:
+        """Учесть в сводке заданий, попавших в очередь ожидания (+) или ушедших из неё (-)"""
+        global _waiting_count
+        if _waiting_count is not None:
+            _waiting_count = max(_waiting_count + delta, 0)
+    
+    @staticmethod
+    def invalidate_summary() -> None:
+        """Сбросить сводку (очередь менялась в обход сервиса) — пересчитается при чтении"""
+        global _waiting_count
+        _waiting_count = None
+    
     @classmethod
     async def add_to_queue(cls, user_id: int, config_name: str) -> ConfigQueue:
         """Добавить пользователя в очередь ожидания"""
@@ -31,28 +50,35 @@ class ConfigQueueService:
             session.add(queue_item)
             await session.commit()
             await session.refresh(queue_item)
+            cls.track_waiting(1)
             logger.info(f"Пользователь {user_id} добавлен в очередь (конфиг: {config_name})")
             return queue_item
     
     @classmethod
     async def get_waiting_count(cls) -> int:
-        """Получить количество ожидающих в очереди"""
-        async with async_session() as session:
-            result = await session.execute(
-                select(func.count(ConfigQueue.id)).where(ConfigQueue.status == "waiting")
-            )
-            return result.scalar() or 0
+        """Получить количество ожидающих в очереди (из сводки в памяти)"""
+        global _waiting_count
+        if _waiting_count is None:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(func.count(ConfigQueue.id)).where(ConfigQueue.status == "waiting")
+                )
+                _waiting_count = result.scalar() or 0
+        return _waiting_count
     
     @classmethod
-    async def get_waiting_queue(cls) -> List[ConfigQueue]:
-        """Получить всех ожидающих в очереди"""
+    async def get_waiting_queue(cls, limit: Optional[int] = None) -> List[ConfigQueue]:
+        """Получить ожидающих в очереди (первые limit, если указан)"""
         async with async_session() as session:
-            result = await session.execute(
+            stmt = (
                 select(ConfigQueue)
                 .where(ConfigQueue.status == "waiting")
                 .options(selectinload(ConfigQueue.user))
                 .order_by(ConfigQueue.created_at.asc())
             )
+            if limit is not None:
+                stmt = stmt.limit(limit)
+            result = await session.execute(stmt)
             return list(result.scalars().all())
     
     @classmethod
@@ -60,125 +86,182 @@ class ConfigQueueService:
         """Проверить, есть ли пользователь уже в очереди"""
         async with async_session() as session:
             result = await session.execute(
-                select(ConfigQueue).where(
+                select(ConfigQueue.id).where(
                     ConfigQueue.user_id == user_id,
                     ConfigQueue.status == "waiting"
-                )
+                ).limit(1)
             )
             return result.scalar_one_or_none() is not None
     
     @classmethod
     async def get_user_queue_position(cls, user_id: int) -> Optional[int]:
-        """Получить позицию пользователя в очереди"""
+        """Получить позицию пользователя в очереди (по индексу status, created_at)"""
         async with async_session() as session:
-            # Получаем все ожидающие записи в порядке создания
-            result = await session.execute(
-                select(ConfigQueue)
-                .where(ConfigQueue.status == "waiting")
-                .order_by(ConfigQueue.created_at.asc())
-            )
-            queue = result.scalars().all()
+            mine = (await session.execute(
+                select(ConfigQueue.id, ConfigQueue.created_at)
+                .where(ConfigQueue.user_id == user_id, ConfigQueue.status == "waiting")
+                .order_by(ConfigQueue.created_at.asc(), ConfigQueue.id.asc())
+                .limit(1)
+            )).first()
+            if mine is None:
+                return None
             
-            for i, item in enumerate(queue, 1):
-                if item.user_id == user_id:
-                    return i
+            ahead = (await session.execute(
+                select(func.count(ConfigQueue.id)).where(
+                    ConfigQueue.status == "waiting",
+                    (ConfigQueue.created_at < mine.created_at)
+                    | ((ConfigQueue.created_at == mine.created_at) & (ConfigQueue.id < mine.id))
+                )
+            )).scalar() or 0
+            return ahead + 1
+    
+    @staticmethod
+    async def _plan(
+        capacity: List[Tuple[Server, int, int]],
+        items: List[ConfigQueue]
+    ) -> List[Tuple[ConfigQueue, Server, str]]:
+        """
+        Распределить ожидающих по свободным местам серверов (capacity из
+        get_free_capacity) за один проход: каждый следующий в очереди получает
+        сервер с наибольшим приоритетом и лучшей оценкой PlacementEngine с учётом
+        уже распределённых. Возвращает [(задание, сервер, протокол)].
+        """
+        from services.wireguard_multi import WireGuardMultiService
+        from services.placement import PlacementEngine
+        
+        # [сервер, клиентов с учётом плана, свободно]
+        slots = [list(row) for row in capacity]
+        supported: Dict[Tuple[int, str], bool] = {}
+        
+        async def supports(server: Server, protocol: str) -> bool:
+            key = (server.id, protocol)
+            if key not in supported:
+                if protocol == "awg":
+                    supported[key] = await WireGuardMultiService.check_awg_available(server)
+                elif protocol == "v2ray":
+                    supported[key] = await WireGuardMultiService.check_v2ray_available(server)
+                else:
+                    supported[key] = True
+            return supported[key]
+        
+        plan = []
+        for item in items:
+            candidates = sorted(
+                (slot for slot in slots if slot[2] > 0),
+                key=lambda slot: (
+                    -(slot[0].priority or 0),
+                    -(PlacementEngine.score(slot[0], slot[1]) or 0.0)
+                )
+            )
+            if not candidates:
+                break
+            for slot in candidates:
+                server = slot[0]
+                if item.server_id and server.id != item.server_id:
+                    continue
+                if item.protocol_type and not await supports(server, item.protocol_type):
+                    continue
+                protocol = item.protocol_type or ("awg" if await supports(server, "awg") else "wg")
+                slot[1] += 1
+                slot[2] -= 1
+                plan.append((item, server, protocol))
+                break
+        return plan
+    
+    @classmethod
+    async def _provision_planned(cls, bot, item: ConfigQueue, server: Server, protocol: str) -> Optional[bool]:
+        """Создать конфиг по плану; None — задание уже забрали"""
+        from services.provisioning import ProvisioningService
+        
+        async with async_session() as session:
+            # Помечаем как обрабатываемый (если его не забрали параллельно)
+            claimed = await session.execute(
+                update(ConfigQueue)
+                .where(ConfigQueue.id == item.id, ConfigQueue.status == "waiting")
+                .values(status="processing", locked_at=datetime.utcnow())
+            )
+            await session.commit()
+        if claimed.rowcount != 1:
             return None
+        cls.track_waiting(-1)
+        
+        try:
+            # Выдаём заготовку из пула или создаём конфиг на сервере
+            # (одновременных созданий на сервер — не больше provision_per_server)
+            success, config_data, msg = await ProvisioningService.provision(item, server, protocol)
+        except Exception as e:
+            success, config_data, msg = False, None, str(e)
+        
+        if not success:
+            # Ошибка создания - возвращаем в очередь
+            async with async_session() as session:
+                await session.execute(
+                    update(ConfigQueue)
+                    .where(ConfigQueue.id == item.id)
+                    .values(status="waiting", locked_at=None, last_error=msg)
+                )
+                await session.commit()
+            cls.track_waiting(1)
+            logger.error(f"Ошибка создания конфига из очереди: {msg}")
+            return False
+        
+        user = item.user
+        job_bot = ProvisioningService.bot_for(item, bot)
+        if user and user.telegram_id:
+            try:
+                await job_bot.send_message(
+                    user.telegram_id,
+                    f"🎉 *Отличные новости!*\n\n"
+                    f"Твой конфиг *{item.config_name}* готов!\n"
+                    f"Мы добавили новый сервер и теперь можем тебя подключить.",
+                    parse_mode="Markdown"
+                )
+            except Exception as e:
+                logger.error(f"Ошибка отправки конфига пользователю: {e}")
+        # Конфиг отправляет обработчик задания
+        await ProvisioningService.notify(job_bot, item, config_data, None)
+        logger.info(f"Конфиг из очереди выдан пользователю {user.telegram_id if user else item.user_id} ({server.name})")
+        return True
     
     @classmethod
-    async def process_queue(cls, bot, max_to_process: int = 10) -> Tuple[int, int]:
+    async def process_queue(cls, bot, max_to_process: Optional[int] = None) -> Tuple[int, int]:
         """
-        Обработать очередь - создать конфиги для ожидающих если есть свободные места
+        Обработать очередь - создать конфиги для ожидающих если есть свободные места.
+        Сначала весь пакет распределяется по серверам, затем конфиги создаются
+        параллельно. max_to_process None — сколько позволяют свободные места.
         Возвращает (успешно_обработано, ошибок)
         """
         from services.wireguard_multi import WireGuardMultiService
-        from handlers.user import send_config_file
-        
-        processed = 0
-        errors = 0
         
         async with async_session() as session:
-            # Получаем ожидающих в порядке очереди
+            capacity = await WireGuardMultiService.get_free_capacity(session)
+            free_total = sum(free for _, _, free in capacity)
+            if free_total == 0:
+                logger.info("Нет свободных серверов для обработки очереди")
+                return 0, 0
+            
+            # Берём с запасом: часть ожидающих может не подойти по протоколу
+            limit = max_to_process or free_total * 2
             result = await session.execute(
                 select(ConfigQueue)
                 .where(ConfigQueue.status == "waiting")
                 .options(selectinload(ConfigQueue.user))
                 .order_by(ConfigQueue.created_at.asc())
-                .limit(max_to_process)
+                .limit(limit)
             )
-            queue_items = result.scalars().all()
-            
-            for item in queue_items:
-                # Проверяем есть ли свободный сервер
-                server = await WireGuardMultiService.get_best_server(session)
-                if not server:
-                    logger.info("Нет свободных серверов для обработки очереди")
-                    break
-                
-                try:
-                    # Помечаем как обрабатываемый
-                    item.status = "processing"
-                    await session.commit()
-                    
-                    # Создаём конфиг
-                    success, config_data, msg = await WireGuardMultiService.create_config(
-                        item.config_name, session
-                    )
-                    
-                    if success and config_data:
-                        # Сохраняем конфиг в БД
-                        config = Config(
-                            user_id=item.user_id,
-                            server_id=config_data.server_id,
-                            name=item.config_name,
-                            public_key=config_data.public_key,
-                            preshared_key=config_data.preshared_key,
-                            allowed_ips=config_data.allowed_ips,
-                            client_ip=config_data.client_ip,
-                            is_active=True
-                        )
-                        session.add(config)
-                        
-                        # Помечаем как выполненный
-                        item.status = "completed"
-                        item.processed_at = datetime.utcnow()
-                        await session.commit()
-                        
-                        # Отправляем конфиг пользователю
-                        user = item.user
-                        if user and user.telegram_id:
-                            try:
-                                from keyboards.user_kb import get_main_menu_kb
-                                await bot.send_message(
-                                    user.telegram_id,
-                                    f"🎉 *Отличные новости!*\n\n"
-                                    f"Твой конфиг *{item.config_name}* готов!\n"
-                                    f"Мы добавили новый сервер и теперь можем тебя подключить.",
-                                    parse_mode="Markdown"
-                                )
-                                await send_config_file(
-                                    bot, user.telegram_id, item.config_name, 
-                                    config_data, config_data.server_id,
-                                    caption="📄 Твой WireGuard конфиг",
-                                    reply_markup=get_main_menu_kb(user.telegram_id, True, True)
-                                )
-                                processed += 1
-                                logger.info(f"Конфиг из очереди выдан пользователю {user.telegram_id}")
-                            except Exception as e:
-                                logger.error(f"Ошибка отправки конфига пользователю: {e}")
-                                processed += 1  # Конфиг создан, просто не отправлен
-                    else:
-                        # Ошибка создания - возвращаем в очередь
-                        item.status = "waiting"
-                        await session.commit()
-                        errors += 1
-                        logger.error(f"Ошибка создания конфига из очереди: {msg}")
-                        
-                except Exception as e:
-                    item.status = "waiting"
-                    await session.commit()
-                    errors += 1
-                    logger.error(f"Ошибка обработки очереди: {e}")
+            queue_items = list(result.scalars().all())
+        plan = await cls._plan(capacity, queue_items)
+        
+        if not plan:
+            return 0, 0
+        logger.info(f"Очередь: распределено {len(plan)} из {len(queue_items)} ожидающих")
         
+        results = await asyncio.gather(*(
+            cls._provision_planned(bot, item, server, protocol)
+            for item, server, protocol in plan
+        ))
+        processed = sum(1 for r in results if r is True)
+        errors = sum(1 for r in results if r is False)
         return processed, errors
     
     @classmethod
@@ -186,17 +269,16 @@ class ConfigQueueService:
         """Отменить ожидание пользователя в очереди"""
         async with async_session() as session:
             result = await session.execute(
-                select(ConfigQueue).where(
+                update(ConfigQueue)
+                .where(
                     ConfigQueue.user_id == user_id,
                     ConfigQueue.status == "waiting"
                 )
+                .values(status="cancelled")
             )
-            item = result.scalar_one_or_none()
-            if item:
-                item.status = "cancelled"
-                await session.commit()
-                return True
-            return False
+            await session.commit()
+            cls.track_waiting(-result.rowcount)
+            return result.rowcount > 0
     
     @classmethod
     async def notify_admin_no_servers(cls, bot, user_telegram_id: int, username: str = None):
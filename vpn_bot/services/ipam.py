@@ -0,0 +1,313 @@
+"""
+Центральный учёт клиентских адресов (IPAM).
+
+Раньше скрипт создания клиента сам выбирал адрес: искал в wg0.conf
+максимальный 10.x.x.N и брал следующий. Это полный проход по конфигу,
+гонка при параллельном создании, освобождённые адреса не переиспользуются,
+а подсеть ограничена одной /24.
+
+Теперь адрес выдаёт бот: у каждого интерфейса сервера (wg, awg) есть пул —
+подсеть из Address интерфейса (любой длины префикса). Освобождённые адреса
+попадают в free-list и выдаются первыми, новые берутся по счётчику
+next_offset. Захват адреса — условный UPDATE, поэтому параллельные
+создания не получают один адрес. Адрес передаётся скрипту вторым аргументом.
+"""
+
+import asyncio
+import ipaddress
+import logging
+from datetime import datetime
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_session, Server, Config, PooledPeer, IpPool, IpAllocation
+from config import LOCAL_MODE
+
+logger = logging.getLogger(__name__)
+
+IPAM_PROTOCOLS = ("wg", "awg")
+
+# Создание пула сервера — одно на процесс {(server_id, protocol): lock}
+_pool_locks: Dict[Tuple[int, str], asyncio.Lock] = {}
+
+
+class IpLease(NamedTuple):
+    """Выданный адрес клиента"""
+    address: str
+    prefix: int
+
+    @property
+    def cidr(self) -> str:
+        return f"{self.address}/{self.prefix}"
+
+
+class IpamService:
+    """Выдача и освобождение клиентских адресов серверов"""
+
+    @staticmethod
+    async def _find_pool(session: AsyncSession, server_id: int, protocol: str) -> Optional[IpPool]:
+        result = await session.execute(
+            select(IpPool).where(IpPool.server_id == server_id, IpPool.protocol_type == protocol)
+        )
+        return result.scalar_one_or_none()
+
+    @staticmethod
+    async def _db_addresses(session: AsyncSession, server_id: int, protocol: str) -> Set[str]:
+        """Адреса, которые уже записаны за конфигами и заготовками сервера"""
+        config_protocol = Config.protocol_type == protocol
+        if protocol == "wg":
+            config_protocol = config_protocol | Config.protocol_type.is_(None)
+        configs = await session.execute(
+            select(Config.client_ip).where(Config.server_id == server_id, config_protocol)
+        )
+        pooled = await session.execute(
+            select(PooledPeer.client_ip).where(
+                PooledPeer.server_id == server_id, PooledPeer.protocol_type == protocol
+            )
+        )
+        return {ip for ip in list(configs.scalars()) + list(pooled.scalars()) if ip}
+
+    @classmethod
+    async def get_pool(cls, server: Server, protocol: str) -> Optional[IpPool]:
+        """
+        Пул адресов интерфейса. При первом обращении читает подсеть и занятые
+        адреса с сервера (и из БД), промежутки между занятыми сразу идут в free-list.
+        None — пул создать не удалось (сервер не ответил, нет Address).
+        """
+        async with async_session() as session:
+            pool = await cls._find_pool(session, server.id, protocol)
+        if pool is not None:
+            return pool
+
+        lock = _pool_locks.setdefault((server.id, protocol), asyncio.Lock())
+        async with lock:
+            async with async_session() as session:
+                pool = await cls._find_pool(session, server.id, protocol)
+                if pool is not None:
+                    return pool
+
+                from services.wireguard_multi import WireGuardMultiService
+                plan = await WireGuardMultiService.read_address_plan(server, protocol)
+                if plan is None:
+                    return None
+                interface_address, used = plan
+
+                interface = ipaddress.ip_interface(interface_address)
+                network = interface.network
+                base = int(network.network_address)
+                taken: Set[int] = {int(interface.ip) - base}
+                for ip in set(used) | await cls._db_addresses(session, server.id, protocol):
+                    try:
+                        address = ipaddress.ip_address(ip)
+                    except ValueError:
+                        continue
+                    if address in network:
+                        taken.add(int(address) - base)
+                taken.discard(0)
+
+                next_offset = max(taken) + 1 if taken else 1
+                pool = IpPool(
+                    server_id=server.id,
+                    protocol_type=protocol,
+                    subnet=str(network),
+                    next_offset=next_offset
+                )
+                session.add(pool)
+                try:
+                    await session.flush()
+                    for offset in range(1, next_offset):
+                        session.add(IpAllocation(
+                            pool_id=pool.id,
+                            host_offset=offset,
+                            address=str(ipaddress.ip_address(base + offset)),
+                            is_free=offset not in taken
+                        ))
+                    await session.commit()
+                except IntegrityError:
+                    # Пул успел создать другой процесс
+                    await session.rollback()
+                    return await cls._find_pool(session, server.id, protocol)
+
+                logger.info(
+                    f"IPAM: пул {protocol} сервера {server.name} — {network}, "
+                    f"занято {len(taken)}, свободно {network.num_addresses - 2 - len(taken)}"
+                )
+                return pool
+
+    @classmethod
+    async def allocate(cls, server: Server, protocol: str, peer_name: str) -> Optional[IpLease]:
+        """
+        Выдать адрес клиенту: сначала из free-list, затем следующий новый.
+        None — IPAM недоступен или подсеть закончилась (скрипт выберет адрес сам).
+        """
+        if LOCAL_MODE or protocol not in IPAM_PROTOCOLS:
+            return None
+
+        pool = await cls.get_pool(server, protocol)
+        if pool is None:
+            return None
+        network = ipaddress.ip_network(pool.subnet)
+        now = datetime.utcnow()
+
+        async with async_session() as session:
+            # Освобождённые адреса — меньшие первыми
+            while True:
+                free = (await session.execute(
+                    select(IpAllocation)
+                    .where(IpAllocation.pool_id == pool.id, IpAllocation.is_free == True)
+                    .order_by(IpAllocation.host_offset.asc())
+                    .limit(1)
+                )).scalar_one_or_none()
+                if free is None:
+                    break
+                claimed = await session.execute(
+                    update(IpAllocation)
+                    .where(IpAllocation.id == free.id, IpAllocation.is_free == True)
+                    .values(is_free=False, peer_name=peer_name, allocated_at=now)
+                )
+                await session.commit()
+                if claimed.rowcount == 1:
+                    return IpLease(free.address, network.prefixlen)
+
+            # Новые адреса — по счётчику
+            while True:
+                offset = (await session.execute(
+                    select(IpPool.next_offset).where(IpPool.id == pool.id)
+                )).scalar()
+                if offset >= network.num_addresses - 1:
+                    logger.warning(f"IPAM: подсеть {network} сервера {server.name} ({protocol}) заполнена")
+                    return None
+
+                bumped = await session.execute(
+                    update(IpPool)
+                    .where(IpPool.id == pool.id, IpPool.next_offset == offset)
+                    .values(next_offset=offset + 1)
+                )
+                await session.commit()
+                if bumped.rowcount != 1:
+                    continue
+
+                address = str(network.network_address + offset)
+                session.add(IpAllocation(
+                    pool_id=pool.id,
+                    host_offset=offset,
+                    address=address,
+                    peer_name=peer_name,
+                    allocated_at=now
+                ))
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    # Адрес уже отмечен занятым (record) — берём следующий
+                    await session.rollback()
+                    continue
+                return IpLease(address, network.prefixlen)
+
+    @classmethod
+    async def record(cls, server: Server, protocol: str, address: str, peer_name: str) -> None:
+        """Отметить занятым адрес, выбранный без IPAM (старый скрипт на сервере)"""
+        if LOCAL_MODE or protocol not in IPAM_PROTOCOLS:
+            return
+
+        pool = await cls.get_pool(server, protocol)
+        if pool is None:
+            return
+        network = ipaddress.ip_network(pool.subnet)
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return
+        if ip not in network:
+            return
+        offset = int(ip) - int(network.network_address)
+
+        async with async_session() as session:
+            existing = (await session.execute(
+                select(IpAllocation).where(IpAllocation.pool_id == pool.id, IpAllocation.host_offset == offset)
+            )).scalar_one_or_none()
+            if existing is not None:
+                existing.is_free = False
+                existing.peer_name = peer_name
+                existing.allocated_at = datetime.utcnow()
+            else:
+                session.add(IpAllocation(
+                    pool_id=pool.id,
+                    host_offset=offset,
+                    address=str(ip),
+                    peer_name=peer_name,
+                    allocated_at=datetime.utcnow()
+                ))
+                await session.execute(
+                    update(IpPool)
+                    .where(IpPool.id == pool.id, IpPool.next_offset <= offset)
+                    .values(next_offset=offset + 1)
+                )
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+
+    @classmethod
+    async def confirm(
+        cls,
+        server: Server,
+        protocol: str,
+        peer_name: str,
+        lease: Optional[IpLease],
+        actual_address: str
+    ) -> None:
+        """
+        Сверить выданный адрес с тем, что реально получил пир.
+        Если скрипт на сервере ещё старый и выбрал адрес сам — учитываем его.
+        """
+        if lease is not None and lease.address == actual_address:
+            return
+        if lease is not None:
+            logger.warning(
+                f"IPAM: {peer_name} на {server.name} получил {actual_address} вместо {lease.address} "
+                f"(скрипт не поддерживает выдачу адреса ботом?)"
+            )
+            await cls.release(server, peer_name)
+        await cls.record(server, protocol, actual_address, peer_name)
+
+    @classmethod
+    async def release(cls, server: Server, peer_name: str) -> None:
+        """Вернуть адреса пира в free-list"""
+        if LOCAL_MODE:
+            return
+        async with async_session() as session:
+            await session.execute(
+                update(IpAllocation)
+                .where(
+                    IpAllocation.peer_name == peer_name,
+                    IpAllocation.pool_id.in_(select(IpPool.id).where(IpPool.server_id == server.id))
+                )
+                .values(is_free=True, peer_name=None, allocated_at=None)
+            )
+            await session.commit()
+
+    @staticmethod
+    async def discard_server(session: AsyncSession, server_id: int) -> None:
+        """Забыть пулы сервера (сервер удаляется)"""
+        pool_ids = select(IpPool.id).where(IpPool.server_id == server_id)
+        await session.execute(delete(IpAllocation).where(IpAllocation.pool_id.in_(pool_ids)))
+        await session.execute(delete(IpPool).where(IpPool.server_id == server_id))
+
+    @staticmethod
+    async def get_usage(server_id: int) -> Dict[str, Tuple[int, int]]:
+        """Заполненность пулов сервера: {протокол: (занято, всего адресов)}"""
+        async with async_session() as session:
+            pools = (await session.execute(select(IpPool).where(IpPool.server_id == server_id))).scalars().all()
+            usage = {}
+            for pool in pools:
+                used = (await session.execute(
+                    select(func.count(IpAllocation.id))
+                    .where(IpAllocation.pool_id == pool.id, IpAllocation.is_free == False)
+                )).scalar() or 0
+                # Без адреса сети и широковещательного; адрес сервера считается занятым
+                capacity = ipaddress.ip_network(pool.subnet).num_addresses - 2
+                usage[pool.protocol_type] = (used, capacity)
+            return usage
@@ -0,0 +1,139 @@
+"""
+Кэш file_id Telegram для отправляемых файлов.
+
+Конфиги, QR-коды и картинки инструкции раньше загружались в Telegram
+заново при каждой отправке (конфиг ещё и через временный файл).
+Теперь после первой загрузки file_id запоминается по sha256 содержимого
+(в памяти и в таблице media_cache, отдельно для каждого бота), и повторная
+отправка идёт по file_id без загрузки. Первая загрузка — из памяти.
+"""
+
+import hashlib
+import logging
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, FSInputFile, InputFile, Message
+from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError
+
+from database import async_session, MediaFile
+
+logger = logging.getLogger(__name__)
+
+SEND_METHODS = {
+    "document": "send_document",
+    "photo": "send_photo",
+    "animation": "send_animation",
+}
+
+# {(bot_id, sha256): file_id}
+_file_ids: Dict[Tuple[int, str], str] = {}
+# Хэши файлов с диска {(путь, размер, mtime): sha256} — чтобы не читать файл каждый раз
+_path_digests: Dict[Tuple[str, int, int], str] = {}
+
+
+class MediaCache:
+    """Отправка файлов с повторным использованием file_id"""
+
+    @staticmethod
+    def _extract_file_id(message: Message, kind: str) -> Optional[str]:
+        if kind == "photo":
+            return message.photo[-1].file_id if message.photo else None
+        media = getattr(message, kind, None)
+        return media.file_id if media else None
+
+    @classmethod
+    async def _lookup(cls, bot_id: int, digest: str) -> Optional[str]:
+        file_id = _file_ids.get((bot_id, digest))
+        if file_id is not None:
+            return file_id
+
+        async with async_session() as session:
+            file_id = (await session.execute(
+                select(MediaFile.file_id)
+                .where(MediaFile.bot_id == bot_id, MediaFile.content_hash == digest)
+            )).scalar_one_or_none()
+        if file_id is not None:
+            _file_ids[(bot_id, digest)] = file_id
+        return file_id
+
+    @classmethod
+    async def _store(cls, bot_id: int, digest: str, kind: str, file_id: str) -> None:
+        _file_ids[(bot_id, digest)] = file_id
+        async with async_session() as session:
+            session.add(MediaFile(bot_id=bot_id, content_hash=digest, kind=kind, file_id=file_id))
+            try:
+                await session.commit()
+            except IntegrityError:
+                # Параллельная отправка того же файла уже записала file_id
+                await session.rollback()
+
+    @classmethod
+    async def _forget(cls, bot_id: int, digest: str) -> None:
+        _file_ids.pop((bot_id, digest), None)
+        async with async_session() as session:
+            await session.execute(
+                delete(MediaFile).where(MediaFile.bot_id == bot_id, MediaFile.content_hash == digest)
+            )
+            await session.commit()
+
+    @classmethod
+    async def _send(
+        cls,
+        bot: Bot,
+        kind: str,
+        chat_id: int,
+        digest: str,
+        make_input: Callable[[], InputFile],
+        **kwargs
+    ) -> Message:
+        send = getattr(bot, SEND_METHODS[kind])
+
+        file_id = await cls._lookup(bot.id, digest)
+        if file_id is not None:
+            try:
+                return await send(chat_id, file_id, **kwargs)
+            except TelegramBadRequest as e:
+                # file_id устарел или от другого бота — загружаем заново
+                logger.warning(f"file_id для {kind} не принят Telegram, загружаем заново: {e}")
+                await cls._forget(bot.id, digest)
+
+        message = await send(chat_id, make_input(), **kwargs)
+        file_id = cls._extract_file_id(message, kind)
+        if file_id:
+            await cls._store(bot.id, digest, kind, file_id)
+        return message
+
+    @classmethod
+    async def send_bytes(
+        cls,
+        bot: Bot,
+        kind: str,
+        chat_id: int,
+        content: bytes,
+        filename: str,
+        **kwargs
+    ) -> Message:
+        """Отправить содержимое из памяти (kind: document, photo, animation)"""
+        # Имя файла — часть документа в Telegram, поэтому входит в ключ
+        digest = hashlib.sha256(f"{kind}:{filename}:".encode("utf-8") + content).hexdigest()
+        return await cls._send(
+            bot, kind, chat_id, digest,
+            lambda: BufferedInputFile(content, filename=filename),
+            **kwargs
+        )
+
+    @classmethod
+    async def send_path(cls, bot: Bot, kind: str, chat_id: int, path: str, **kwargs) -> Message:
+        """Отправить файл с диска (картинки инструкции и т.п.)"""
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        digest = _path_digests.get(key)
+        if digest is None:
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f"{kind}:".encode("utf-8") + f.read()).hexdigest()
+            _path_digests[key] = digest
+        return await cls._send(bot, kind, chat_id, digest, lambda: FSInputFile(path), **kwargs)
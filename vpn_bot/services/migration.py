@@ -0,0 +1,539 @@
+"""
+Перенос клиентов с сервера на сервер.
+
+Раньше перенос шёл по одному конфигу: отдельный select на каждый конфиг,
+удаление и создание по очереди, commit и сообщения в Telegram на каждом шаге;
+сервер на 200 клиентов переносился около часа, а падение бота обрывало перенос.
+
+Теперь план (migrations + migration_items) сохраняется в БД до начала работы,
+и у каждого конфига своё состояние:
+pending → issued (пир создан на новом сервере) → moved (запись в БД обновлена)
+→ done (старый пир удалён с исходного сервера); notified — клиент получил
+новый конфиг. Перенос идёт пачками: в пачке конфиги создаются параллельно
+(не больше MIGRATION_TARGET_PARALLEL на целевом сервере, удаление — не больше
+MIGRATION_SOURCE_PARALLEL на исходном), результаты пачки записываются одним
+commit, уведомления идут через очередь с ограничением скорости.
+Незавершённые переносы продолжаются после перезапуска (resume_all); пиры,
+созданные до падения, но не записанные в конфиг (issued), удаляются с целевого
+сервера, и конфиг переносится заново.
+
+Новый пир создаётся раньше, чем удаляется старый, — клиент не остаётся без конфига.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import select, update, func
+from sqlalchemy.orm import selectinload
+
+from database import async_session, Config, Server, Migration, MigrationItem
+from services.notifier import notifier
+from config import LOCAL_MODE
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH = 25
+MIGRATION_TARGET_PARALLEL = 5
+MIGRATION_SOURCE_PARALLEL = 5
+
+# Идущие переносы {migration_id: task}
+_running: Dict[int, asyncio.Task] = {}
+
+
+class MigrationPlan(NamedTuple):
+    """Что будет перенесено (и пробный прогон)"""
+    source: Server
+    target: Server
+    target_free: int
+    configs: List[Config]  # будут перенесены
+    by_protocol: Dict[str, int]  # {протокол: сколько переносится}
+    unsupported: Dict[str, int]  # {протокол: сколько не поддерживает целевой сервер}
+    over_capacity: int  # не поместятся на целевой сервер
+
+
+class MigrationService:
+    """Планирование и выполнение переноса клиентов"""
+
+    @staticmethod
+    async def plan(source_id: int, target_id: int) -> Optional[MigrationPlan]:
+        """Составить план переноса (ничего не меняет). None — сервер не найден."""
+        from services.wireguard_multi import WireGuardMultiService
+
+        async with async_session() as session:
+            source = await WireGuardMultiService.get_server_by_id(session, source_id)
+            target = await WireGuardMultiService.get_server_by_id(session, target_id)
+            if not source or not target:
+                return None
+
+            configs = list((await session.execute(
+                select(Config)
+                .where(Config.server_id == source_id)
+                .options(selectinload(Config.user))
+                .order_by(Config.id.asc())
+            )).scalars().all())
+            target_free = target.max_clients - await WireGuardMultiService.get_server_client_count(session, target_id)
+
+        supported = {"wg": True}
+        if any((c.protocol_type or "wg") == "awg" for c in configs):
+            supported["awg"] = await WireGuardMultiService.check_awg_available(target)
+        if any(c.protocol_type == "v2ray" for c in configs):
+            supported["v2ray"] = await WireGuardMultiService.check_v2ray_available(target)
+
+        movable, unsupported = [], {}
+        for config in configs:
+            protocol = config.protocol_type or "wg"
+            if supported.get(protocol, False):
+                movable.append(config)
+            else:
+                unsupported[protocol] = unsupported.get(protocol, 0) + 1
+
+        free = max(target_free, 0)
+        moving = movable[:free]
+        by_protocol: Dict[str, int] = {}
+        for config in moving:
+            protocol = config.protocol_type or "wg"
+            by_protocol[protocol] = by_protocol.get(protocol, 0) + 1
+
+        return MigrationPlan(
+            source=source,
+            target=target,
+            target_free=free,
+            configs=moving,
+            by_protocol=by_protocol,
+            unsupported=unsupported,
+            over_capacity=len(movable) - len(moving)
+        )
+
+    @classmethod
+    async def start(cls, source_id: int, target_id: int, bot, admin_chat_id: int) -> Optional[Migration]:
+        """
+        Сохранить план и запустить перенос в фоне.
+        None — нечего переносить или с этого сервера уже идёт перенос.
+        """
+        async with async_session() as session:
+            active = (await session.execute(
+                select(Migration.id).where(
+                    Migration.source_server_id == source_id,
+                    Migration.status == "running"
+                ).limit(1)
+            )).scalar_one_or_none()
+        if active is not None:
+            return None
+
+        plan = await cls.plan(source_id, target_id)
+        if plan is None or not plan.configs:
+            return None
+
+        async with async_session() as session:
+            migration = Migration(
+                source_server_id=source_id,
+                target_server_id=target_id,
+                status="running",
+                bot_id=bot.id,
+                admin_chat_id=admin_chat_id
+            )
+            session.add(migration)
+            await session.flush()
+            session.add_all([
+                MigrationItem(
+                    migration_id=migration.id,
+                    config_id=config.id,
+                    protocol_type=config.protocol_type or "wg",
+                    status="pending",
+                    old_peer_name=config.remote_name,
+                    old_public_key=config.public_key,
+                    notified=False
+                )
+                for config in plan.configs
+            ])
+            await session.commit()
+
+        logger.info(
+            f"Перенос #{migration.id}: {len(plan.configs)} конфигов "
+            f"с {plan.source.name} на {plan.target.name}"
+        )
+        cls._spawn(migration.id)
+        return migration
+
+    @classmethod
+    def _spawn(cls, migration_id: int) -> None:
+        task = _running.get(migration_id)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(cls._run(migration_id))
+        _running[migration_id] = task
+        task.add_done_callback(lambda _: _running.pop(migration_id, None))
+
+    @classmethod
+    async def resume_all(cls) -> None:
+        """Продолжить переносы, прерванные перезапуском"""
+        async with async_session() as session:
+            ids = list((await session.execute(
+                select(Migration.id).where(Migration.status == "running")
+            )).scalars().all())
+        for migration_id in ids:
+            logger.info(f"Перенос #{migration_id}: продолжаем после перезапуска")
+            cls._spawn(migration_id)
+
+    @staticmethod
+    async def _load_items(migration_id: int, status: str) -> List[MigrationItem]:
+        async with async_session() as session:
+            return list((await session.execute(
+                select(MigrationItem)
+                .where(MigrationItem.migration_id == migration_id, MigrationItem.status == status)
+                .order_by(MigrationItem.id.asc())
+            )).scalars().all())
+
+    @staticmethod
+    async def _load_configs(items: List[MigrationItem]) -> Dict[int, Config]:
+        async with async_session() as session:
+            configs = (await session.execute(
+                select(Config)
+                .where(Config.id.in_([item.config_id for item in items]))
+                .options(selectinload(Config.user))
+            )).scalars().all()
+        return {config.id: config for config in configs}
+
+    @classmethod
+    async def _move_batch(
+        cls,
+        items: List[MigrationItem],
+        target: Server,
+        slots: asyncio.Semaphore
+    ) -> List[MigrationItem]:
+        """Создать конфиги пачки на целевом сервере и записать результат одним commit; возвращает перенесённые"""
+        from services.warm_pool import WarmPoolService
+
+        configs = await cls._load_configs(items)
+
+        async def move(item: MigrationItem):
+            config = configs.get(item.config_id)
+            if config is None:
+                return None, "Конфиг удалён"
+            async with slots:
+                try:
+                    success, config_data, msg = await WarmPoolService.issue(
+                        config.name, target, item.protocol_type, None
+                    )
+                except Exception as e:
+                    return None, str(e)
+            if not success or not config_data:
+                return None, msg
+            # Запоминаем пир до общего commit пачки — после падения его найдёт _discard_issued
+            async with async_session() as session:
+                await session.execute(
+                    update(MigrationItem)
+                    .where(MigrationItem.id == item.id)
+                    .values(
+                        status="issued",
+                        new_peer_name=config_data.peer_name or config.name,
+                        new_public_key=config_data.public_key
+                    )
+                )
+                await session.commit()
+            return config_data, None
+
+        results = await asyncio.gather(*(move(item) for item in items))
+
+        moved = []
+        async with async_session() as session:
+            # Конфиги меняем через ORM, чтобы счётчики клиентов серверов сдвинулись в той же транзакции
+            configs = {
+                config.id: config
+                for config in (await session.execute(
+                    select(Config).where(Config.id.in_([item.config_id for item in items]))
+                )).scalars().all()
+            }
+            for item, (config_data, error) in zip(items, results):
+                if config_data is None:
+                    logger.error(f"Перенос конфига #{item.config_id} не удался: {error}")
+                    await session.execute(
+                        update(MigrationItem)
+                        .where(MigrationItem.id == item.id)
+                        .values(status="failed", error=error)
+                    )
+                    continue
+                config = configs.get(item.config_id)
+                if config is not None:
+                    config.server_id = target.id
+                    config.public_key = config_data.public_key
+                    config.preshared_key = config_data.preshared_key
+                    config.allowed_ips = config_data.allowed_ips
+                    config.client_ip = config_data.client_ip
+                    config.config_content = config_data.config_content
+                    config.peer_name = config_data.peer_name
+                await session.execute(
+                    update(MigrationItem).where(MigrationItem.id == item.id).values(status="moved")
+                )
+                moved.append(item)
+            await session.commit()
+        return moved
+
+    @classmethod
+    async def _discard_issued(cls, items: List[MigrationItem], target: Server, slots: asyncio.Semaphore) -> None:
+        """Убрать с целевого сервера пиры, созданные до падения, и вернуть конфиги в очередь"""
+        from services.wireguard_multi import WireGuardMultiService
+
+        async def discard(item: MigrationItem) -> None:
+            if not item.new_peer_name:
+                return
+            async with slots:
+                await WireGuardMultiService.discard_peer(
+                    target, item.new_peer_name, item.protocol_type, item.new_public_key
+                )
+
+        await asyncio.gather(*(discard(item) for item in items))
+
+        async with async_session() as session:
+            await session.execute(
+                update(MigrationItem)
+                .where(MigrationItem.id.in_([item.id for item in items]))
+                .values(status="pending", new_peer_name=None, new_public_key=None)
+            )
+            await session.commit()
+
+    @classmethod
+    async def _cleanup_batch(cls, items: List[MigrationItem], source: Server, slots: asyncio.Semaphore) -> None:
+        """Удалить старые пиры с исходного сервера и отметить пачку одним commit"""
+        from services.wireguard_multi import WireGuardMultiService
+
+        async def cleanup(item: MigrationItem) -> None:
+            async with slots:
+                try:
+                    success, msg = await WireGuardMultiService.delete_config(
+                        item.old_peer_name, source, item.old_public_key, item.protocol_type
+                    )
+                    if not success:
+                        logger.warning(f"Старый пир {item.old_peer_name} на {source.name} не удалён: {msg}")
+                except Exception as e:
+                    logger.warning(f"Ошибка удаления {item.old_peer_name} с исходного сервера: {e}")
+
+        await asyncio.gather(*(cleanup(item) for item in items))
+
+        async with async_session() as session:
+            await session.execute(
+                update(MigrationItem)
+                .where(MigrationItem.id.in_([item.id for item in items]))
+                .values(status="done")
+            )
+            await session.commit()
+
+    @classmethod
+    async def _notify_batch(cls, bot, items: List[MigrationItem]) -> None:
+        """Отправить клиентам новые конфиги через очередь уведомлений"""
+        from handlers.user import send_config_file
+        from keyboards.user_kb import get_main_menu_kb
+        from services.media_cache import MediaCache
+        from services.qr import QrService
+
+        configs = await cls._load_configs(items)
+
+        def make_sends(config: Config) -> List[Callable[[], Awaitable[None]]]:
+            """Вызовы API уведомления — по одному на шаг, чтобы повтор не дублировал отправленное"""
+            chat_id = config.user.telegram_id
+            menu = get_main_menu_kb(chat_id, True, True)
+
+            async def notice() -> None:
+                await bot.send_message(
+                    chat_id,
+                    f"🔄 *Обновление конфига*\n\n"
+                    f"Твой конфиг *{config.name}* был перенесён на новый сервер.\n"
+                    f"Старый конфиг больше не работает.\n\n"
+                    f"Сейчас отправлю новый конфиг 👇",
+                    parse_mode="Markdown"
+                )
+
+            async def link() -> None:
+                await bot.send_message(
+                    chat_id,
+                    f"🔗 *Новая ссылка для подключения:*\n\n`{config.config_content}`",
+                    parse_mode="Markdown",
+                    reply_markup=menu
+                )
+
+            async def document() -> None:
+                await MediaCache.send_bytes(
+                    bot, "document", chat_id,
+                    config.config_content.encode('utf-8'), f"{config.name}.conf",
+                    caption="📄 Твой новый конфиг",
+                    reply_markup=menu
+                )
+
+            async def qr() -> None:
+                await MediaCache.send_bytes(
+                    bot, "photo", chat_id,
+                    await QrService.get_png(config.config_content), f"{config.name}.png",
+                    caption=f"📷 QR-код: {config.name}",
+                    parse_mode=None
+                )
+
+            async def config_file() -> None:
+                await send_config_file(
+                    bot, chat_id, config.name, config, config.server_id,
+                    caption="📄 Твой новый конфиг",
+                    reply_markup=menu
+                )
+
+            if config.protocol_type == "v2ray":
+                return [notice, link]
+            if config.config_content and config.server_id and not LOCAL_MODE:
+                # Как send_config_file, но файл и QR — отдельными шагами очереди
+                return [notice, document, qr]
+            return [notice, config_file]
+
+        sent_ids, futures = [], []
+        for item in items:
+            config = configs.get(item.config_id)
+            if config is None or not config.user or not config.user.telegram_id:
+                # Некого уведомлять — не пытаемся снова после перезапуска
+                sent_ids.append(item.id)
+                continue
+            futures.append((item.id, notifier.submit(*make_sends(config))))
+
+        for item_id, future in futures:
+            try:
+                await future
+                sent_ids.append(item_id)
+            except Exception as e:
+                logger.error(f"Ошибка уведомления о переносе (элемент #{item_id}): {e}")
+                sent_ids.append(item_id)  # повторять отправку не будем
+
+        if sent_ids:
+            async with async_session() as session:
+                await session.execute(
+                    update(MigrationItem).where(MigrationItem.id.in_(sent_ids)).values(notified=True)
+                )
+                await session.commit()
+
+    @classmethod
+    async def _run(cls, migration_id: int) -> None:
+        from services.provisioning import ProvisioningService
+        from services.wireguard_multi import WireGuardMultiService
+
+        migration = None
+        try:
+            async with async_session() as session:
+                migration = (await session.execute(
+                    select(Migration).where(Migration.id == migration_id)
+                )).scalar_one()
+                source = await WireGuardMultiService.get_server_by_id(session, migration.source_server_id)
+                target = await WireGuardMultiService.get_server_by_id(session, migration.target_server_id)
+            bot = ProvisioningService.bot_for(migration)
+            if source is None or target is None:
+                logger.error(f"Перенос #{migration_id}: сервер удалён, перенос остановлен")
+                await cls._finish(migration)
+                return
+
+            target_slots = asyncio.Semaphore(MIGRATION_TARGET_PARALLEL)
+            source_slots = asyncio.Semaphore(MIGRATION_SOURCE_PARALLEL)
+            notifications = []
+
+            # Переносы, прерванные между шагами, сначала доводим до конца
+            moved = await cls._load_items(migration_id, "moved")
+            for i in range(0, len(moved), MIGRATION_BATCH):
+                await cls._cleanup_batch(moved[i:i + MIGRATION_BATCH], source, source_slots)
+            issued = await cls._load_items(migration_id, "issued")
+            if issued:
+                logger.info(f"Перенос #{migration_id}: {len(issued)} пиров созданы до падения, пересоздаём")
+                await cls._discard_issued(issued, target, target_slots)
+
+            pending = await cls._load_items(migration_id, "pending")
+            for i in range(0, len(pending), MIGRATION_BATCH):
+                batch = pending[i:i + MIGRATION_BATCH]
+                moved = await cls._move_batch(batch, target, target_slots)
+                if moved:
+                    await cls._cleanup_batch(moved, source, source_slots)
+                    # Уведомления идут параллельно со следующими пачками
+                    notifications.append(asyncio.create_task(cls._notify_batch(bot, moved)))
+
+            # Не уведомлённые до перезапуска
+            async with async_session() as session:
+                unnotified = list((await session.execute(
+                    select(MigrationItem).where(
+                        MigrationItem.migration_id == migration_id,
+                        MigrationItem.status == "done",
+                        MigrationItem.notified == False
+                    )
+                )).scalars().all())
+            in_flight = {item.id for item in pending}
+            leftover = [item for item in unnotified if item.id not in in_flight]
+            if leftover:
+                notifications.append(asyncio.create_task(cls._notify_batch(bot, leftover)))
+
+            if notifications:
+                await asyncio.gather(*notifications)
+            await cls._finish(migration)
+        except Exception as e:
+            logger.error(f"Ошибка переноса #{migration_id}: {e}")
+            # Иначе перенос так и останется running и start() не даст начать новый
+            try:
+                if migration is not None:
+                    await cls._finish(migration, error=str(e))
+                else:
+                    async with async_session() as session:
+                        await session.execute(
+                            update(Migration)
+                            .where(Migration.id == migration_id)
+                            .values(status="failed", finished_at=datetime.utcnow())
+                        )
+                        await session.commit()
+            except Exception as finish_error:
+                logger.error(f"Перенос #{migration_id}: не удалось отметить ошибку: {finish_error}")
+
+    @classmethod
+    async def _finish(cls, migration: Migration, error: Optional[str] = None) -> None:
+        """Отметить перенос завершённым (или прерванным ошибкой error) и отправить итог администратору"""
+        from services.provisioning import ProvisioningService
+        from keyboards.admin_kb import get_server_detail_kb
+
+        async with async_session() as session:
+            await session.execute(
+                update(Migration)
+                .where(Migration.id == migration.id)
+                .values(status="failed" if error else "completed", finished_at=datetime.utcnow())
+            )
+            await session.commit()
+            counts = dict((await session.execute(
+                select(MigrationItem.status, func.count(MigrationItem.id))
+                .where(MigrationItem.migration_id == migration.id)
+                .group_by(MigrationItem.status)
+            )).all())
+            notified = (await session.execute(
+                select(func.count(MigrationItem.id)).where(
+                    MigrationItem.migration_id == migration.id,
+                    MigrationItem.notified == True
+                )
+            )).scalar() or 0
+            source = await session.get(Server, migration.source_server_id)
+            target = await session.get(Server, migration.target_server_id)
+
+        migrated = counts.get("done", 0) + counts.get("moved", 0)
+        logger.info(f"Перенос #{migration.id} завершён: перенесено {migrated}, ошибок {counts.get('failed', 0)}")
+        if error:
+            header = "❌ *Миграция прервана*"
+            remaining = counts.get("pending", 0) + counts.get("issued", 0)
+            # Текст исключения не должен ломать разметку Markdown
+            footer = f"\n⏳ Не перенесено: {remaining}\n\n⚠️ {error.translate(str.maketrans('', '', '_*`['))}"
+        else:
+            header, footer = "✅ *Миграция завершена*", ""
+
+        bot = ProvisioningService.bot_for(migration)
+        if not migration.admin_chat_id or bot is None or target is None:
+            return
+        try:
+            await bot.send_message(
+                migration.admin_chat_id,
+                f"{header}\n\n"
+                f"📤 С сервера: *{source.name if source else '—'}*\n"
+                f"📥 На сервер: *{target.name}*\n\n"
+                f"✅ Перенесено: {migrated}\n"
+                f"❌ Ошибок: {counts.get('failed', 0)}\n"
+                f"📨 Уведомлено: {notified}"
+                f"{footer}",
+                parse_mode="Markdown",
+                reply_markup=get_server_detail_kb(target.id, target.is_active, migrated > 0)
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки итога переноса: {e}")
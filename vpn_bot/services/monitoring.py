@@ -5,9 +5,8 @@ from sqlalchemy import select
 from sqlalchemy.orm import selectinload
 
 from database import async_session, User, Config, Settings, Server
-from services.wireguard import WireGuardService
 from services.traffic import format_bytes, get_server_traffic
-from services.wireguard_multi import WireGuardMultiService
+from services.traffic_history import TrafficHistory
 from config import ADMIN_ID
 
 logger = logging.getLogger(__name__)
@@ -15,6 +14,8 @@ logger = logging.getLogger(__name__)
 # Дефолтные пороговые значения (могут быть переопределены в БД)
 DEFAULT_TRAFFIC_THRESHOLD_GB = 50
 DEFAULT_CONFIGS_THRESHOLD = 3
+# Окно, за которое трафик сравнивается с порогом
+TRAFFIC_WINDOW = timedelta(hours=24)
 
 
 class MonitoringService:
@@ -78,63 +79,42 @@ class MonitoringService:
     
     @classmethod
     async def _check_traffic_abuse(cls, bot) -> List[Dict]:
-        """Проверяет злоупотребление трафиком"""
+        """Проверяет злоупотребление трафиком (за последние сутки, по истории трафика)"""
         alerts = []
         
         # Получаем порог из настроек
         traffic_threshold = await cls.get_traffic_threshold()
         
+        heavy = await TrafficHistory.get_heavy_configs(
+            datetime.utcnow() - TRAFFIC_WINDOW, traffic_threshold * 1024 ** 3
+        )
+        if not heavy:
+            return alerts
+        
         async with async_session() as session:
-            # Получаем все конфиги из БД
-            stmt = select(Config).options(selectinload(Config.user))
+            stmt = select(Config).where(Config.id.in_(list(heavy))).options(selectinload(Config.user))
             result = await session.execute(stmt)
             configs = result.scalars().all()
+        
+        for config in configs:
+            user = config.user
+            if not user:
+                continue
+            total_gb = heavy[config.id] / (1024 ** 3)
             
-            # Собираем трафик со всех серверов
-            server_traffic_cache = {}
-            
-            for config in configs:
-                if not config.public_key or not config.user:
-                    continue
-                
-                user = config.user
-                
-                # Получаем трафик с правильного сервера
-                if config.server_id:
-                    if config.server_id not in server_traffic_cache:
-                        server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
-                        if server:
-                            server_traffic_cache[config.server_id] = await WireGuardMultiService.get_traffic_stats(server)
-                        else:
-                            server_traffic_cache[config.server_id] = {}
-                    traffic_stats = server_traffic_cache[config.server_id]
-                else:
-                    traffic_stats = await WireGuardService.get_traffic_stats()
-                
-                if config.public_key not in traffic_stats:
-                    continue
-                
-                stats = traffic_stats[config.public_key]
-                
-                # Считаем общий трафик (received + sent)
-                total_bytes = stats.get('received', 0) + stats.get('sent', 0)
-                total_gb = total_bytes / (1024 ** 3)
-                
-                # Проверяем превышение порога
-                if total_gb > traffic_threshold:
-                    # Проверяем, не отправляли ли уже алерт
-                    if cls._can_send_alert(user.id, 'traffic'):
-                        alerts.append({
-                            'type': 'traffic_abuse',
-                            'user_id': user.id,
-                            'telegram_id': user.telegram_id,
-                            'username': user.username or user.full_name,
-                            'config_name': config.name,
-                            'traffic_gb': round(total_gb, 2),
-                            'threshold_gb': traffic_threshold,
-                            'reason': f"Трафик конфига {config.name} превысил {traffic_threshold} GB"
-                        })
-                        cls._mark_alert_sent(user.id, 'traffic')
+            # Проверяем, не отправляли ли уже алерт
+            if cls._can_send_alert(user.id, 'traffic'):
+                alerts.append({
+                    'type': 'traffic_abuse',
+                    'user_id': user.id,
+                    'telegram_id': user.telegram_id,
+                    'username': user.username or user.full_name,
+                    'config_name': config.name,
+                    'traffic_gb': round(total_gb, 2),
+                    'threshold_gb': traffic_threshold,
+                    'reason': f"Трафик конфига {config.name} за сутки превысил {traffic_threshold} GB"
+                })
+                cls._mark_alert_sent(user.id, 'traffic')
         
         return alerts
     
@@ -234,16 +214,18 @@ class MonitoringService:
             if not user:
                 return {}
             
-            # Получаем трафик для конфигов пользователя
-            traffic_stats = await WireGuardService.get_traffic_stats()
+            # Трафик конфигов пользователя за 30 дней — из истории трафика
+            usage = await TrafficHistory.get_usage(
+                datetime.utcnow() - timedelta(days=30), config_ids=[c.id for c in user.configs]
+            )
             
             configs_info = []
             total_traffic = 0
             
             for config in user.configs:
-                config_traffic = traffic_stats.get(config.public_key, {})
-                received = config_traffic.get('received', 0)
-                sent = config_traffic.get('sent', 0)
+                config_traffic = usage.get(config.id)
+                received = config_traffic.received if config_traffic else 0
+                sent = config_traffic.sent if config_traffic else 0
                 total = received + sent
                 total_traffic += total
                 
@@ -0,0 +1,74 @@
+"""
+Отправка массовых уведомлений с ограничением скорости.
+
+Telegram допускает около 30 сообщений в секунду на бота; при массовой
+рассылке (перенос клиентов, очередь) сообщения идут через общую очередь
+с интервалом между вызовами API, а на TelegramRetryAfter — ждём и повторяем.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_PER_SECOND = 20
+RETRY_AFTER_ATTEMPTS = 3
+
+
+class RateLimitedSender:
+    """Очередь отправок: не больше MESSAGES_PER_SECOND вызовов API в секунду"""
+
+    def __init__(self, rate: float = MESSAGES_PER_SECOND):
+        self.rate = rate
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, *sends: Callable[[], Awaitable[None]]) -> asyncio.Future:
+        """
+        Поставить отправку в очередь. sends — функции без аргументов, каждая
+        делает ровно один вызов API; выполняются по порядку, и после
+        TelegramRetryAfter повторяется только тот вызов, на котором остановились,
+        а не уже отправленные. Future завершается после последнего вызова
+        (или с ошибкой — тогда оставшиеся не отправляются).
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((sends, future))
+        return future
+
+    async def _call(self, send: Callable[[], Awaitable[None]]) -> None:
+        """Один вызов API с ожиданием по TelegramRetryAfter"""
+        for attempt in range(RETRY_AFTER_ATTEMPTS):
+            try:
+                await send()
+                return
+            except TelegramRetryAfter as e:
+                logger.warning(f"Telegram просит подождать {e.retry_after}с перед отправкой")
+                await asyncio.sleep(e.retry_after)
+        raise RuntimeError("Telegram не принял сообщение после ожидания")
+
+    async def _run(self) -> None:
+        while True:
+            item: Tuple[Tuple[Callable[[], Awaitable[None]], ...], asyncio.Future] = await self._queue.get()
+            sends, future = item
+            try:
+                for send in sends:
+                    await self._call(send)
+                    await asyncio.sleep(1 / self.rate)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(None)
+
+
+# Общая очередь уведомлений
+notifier = RateLimitedSender()
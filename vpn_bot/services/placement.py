@@ -0,0 +1,253 @@
+"""
+Выбор сервера для нового клиента (placement).
+
+Раньше сервер выбирался по priority и проценту заполненности, который
+каждый раз считался GROUP BY по всем активным конфигам. Теперь сервер
+оценивается набором стратегий, у каждой свой вес:
+
+- fill — доля свободных мест (полный сервер исключается);
+- latency — задержка до сервера (SSH handshake из пула и ping UptimeMonitor);
+- load — загрузка CPU (loadavg / ядра) и сети по последнему замеру;
+- breaker — разомкнутый circuit breaker исключает сервер, half-open штрафует;
+- capability — сервер без нужного протокола исключается.
+
+Итоговая оценка — взвешенное среднее; priority сервера по-прежнему главнее
+оценки. Стратегии можно заменить или добавить через PlacementEngine.strategies.
+
+Число клиентов берётся из счётчика Server.active_clients (ведётся вместе
+с конфигами, см. database/counters.py), поэтому выбор сервера — одно
+чтение таблицы серверов без агрегации по конфигам.
+"""
+
+import logging
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from database import async_session
+from database.models import Server
+from services.capabilities import CapabilityService, ServerCapabilities
+from services.circuit_breaker import breakers, STATE_HALF_OPEN
+
+logger = logging.getLogger(__name__)
+
+LATENCY_EWMA_ALPHA = 0.3  # вес нового замера задержки
+LATENCY_REFERENCE_MS = 100.0  # задержка, при которой оценка — 0.5
+NET_REFERENCE_BYTES_PER_SEC = 12_500_000  # 100 Мбит/с — оценка сети 0
+LOAD_MAX_AGE_SECONDS = 900  # более старые замеры загрузки не учитываются
+
+
+@dataclass
+class ServerStats:
+    """Живые показатели сервера"""
+    latency_ms: Optional[float] = None
+    cpu: Optional[float] = None  # loadavg / число ядер
+    net_bytes_per_sec: Optional[float] = None
+    load_sampled_at: float = 0.0
+    net_total_bytes: Optional[int] = None  # последний счётчик rx+tx для расчёта скорости
+
+
+# {server_id: показатели}
+_stats: Dict[int, ServerStats] = {}
+
+
+def get_stats(server_id: int) -> ServerStats:
+    stats = _stats.get(server_id)
+    if stats is None:
+        stats = ServerStats()
+        _stats[server_id] = stats
+    return stats
+
+
+def record_latency(server_id: int, latency_ms: float) -> None:
+    """Учесть замер задержки (сглаживание EWMA)"""
+    stats = get_stats(server_id)
+    if stats.latency_ms is None:
+        stats.latency_ms = latency_ms
+    else:
+        stats.latency_ms += LATENCY_EWMA_ALPHA * (latency_ms - stats.latency_ms)
+
+
+def record_load(server_id: int, cpu: Optional[float], net_total_bytes: Optional[int]) -> None:
+    """Учесть замер загрузки; скорость сети — по разнице со счётчиком прошлого замера"""
+    stats = get_stats(server_id)
+    now = time.time()
+    if net_total_bytes is not None and stats.net_total_bytes is not None and stats.load_sampled_at:
+        elapsed = now - stats.load_sampled_at
+        delta = net_total_bytes - stats.net_total_bytes
+        # Счётчик сбрасывается при перезагрузке сервера
+        stats.net_bytes_per_sec = delta / elapsed if elapsed > 0 and delta >= 0 else None
+    stats.cpu = cpu
+    stats.net_total_bytes = net_total_bytes
+    stats.load_sampled_at = now
+
+
+@dataclass
+class PlacementContext:
+    """Всё, что знают стратегии о сервере-кандидате"""
+    server: Server
+    clients: int
+    stats: ServerStats
+    protocol: Optional[str]
+    caps: Optional[ServerCapabilities]
+
+
+class PlacementStrategy(ABC):
+    """Оценка сервера: 1 — лучший, 0 — худший, None — сервер не подходит"""
+    name = "base"
+
+    def __init__(self, weight: float = 1.0):
+        self.weight = weight
+
+    @abstractmethod
+    def score(self, ctx: PlacementContext) -> Optional[float]:
+        ...
+
+
+class FillRatioStrategy(PlacementStrategy):
+    name = "fill"
+
+    def score(self, ctx: PlacementContext) -> Optional[float]:
+        if not ctx.server.max_clients or ctx.clients >= ctx.server.max_clients:
+            return None
+        return 1.0 - ctx.clients / ctx.server.max_clients
+
+
+class LatencyStrategy(PlacementStrategy):
+    name = "latency"
+
+    def score(self, ctx: PlacementContext) -> Optional[float]:
+        if ctx.stats.latency_ms is None:
+            return 0.5
+        return 1.0 / (1.0 + ctx.stats.latency_ms / LATENCY_REFERENCE_MS)
+
+
+class LoadStrategy(PlacementStrategy):
+    name = "load"
+
+    def score(self, ctx: PlacementContext) -> Optional[float]:
+        stats = ctx.stats
+        if time.time() - stats.load_sampled_at > LOAD_MAX_AGE_SECONDS:
+            return 0.5
+        parts = []
+        if stats.cpu is not None:
+            parts.append(1.0 - min(stats.cpu, 1.0))
+        if stats.net_bytes_per_sec is not None:
+            parts.append(1.0 - min(stats.net_bytes_per_sec / NET_REFERENCE_BYTES_PER_SEC, 1.0))
+        return sum(parts) / len(parts) if parts else 0.5
+
+
+class BreakerStrategy(PlacementStrategy):
+    name = "breaker"
+
+    def score(self, ctx: PlacementContext) -> Optional[float]:
+        if not breakers.is_available(ctx.server):
+            return None
+        return 0.2 if breakers.get_state(ctx.server.id) == STATE_HALF_OPEN else 1.0
+
+
+class CapabilityStrategy(PlacementStrategy):
+    name = "capability"
+
+    def score(self, ctx: PlacementContext) -> Optional[float]:
+        if ctx.protocol is None or ctx.protocol == "wg":
+            return 1.0
+        if ctx.caps is None or not ctx.caps.supports(ctx.protocol):
+            return None
+        return 1.0
+
+
+class PlacementEngine:
+    """Оценка и выбор серверов по набору стратегий"""
+
+    strategies: List[PlacementStrategy] = [
+        FillRatioStrategy(weight=1.0),
+        LoadStrategy(weight=0.5),
+        LatencyStrategy(weight=0.3),
+        BreakerStrategy(weight=0.5),
+        CapabilityStrategy(weight=0.0),  # только отсев
+    ]
+
+    @classmethod
+    async def _capabilities(cls, server: Server, protocol: Optional[str]) -> Optional[ServerCapabilities]:
+        if protocol in ("awg", "v2ray"):
+            return await CapabilityService.get(server)
+        return CapabilityService.peek(server)
+
+    @classmethod
+    def score(
+        cls,
+        server: Server,
+        clients: int,
+        protocol: Optional[str] = None,
+        caps: Optional[ServerCapabilities] = None
+    ) -> Optional[float]:
+        """Оценка сервера (None — не подходит); clients можно передать с учётом плана"""
+        ctx = PlacementContext(server, clients, get_stats(server.id), protocol, caps)
+        total = weights = 0.0
+        for strategy in cls.strategies:
+            value = strategy.score(ctx)
+            if value is None:
+                return None
+            total += strategy.weight * value
+            weights += strategy.weight
+        return total / weights if weights else 0.0
+
+    @classmethod
+    async def get_servers(cls) -> List[Server]:
+        async with async_session() as session:
+            result = await session.execute(select(Server).where(Server.is_active == True))
+            return list(result.scalars().all())
+
+    @classmethod
+    async def rank(
+        cls,
+        protocol: Optional[str] = None,
+        servers: Optional[Iterable[Server]] = None,
+        exclude: Iterable[int] = ()
+    ) -> List[Tuple[Server, float]]:
+        """Подходящие серверы, лучшие первыми: [(сервер, оценка)]"""
+        if servers is None:
+            servers = await cls.get_servers()
+        excluded = set(exclude)
+
+        ranked = []
+        for server in servers:
+            if server.id in excluded:
+                continue
+            # Дешёвые проверки раньше запроса возможностей
+            clients = server.client_count
+            if clients >= server.max_clients or not breakers.is_available(server):
+                continue
+            caps = await cls._capabilities(server, protocol)
+            value = cls.score(server, clients, protocol, caps)
+            if value is not None:
+                ranked.append((server, value))
+        ranked.sort(key=lambda item: (-(item[0].priority or 0), -item[1]))
+        return ranked
+
+    @classmethod
+    async def choose(cls, protocol: Optional[str] = None, exclude: Iterable[int] = ()) -> Optional[Server]:
+        """Лучший сервер для нового клиента (None — подходящих нет)"""
+        ranked = await cls.rank(protocol, exclude=exclude)
+        if not ranked:
+            return None
+        server, value = ranked[0]
+        logger.info(
+            f"Выбран сервер {server.name}{' для ' + protocol if protocol else ''}: "
+            f"{server.client_count}/{server.max_clients}, оценка {value:.2f}"
+        )
+        return server
+
+    @classmethod
+    async def get_free_capacity(cls) -> List[Tuple[Server, int, int]]:
+        """[(сервер, клиентов, свободно)] доступных серверов со свободными местами"""
+        capacity = []
+        for server in await cls.get_servers():
+            clients = server.client_count
+            if clients < server.max_clients and breakers.is_available(server):
+                capacity.append((server, clients, server.max_clients - clients))
+        return capacity
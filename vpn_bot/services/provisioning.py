@@ -0,0 +1,492 @@
+"""
+Очередь заданий на создание конфигов.
+
+Раньше конфиг создавался прямо в хендлере (пробный период, доп. устройство,
+подтверждение оплаты): медленный или упавший SSH держал апдейт, а
+перезапуск бота терял работу. Теперь хендлер кладёт задание в таблицу
+config_queue и сразу отвечает, а пул воркеров выполняет задания:
+
+- ключ идемпотентности — повторное нажатие не создаёт второе задание;
+- при ошибке — повтор с экспоненциальной задержкой, после
+  PROVISION_MAX_ATTEMPTS попыток задание помечается failed;
+- не больше provision_per_server одновременных созданий на сервер;
+- результат отправляет обработчик, зарегистрированный по имени
+  (@completion_callback), — имя хранится в задании вместе с payload;
+- нет свободных серверов — задание уходит в очередь ожидания (waiting),
+  её разбирает ConfigQueueService.process_queue при появлении места.
+
+Задания, прерванные перезапуском (processing), при старте возвращаются в pending.
+"""
+
+import asyncio
+import json
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from database import async_session, ConfigQueue, Config, Server
+from services.settings import get_setting
+from services.bulkhead import OpPriority, operation_priority
+
+logger = logging.getLogger(__name__)
+
+# Значения по умолчанию (переопределяются настройками provision_workers / provision_per_server)
+DEFAULT_WORKERS = 4
+DEFAULT_PER_SERVER = 2
+
+PROVISION_MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 10
+BACKOFF_MAX_SECONDS = 600
+POLL_INTERVAL_SECONDS = 30
+
+NO_SERVERS_MSG = "Нет доступных серверов"
+
+# Обработчики результата {имя: async fn(bot, job, config_data, error)}
+CompletionCallback = Callable[..., Awaitable[None]]
+_callbacks: Dict[str, CompletionCallback] = {}
+# Ограничение одновременных созданий на сервер {server_id: semaphore}
+_server_slots: Dict[int, asyncio.Semaphore] = {}
+
+
+def completion_callback(name: str):
+    """
+    Зарегистрировать обработчик результата задания.
+    Вызывается с (bot, job, config_data, error): при успехе error — None,
+    при окончательной ошибке config_data — None.
+    """
+    def decorator(func: CompletionCallback) -> CompletionCallback:
+        _callbacks[name] = func
+        return func
+    return decorator
+
+
+class ProvisioningService:
+    """Пул воркеров, создающих конфиги из заданий config_queue"""
+
+    _bots: Dict[int, object] = {}
+    _default_bot = None
+    _workers: List[asyncio.Task] = []
+    _wakeup: Optional[asyncio.Event] = None
+    _per_server = DEFAULT_PER_SERVER
+    is_running = False
+
+    @classmethod
+    def _get_wakeup(cls) -> asyncio.Event:
+        if cls._wakeup is None:
+            cls._wakeup = asyncio.Event()
+        return cls._wakeup
+
+    @classmethod
+    async def enqueue(
+        cls,
+        user_id: int,
+        config_name: str,
+        protocol: Optional[str] = None,
+        on_complete: Optional[str] = None,
+        payload: Optional[dict] = None,
+        idempotency_key: Optional[str] = None,
+        bot_id: Optional[int] = None,
+        server_id: Optional[int] = None,
+        retry_failed: bool = False,
+        prepare: Optional[Callable[[AsyncSession], Awaitable[None]]] = None
+    ) -> Tuple[ConfigQueue, bool]:
+        """
+        Поставить задание в очередь. Возвращает (задание, создано ли новое):
+        с тем же idempotency_key возвращается уже существующее задание.
+        retry_failed — упавшее (failed) задание с этим ключом запускается заново
+        с новыми параметрами и считается созданным.
+        prepare(session) — изменения в БД, которые должны записаться той же
+        транзакцией, что и задание (только если оно создано или перезапущено).
+        """
+        async with async_session() as session:
+            job = ConfigQueue(
+                user_id=user_id,
+                config_name=config_name,
+                status="pending",
+                protocol_type=protocol,
+                server_id=server_id,
+                idempotency_key=idempotency_key,
+                bot_id=bot_id,
+                on_complete=on_complete,
+                payload=json.dumps(payload, ensure_ascii=False) if payload else None,
+                attempts=0
+            )
+            session.add(job)
+            try:
+                if prepare is not None:
+                    await prepare(session)
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                existing = (await session.execute(
+                    select(ConfigQueue).where(ConfigQueue.idempotency_key == idempotency_key)
+                )).scalar_one()
+                if not (retry_failed and existing.status == "failed"):
+                    return existing, False
+
+                # Условный UPDATE: из двух одновременных повторов перезапустит один
+                reset = await session.execute(
+                    update(ConfigQueue)
+                    .where(ConfigQueue.id == existing.id, ConfigQueue.status == "failed")
+                    .values(
+                        status="pending",
+                        config_name=config_name,
+                        protocol_type=protocol,
+                        server_id=server_id,
+                        payload=job.payload,
+                        attempts=0,
+                        next_attempt_at=None,
+                        locked_at=None,
+                        last_error=None
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                if reset.rowcount == 1 and prepare is not None:
+                    await prepare(session)
+                await session.commit()
+                await session.refresh(existing)
+                if reset.rowcount != 1:
+                    return existing, False
+                job = existing
+
+        logger.info(f"Задание #{job.id}: конфиг {config_name} ({protocol or 'auto'}) для пользователя {user_id}")
+        cls._get_wakeup().set()
+        return job, True
+
+    @classmethod
+    async def _claim_next(cls) -> Optional[ConfigQueue]:
+        """Забрать следующее готовое задание (условный UPDATE pending → processing)"""
+        async with async_session() as session:
+            while True:
+                now = datetime.utcnow()
+                job_id = (await session.execute(
+                    select(ConfigQueue.id)
+                    .where(
+                        ConfigQueue.status == "pending",
+                        (ConfigQueue.next_attempt_at.is_(None)) | (ConfigQueue.next_attempt_at <= now)
+                    )
+                    .order_by(ConfigQueue.created_at.asc())
+                    .limit(1)
+                )).scalar_one_or_none()
+                if job_id is None:
+                    return None
+
+                claimed = await session.execute(
+                    update(ConfigQueue)
+                    .where(ConfigQueue.id == job_id, ConfigQueue.status == "pending")
+                    .values(status="processing", locked_at=now)
+                )
+                await session.commit()
+                if claimed.rowcount == 1:
+                    return (await session.execute(
+                        select(ConfigQueue)
+                        .where(ConfigQueue.id == job_id)
+                        .options(selectinload(ConfigQueue.user))
+                    )).scalar_one()
+
+    @classmethod
+    async def _seconds_to_next(cls) -> float:
+        """Сколько ждать до ближайшего отложенного повтора"""
+        async with async_session() as session:
+            nearest = (await session.execute(
+                select(func.min(ConfigQueue.next_attempt_at)).where(ConfigQueue.status == "pending")
+            )).scalar()
+        if nearest is None:
+            return POLL_INTERVAL_SECONDS
+        return min(max((nearest - datetime.utcnow()).total_seconds(), 0.5), POLL_INTERVAL_SECONDS)
+
+    @classmethod
+    def _server_slot(cls, server_id: int) -> asyncio.Semaphore:
+        slot = _server_slots.get(server_id)
+        if slot is None:
+            slot = asyncio.Semaphore(cls._per_server)
+            _server_slots[server_id] = slot
+        return slot
+
+    @classmethod
+    def bot_for(cls, job: ConfigQueue, fallback=None):
+        """Бот, через которого пришёл запрос (или основной)"""
+        return cls._bots.get(job.bot_id) or fallback or cls._default_bot
+
+    @staticmethod
+    async def pick_server(job: ConfigQueue) -> Tuple[Optional[Server], str]:
+        """(сервер, протокол) для задания; сервер None — свободных нет"""
+        from services.wireguard_multi import WireGuardMultiService
+
+        async with async_session() as session:
+            if job.server_id:
+                server = await WireGuardMultiService.get_server_by_id(session, job.server_id)
+                protocol = job.protocol_type or "wg"
+                return (server if server and server.is_active else None), protocol
+            if job.protocol_type:
+                server = await WireGuardMultiService.get_best_server_for_protocol(session, job.protocol_type)
+                return server, job.protocol_type
+            server = await WireGuardMultiService.get_best_server(session)
+        if server is None:
+            return None, "wg"
+        has_awg = await WireGuardMultiService.check_awg_available(server)
+        return server, "awg" if has_awg else "wg"
+
+    @classmethod
+    async def provision(cls, job: ConfigQueue, server: Server, protocol: str) -> Tuple[bool, object, str]:
+        """
+        Создать конфиг задания на сервере и записать его в БД вместе с
+        отметкой о выполнении. Повтор задания, конфиг которого уже записан,
+        ничего не создаёт.
+        """
+        from services.warm_pool import WarmPoolService
+        from services.wireguard_multi import ConfigData
+
+        async with async_session() as session:
+            existing = (await session.execute(
+                select(Config).where(Config.user_id == job.user_id, Config.name == job.config_name)
+            )).scalar_one_or_none()
+            if existing is None:
+                # Имя конфига уникально глобально: занятое другим пользователем
+                # дало бы IntegrityError после создания пира на каждой попытке
+                await cls._ensure_free_name(session, job)
+        if existing is not None:
+            await cls._mark(job, "completed", config_id=existing.id)
+            return True, ConfigData(
+                name=existing.name,
+                public_key=existing.public_key,
+                preshared_key=existing.preshared_key,
+                allowed_ips=existing.allowed_ips,
+                client_ip=existing.client_ip,
+                config_content=existing.config_content,
+                server_id=existing.server_id,
+                peer_name=existing.peer_name
+            ), "Конфиг уже создан"
+
+        async with cls._server_slot(server.id):
+            success, config_data, msg = await WarmPoolService.issue(job.config_name, server, protocol, None)
+        if not success or not config_data:
+            return False, None, msg
+
+        try:
+            await cls._save_config(job, protocol, config_data)
+        except Exception:
+            from services.wireguard_multi import WireGuardMultiService
+            await WireGuardMultiService.discard_peer(
+                server, config_data.peer_name or job.config_name, protocol, config_data.public_key
+            )
+            raise
+        return True, config_data, msg
+
+    @staticmethod
+    async def _ensure_free_name(session, job: ConfigQueue) -> None:
+        """Добавить к имени задания суффикс, если конфиг с таким именем уже есть"""
+        base = job.config_name
+        name, suffix = base, 0
+        while (await session.execute(select(Config.id).where(Config.name == name))).first():
+            suffix += 1
+            name = f"{base}_{suffix}"
+        if name != base:
+            job.config_name = name
+            await session.execute(
+                update(ConfigQueue).where(ConfigQueue.id == job.id).values(config_name=name)
+            )
+            await session.commit()
+            logger.info(f"Задание #{job.id}: имя {base} занято, конфиг будет назван {name}")
+
+    @staticmethod
+    async def _save_config(job: ConfigQueue, protocol: str, config_data) -> None:
+        """Записать конфиг и отметку о выполнении задания одной транзакцией"""
+        async with async_session() as session:
+            config = Config(
+                user_id=job.user_id,
+                server_id=config_data.server_id,
+                name=job.config_name,
+                public_key=config_data.public_key or "",
+                preshared_key=config_data.preshared_key or "",
+                allowed_ips=config_data.allowed_ips or "",
+                client_ip=config_data.client_ip or "",
+                is_active=True,
+                protocol_type=protocol,
+                peer_name=config_data.peer_name,
+                config_content=config_data.config_content
+            )
+            session.add(config)
+            await session.flush()
+            await session.execute(
+                update(ConfigQueue)
+                .where(ConfigQueue.id == job.id)
+                .values(status="completed", processed_at=datetime.utcnow(), config_id=config.id, last_error=None)
+            )
+            await session.commit()
+
+    @staticmethod
+    async def _mark(job: ConfigQueue, status: str, **values) -> None:
+        if status in ("completed", "failed"):
+            values.setdefault("processed_at", datetime.utcnow())
+        async with async_session() as session:
+            await session.execute(
+                update(ConfigQueue).where(ConfigQueue.id == job.id).values(status=status, **values)
+            )
+            await session.commit()
+
+    @classmethod
+    async def notify(cls, bot, job: ConfigQueue, config_data, error: Optional[str]) -> None:
+        """Вызвать обработчик результата задания"""
+        callback = _callbacks.get(job.on_complete or "")
+        user = job.user
+        try:
+            if callback is not None:
+                await callback(bot, job, config_data, error)
+            elif not user or not user.telegram_id:
+                return
+            elif error is not None:
+                await bot.send_message(
+                    user.telegram_id,
+                    f"❌ Ошибка создания конфига: {error}\n\nНапиши @agdelesha для помощи.",
+                    parse_mode=None
+                )
+            else:
+                # Без обработчика (очередь ожидания) — просто отправляем конфиг
+                from handlers.user import send_config_file
+                from keyboards.user_kb import get_main_menu_kb
+                await send_config_file(
+                    bot, user.telegram_id, job.config_name,
+                    config_data, config_data.server_id,
+                    caption="📄 Твой WireGuard конфиг",
+                    reply_markup=get_main_menu_kb(user.telegram_id, True, True)
+                )
+        except Exception as e:
+            logger.error(f"Ошибка обработчика результата задания #{job.id}: {e}")
+
+    @classmethod
+    async def _to_waiting(cls, bot, job: ConfigQueue) -> None:
+        """Свободных серверов нет — задание ждёт в очереди"""
+        from services.config_queue import ConfigQueueService
+
+        await cls._mark(job, "waiting", locked_at=None)
+        ConfigQueueService.track_waiting(1)
+        logger.info(f"Задание #{job.id}: нет свободных серверов, ждёт в очереди")
+        user = job.user
+        if not user or not user.telegram_id:
+            return
+        try:
+            await bot.send_message(
+                user.telegram_id,
+                "⏳ *Все серверы сейчас заняты*\n\n"
+                "Ты добавлен в очередь ожидания.\n"
+                "Как только появится свободное место — конфиг придёт автоматически!",
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка уведомления пользователя об очереди: {e}")
+        await ConfigQueueService.notify_admin_no_servers(bot, user.telegram_id, user.username)
+
+    @classmethod
+    async def _retry_or_fail(cls, bot, job: ConfigQueue, error: str) -> None:
+        attempts = (job.attempts or 0) + 1
+        if attempts >= PROVISION_MAX_ATTEMPTS:
+            await cls._mark(job, "failed", attempts=attempts, last_error=error, locked_at=None)
+            logger.error(f"Задание #{job.id} ({job.config_name}) не выполнено за {attempts} попыток: {error}")
+            await cls.notify(bot, job, None, error)
+            return
+
+        delay = min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS)
+        delay *= random.uniform(0.8, 1.2)
+        await cls._mark(
+            job, "pending",
+            attempts=attempts,
+            last_error=error,
+            locked_at=None,
+            next_attempt_at=datetime.utcnow() + timedelta(seconds=delay)
+        )
+        logger.warning(f"Задание #{job.id}: попытка {attempts} не удалась ({error}), повтор через {int(delay)}с")
+
+    @classmethod
+    async def run_job(cls, job: ConfigQueue) -> None:
+        """Выполнить захваченное задание"""
+        bot = cls.bot_for(job)
+        try:
+            # Пользователь ждёт результата — операции идут с его приоритетом
+            with operation_priority(OpPriority.USER):
+                server, protocol = await cls.pick_server(job)
+                if server is None:
+                    await cls._to_waiting(bot, job)
+                    return
+                success, config_data, msg = await cls.provision(job, server, protocol)
+        except Exception as e:
+            logger.error(f"Ошибка выполнения задания #{job.id}: {e}")
+            await cls._retry_or_fail(bot, job, str(e))
+            return
+
+        if not success:
+            if NO_SERVERS_MSG in (msg or ""):
+                await cls._to_waiting(bot, job)
+            else:
+                await cls._retry_or_fail(bot, job, msg)
+            return
+
+        logger.info(f"Задание #{job.id}: конфиг {job.config_name} создан на {server.name}")
+        await cls.notify(bot, job, config_data, None)
+
+    @classmethod
+    async def _worker(cls, number: int) -> None:
+        wakeup = cls._get_wakeup()
+        while cls.is_running:
+            try:
+                job = await cls._claim_next()
+                if job is not None:
+                    await cls.run_job(job)
+                    continue
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=await cls._seconds_to_next())
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка воркера заданий #{number}: {e}")
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+    @classmethod
+    async def start(cls, bots: list) -> None:
+        """Запустить воркеры; bots — все боты процесса, первый — основной"""
+        if cls.is_running:
+            return
+
+        for bot in bots:
+            cls._bots[bot.id] = bot
+        cls._default_bot = bots[0] if bots else None
+
+        try:
+            workers = int(await get_setting("provision_workers") or DEFAULT_WORKERS)
+            cls._per_server = int(await get_setting("provision_per_server") or DEFAULT_PER_SERVER)
+        except ValueError:
+            workers, cls._per_server = DEFAULT_WORKERS, DEFAULT_PER_SERVER
+        workers = max(workers, 1)
+        cls._per_server = max(cls._per_server, 1)
+
+        # Задания, прерванные перезапуском, выполняем заново
+        async with async_session() as session:
+            resumed = await session.execute(
+                update(ConfigQueue)
+                .where(ConfigQueue.status == "processing")
+                .values(status="pending", locked_at=None)
+            )
+            await session.commit()
+        if resumed.rowcount:
+            logger.info(f"Возобновлено прерванных заданий: {resumed.rowcount}")
+
+        cls.is_running = True
+        cls._workers = [asyncio.create_task(cls._worker(i)) for i in range(workers)]
+        logger.info(f"Очередь заданий запущена (воркеров: {workers}, на сервер: {cls._per_server})")
+
+    @classmethod
+    def stop(cls) -> None:
+        cls.is_running = False
+        for task in cls._workers:
+            task.cancel()
+        cls._workers = []
+        logger.info("Очередь заданий остановлена")
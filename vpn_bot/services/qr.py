@@ -0,0 +1,121 @@
+"""
+QR-коды клиентских конфигов — рисуются ботом, без чтения .png с сервера.
+
+Готовые PNG кэшируются по sha256 содержимого: в памяти (LRU на
+QR_MEMORY_ITEMS штук), вытесненные — на диске в QR_CACHE_DIR.
+Рисование и работа с диском идут в пуле потоков, чтобы не блокировать
+event loop; одинаковые параллельные запросы ждут одну отрисовку.
+В QR конфига есть приватный ключ, поэтому файлы кэша доступны только владельцу.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import qrcode
+
+from config import QR_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+QR_MEMORY_ITEMS = 256  # PNG в памяти
+QR_DISK_ITEMS = 5000  # PNG на диске; лишние (самые старые) удаляются
+
+# {sha256: png}, последний использованный — в конце
+_memory: "OrderedDict[str, bytes]" = OrderedDict()
+# Идущие отрисовки {sha256: future}
+_rendering: Dict[str, asyncio.Future] = {}
+
+
+def render_qr_png(content: str) -> bytes:
+    """PNG с QR-кодом текста конфига или ссылки (синхронно)"""
+    image = qrcode.make(content)
+    buffer = io.BytesIO()
+    image.save(buffer)
+    return buffer.getvalue()
+
+
+def _disk_path(digest: str) -> str:
+    return os.path.join(QR_CACHE_DIR, f"{digest}.png")
+
+
+def _read_disk(digest: str) -> Optional[bytes]:
+    path = _disk_path(digest)
+    try:
+        with open(path, "rb") as f:
+            png = f.read()
+        os.utime(path)  # mtime — время последнего использования
+        return png
+    except OSError:
+        return None
+
+
+def _write_disk(digest: str, png: bytes) -> None:
+    try:
+        os.makedirs(QR_CACHE_DIR, mode=0o700, exist_ok=True)
+        fd = os.open(_disk_path(digest), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(png)
+        _prune_disk()
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить QR в кэш на диске: {e}")
+
+
+def _prune_disk() -> None:
+    """Оставить на диске не больше QR_DISK_ITEMS файлов"""
+    names = [n for n in os.listdir(QR_CACHE_DIR) if n.endswith(".png")]
+    if len(names) <= QR_DISK_ITEMS:
+        return
+    paths = sorted((os.path.join(QR_CACHE_DIR, n) for n in names), key=os.path.getmtime)
+    # Удаляем с запасом, чтобы не чистить на каждой записи
+    for path in paths[:len(paths) - QR_DISK_ITEMS + QR_DISK_ITEMS // 10]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class QrService:
+    """QR-коды с кэшем по хэшу содержимого"""
+
+    @classmethod
+    def _remember(cls, digest: str, png: bytes) -> Optional[tuple]:
+        """Положить в память; возвращает вытесненную запись (digest, png) для записи на диск"""
+        _memory[digest] = png
+        _memory.move_to_end(digest)
+        if len(_memory) > QR_MEMORY_ITEMS:
+            return _memory.popitem(last=False)
+        return None
+
+    @classmethod
+    async def get_png(cls, content: str) -> bytes:
+        """PNG с QR-кодом content: из памяти, с диска или новая отрисовка"""
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+        png = _memory.get(digest)
+        if png is not None:
+            _memory.move_to_end(digest)
+            return png
+
+        future = _rendering.get(digest)
+        if future is None:
+            future = asyncio.ensure_future(cls._load_or_render(digest, content))
+            _rendering[digest] = future
+            future.add_done_callback(lambda _: _rendering.pop(digest, None))
+        return await asyncio.shield(future)
+
+    @classmethod
+    async def _load_or_render(cls, digest: str, content: str) -> bytes:
+        loop = asyncio.get_event_loop()
+        png = await loop.run_in_executor(None, _read_disk, digest)
+        if png is None:
+            png = await loop.run_in_executor(None, render_qr_png, content)
+
+        evicted = cls._remember(digest, png)
+        if evicted is not None:
+            loop.run_in_executor(None, _write_disk, *evicted)
+        return png
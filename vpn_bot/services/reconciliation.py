@@ -0,0 +1,333 @@
+"""
+Сверка БД с серверами (reconciliation) по всем серверам и протоколам.
+
+Для каждого сервера параллельно снимаются наборы пиров (wg, awg) и клиентов
+Xray, сравниваются с конфигами в БД и расхождения исправляются пачкой:
+
+- сироты — пир есть на сервере, но не принадлежит ни конфигу, ни пулу
+  заготовок, ни незавершённому переносу — удаляются;
+- пропавшие — активный в БД конфиг отсутствует на сервере — WG/AWG пир
+  добавляется обратно, Xray-клиент только попадает в отчёт (пересоздать
+  его с тем же UUID нельзя);
+- рассогласование — отключённый в БД конфиг включён на сервере (и наоборот).
+
+Конфиги без ключа в БД (public_key = UNKNOWN, заведены до учёта ключей)
+сопоставляются с пирами по адресу (allowed-ips пира и client_ip конфига);
+если адреса у такого конфига тоже нет, сироты этого протокола на сервере
+не удаляются вовсе.
+
+Конфиг создаётся на сервере раньше, чем его строка попадает в БД, поэтому
+расхождение исправляется, только если оно держится дольше
+CONFIRM_AFTER_SECONDS (то есть замечено и предыдущей сверкой). Свежие
+расхождения попадают в отчёт как ожидающие подтверждения.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import select
+
+from database import async_session, Config, Server, PooledPeer, Migration, MigrationItem
+from services.capabilities import CapabilityService
+from services.circuit_breaker import breakers
+from config import LOCAL_MODE
+
+logger = logging.getLogger(__name__)
+
+CONFIRM_AFTER_SECONDS = 600
+SERVER_PARALLEL = 5
+
+# Что сверяем: wg/awg — по public_key, v2ray — по email клиента (имя пира)
+PROTOCOLS = ("wg", "awg", "v2ray")
+
+# {server_id: {(протокол, вид, идентификатор): когда впервые замечено}}
+_seen: Dict[int, Dict[Tuple[str, str, str], float]] = {}
+_lock = asyncio.Lock()
+
+
+class _Expected(NamedTuple):
+    """Конфиг из БД, каким он должен быть на сервере"""
+    name: str
+    is_active: bool
+    public_key: str
+    preshared_key: str
+    allowed_ips: str
+
+
+@dataclass
+class ServerReport:
+    """Итог сверки одного сервера"""
+    server_name: str
+    peers: Dict[str, int] = field(default_factory=dict)  # протокол → пиров на сервере
+    removed: Dict[str, int] = field(default_factory=dict)  # протокол → удалено сирот
+    enabled: int = 0
+    disabled: int = 0
+    missing: List[str] = field(default_factory=list)  # пропавшие конфиги, не восстановленные
+    pending: int = 0  # расхождения, ждущие подтверждения
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def fixed(self) -> int:
+        return sum(self.removed.values()) + self.enabled + self.disabled
+
+    @property
+    def clean(self) -> bool:
+        return not (self.fixed or self.missing or self.pending or self.errors)
+
+
+class _Snapshot(NamedTuple):
+    """Ожидаемое состояние сервера по данным БД"""
+    expected: Dict[str, Dict[str, _Expected]]  # протокол → {идентификатор: конфиг}
+    known: Dict[str, Set[str]]  # пул заготовок и старые пиры переносов
+    unkeyed: Dict[str, Set[str]]  # протокол → адреса конфигов без ключа
+    unmatched: Set[str]  # протоколы с конфигами без ключа и без адреса
+
+
+def _addresses(value: Optional[str]) -> Set[str]:
+    """'10.0.0.5/32, fd00::5/128' → {'10.0.0.5', 'fd00::5'}"""
+    return {part.strip().split("/")[0] for part in (value or "").split(",") if part.strip()}
+
+
+class ReconciliationService:
+    """Сверка и исправление расхождений БД и серверов"""
+
+    @classmethod
+    async def run(cls, server_ids: Optional[List[int]] = None) -> List[ServerReport]:
+        """Сверить серверы (по умолчанию — все активные) и исправить подтверждённые расхождения"""
+        if LOCAL_MODE:
+            return []
+
+        async with _lock:
+            async with async_session() as session:
+                stmt = select(Server).where(Server.is_active == True)
+                if server_ids:
+                    stmt = select(Server).where(Server.id.in_(server_ids))
+                servers = list((await session.execute(stmt)).scalars().all())
+
+            slots = asyncio.Semaphore(SERVER_PARALLEL)
+
+            async def check(server: Server) -> ServerReport:
+                async with slots:
+                    try:
+                        return await cls._reconcile_server(server)
+                    except Exception as e:
+                        logger.error(f"Ошибка сверки сервера {server.name}: {e}")
+                        return ServerReport(server.name, errors=[str(e)])
+
+            reports = list(await asyncio.gather(*(check(server) for server in servers)))
+
+        fixed = sum(report.fixed for report in reports)
+        logger.info(f"Сверка серверов: проверено {len(reports)}, исправлено расхождений {fixed}")
+        return reports
+
+    @staticmethod
+    async def _fetch(
+        server: Server,
+        protocols: List[str]
+    ) -> Tuple[Dict[str, Optional[Dict[str, bool]]], Dict[str, Dict[str, Set[str]]]]:
+        """
+        Снять с сервера {протокол: {идентификатор: включён}} параллельно по протоколам
+        и адреса WG/AWG пиров {протокол: {public_key: адреса}}
+        """
+        from services.wireguard_multi import WireGuardMultiService
+
+        addresses: Dict[str, Dict[str, Set[str]]] = {}
+
+        async def fetch(protocol: str) -> Optional[Dict[str, bool]]:
+            if protocol == "v2ray":
+                return await WireGuardMultiService.list_v2ray_clients(server)
+            if protocol == "awg":
+                table = await WireGuardMultiService.get_awg_peer_table(server)
+            else:
+                table = await WireGuardMultiService.get_peer_table(server)
+            if table is None:
+                return None
+            addresses[protocol] = {key: _addresses(peer.allowed_ips) for key, peer in table.peers.items()}
+            # Отключённый WG пир убирается из интерфейса — в дампе только включённые
+            return {key: True for key in table.peers}
+
+        results = await asyncio.gather(*(fetch(protocol) for protocol in protocols))
+        return dict(zip(protocols, results)), addresses
+
+    @staticmethod
+    async def _load_snapshot(server_id: int) -> _Snapshot:
+        """Конфиги, пул заготовок и старые пиры переносов сервера"""
+        expected: Dict[str, Dict[str, _Expected]] = {}
+        known: Dict[str, Set[str]] = {}
+        unkeyed: Dict[str, Set[str]] = {}
+        unmatched: Set[str] = set()
+
+        async with async_session() as session:
+            configs = (await session.execute(
+                select(
+                    Config.protocol_type, Config.name, Config.peer_name, Config.is_active,
+                    Config.public_key, Config.preshared_key, Config.allowed_ips, Config.client_ip
+                ).where(Config.server_id == server_id)
+            )).all()
+            pooled = (await session.execute(
+                select(PooledPeer.protocol_type, PooledPeer.public_key, PooledPeer.peer_name)
+                .where(PooledPeer.server_id == server_id)
+            )).all()
+            leftovers = (await session.execute(
+                select(MigrationItem.protocol_type, MigrationItem.old_public_key, MigrationItem.old_peer_name)
+                .join(Migration, Migration.id == MigrationItem.migration_id)
+                .where(Migration.source_server_id == server_id, MigrationItem.status.in_(("pending", "moved", "failed")))
+            )).all()
+
+        def ident(protocol: str, public_key: Optional[str], peer_name: Optional[str]) -> Optional[str]:
+            return peer_name if protocol == "v2ray" else public_key
+
+        for protocol_type, name, peer_name, is_active, public_key, preshared_key, allowed_ips, client_ip in configs:
+            protocol = protocol_type if protocol_type in PROTOCOLS else "wg"
+            key = ident(protocol, public_key, peer_name or name)
+            if key and key != "UNKNOWN":
+                expected.setdefault(protocol, {})[key] = _Expected(
+                    name, is_active is not False, public_key, preshared_key, allowed_ips
+                )
+                continue
+            # Пир такого конфига на сервере есть, но узнать его можно только по адресу
+            ips = _addresses(client_ip) | _addresses(allowed_ips)
+            if ips:
+                unkeyed.setdefault(protocol, set()).update(ips)
+            else:
+                unmatched.add(protocol)
+        for protocol_type, public_key, peer_name in list(pooled) + list(leftovers):
+            protocol = protocol_type if protocol_type in PROTOCOLS else "wg"
+            key = ident(protocol, public_key, peer_name)
+            if key:
+                known.setdefault(protocol, set()).add(key)
+        return _Snapshot(expected, known, unkeyed, unmatched)
+
+    @classmethod
+    async def _reconcile_server(cls, server: Server) -> ServerReport:
+        from services.wireguard_multi import WireGuardMultiService
+
+        report = ServerReport(server.name)
+        if not breakers.is_available(server):
+            report.errors.append("сервер недоступен")
+            return report
+
+        caps = await CapabilityService.get(server)
+        protocols = ["wg"] + [p for p in ("awg", "v2ray") if caps.supports(p)]
+
+        # Сначала сервер, потом БД: конфиг, созданный между снимками, не станет сиротой
+        on_server, addresses = await cls._fetch(server, protocols)
+        snapshot = await cls._load_snapshot(server.id)
+
+        now = time.time()
+        previous = _seen.get(server.id, {})
+        seen: Dict[Tuple[str, str, str], float] = {}
+
+        def confirmed(protocol: str, kind: str, key: str) -> bool:
+            mark = (protocol, kind, key)
+            seen[mark] = previous.get(mark, now)
+            if now - seen[mark] >= CONFIRM_AFTER_SECONDS:
+                return True
+            report.pending += 1
+            return False
+
+        for protocol in protocols:
+            present = on_server[protocol]
+            if present is None:
+                report.errors.append(f"{protocol}: нет ответа")
+                # Не сбрасываем замеченное по протоколу, который не ответил
+                seen.update({mark: at for mark, at in previous.items() if mark[0] == protocol})
+                continue
+            report.peers[protocol] = len(present)
+
+            expected = snapshot.expected.get(protocol, {})
+            known = snapshot.known.get(protocol, set())
+
+            unkeyed = snapshot.unkeyed.get(protocol)
+            peer_addresses = addresses.get(protocol, {})
+
+            orphans = [key for key in present if key not in expected and key not in known]
+            if protocol in snapshot.unmatched:
+                # Пир конфига без ключа и адреса не отличить от сироты
+                orphans = []
+            elif unkeyed:
+                orphans = [key for key in orphans if not peer_addresses.get(key, set()) & unkeyed]
+            to_disable = [key for key, config in expected.items() if not config.is_active and present.get(key)]
+            to_enable = [key for key, config in expected.items() if config.is_active and present.get(key) is False]
+            missing = [key for key, config in expected.items() if config.is_active and key not in present]
+
+            orphans = [key for key in orphans if confirmed(protocol, "orphan", key)]
+            to_disable = [key for key in to_disable if confirmed(protocol, "disable", key)]
+            to_enable = [key for key in to_enable if confirmed(protocol, "enable", key)]
+            missing = [key for key in missing if confirmed(protocol, "missing", key)]
+
+            if protocol == "v2ray":
+                report.missing.extend(expected[key].name for key in missing)
+                if orphans or to_enable or to_disable:
+                    success, error = await WireGuardMultiService.update_v2ray_clients(
+                        server, remove=orphans, enable=to_enable, disable=to_disable
+                    )
+                    if success:
+                        report.removed[protocol] = len(orphans)
+                        report.enabled += len(to_enable)
+                        report.disabled += len(to_disable)
+                    else:
+                        report.errors.append(f"{protocol}: {error}")
+                continue
+
+            interface = (server.awg_interface or "awg0") if protocol == "awg" else server.wg_interface
+            if orphans:
+                # wg-quick save не знает awg0 (конфиг AWG лежит в /etc/amnezia) — для AWG только
+                # убираем из интерфейса; вернувшийся после перезапуска сирота уйдёт следующей сверкой
+                removed, failed = await WireGuardMultiService.remove_peers(
+                    server, orphans, save=protocol != "awg", interface=interface
+                )
+                report.removed[protocol] = len(removed)
+                if failed:
+                    report.errors.append(f"{protocol}: не удалено сирот {len(failed)}")
+            if to_disable:
+                removed, failed = await WireGuardMultiService.remove_peers(
+                    server, to_disable, save=False, interface=interface
+                )
+                report.disabled += len(removed)
+            for key in missing:
+                config = expected[key]
+                success, _ = await WireGuardMultiService.enable_config(
+                    config.public_key, config.preshared_key, config.allowed_ips, server, interface=interface
+                )
+                if success:
+                    report.enabled += 1
+                else:
+                    report.missing.append(config.name)
+
+        # Исправленное в следующий раз не найдётся и выпадет само, неисправленное повторится сразу
+        _seen[server.id] = seen
+        return report
+
+    @staticmethod
+    def format_report(reports: List[ServerReport]) -> str:
+        """Отчёт сверки для админа (Markdown)"""
+        if not reports:
+            return "🔎 *Сверка серверов*\n\nНет серверов для проверки."
+
+        lines = ["🔎 *Сверка серверов*", ""]
+        for report in reports:
+            if report.clean:
+                peers = ", ".join(f"{p.upper()} {n}" for p, n in report.peers.items())
+                lines.append(f"✅ *{report.server_name}*: расхождений нет ({peers})")
+                continue
+            lines.append(f"⚠️ *{report.server_name}*")
+            removed = ", ".join(f"{p.upper()} {n}" for p, n in report.removed.items() if n)
+            if removed:
+                lines.append(f"  🧹 Удалено сирот: {removed}")
+            if report.enabled:
+                lines.append(f"  ▶️ Включено: {report.enabled}")
+            if report.disabled:
+                lines.append(f"  ⏸ Отключено: {report.disabled}")
+            if report.missing:
+                names = ", ".join(f"`{name}`" for name in report.missing[:10])
+                more = f" и ещё {len(report.missing) - 10}" if len(report.missing) > 10 else ""
+                lines.append(f"  ❓ Нет на сервере: {names}{more}")
+            if report.pending:
+                lines.append(f"  ⏳ Ждут подтверждения: {report.pending}")
+            for error in report.errors:
+                lines.append(f"  ❌ {error}")
+        return "\n".join(lines)
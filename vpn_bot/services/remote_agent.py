@@ -0,0 +1,217 @@
+"""
+Клиент агента agde-agent на VPN серверах.
+
+Агент запускается один раз на постоянном SSH канале и принимает JSON запросы
+по строке на сообщение. Это убирает запуск shell и нового процесса на каждую
+операцию с пирами. Если агент не установлен — вызывающий код откатывается на shell.
+"""
+
+import asyncio
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from services.ssh_pool import ssh_pool
+
+logger = logging.getLogger(__name__)
+
+AGENT_PATH = "/usr/local/bin/agde-agent.py"
+AGENT_SOURCE = Path(__file__).resolve().parent.parent / "scripts" / "server" / "agde-agent.py"
+
+REQUEST_TIMEOUT_SECONDS = 60
+START_TIMEOUT_SECONDS = 10
+# Сколько не пытаться запускать агент после неудачи (например, он не установлен)
+RETRY_AFTER_SECONDS = 300
+
+
+class AgentError(Exception):
+    """Агент недоступен или канал с ним оборвался"""
+
+
+class RemoteAgent:
+    """Один запущенный агент: мультиплексирует запросы по id поверх stdin/stdout"""
+
+    def __init__(self, stdin, stdout, close: Callable[[], None], name: str):
+        # stdin/stdout — байтовые потоки с write()/drain() и readline()
+        # (подходят и asyncssh процесс, и локальный asyncio subprocess)
+        self._stdin = stdin
+        self._stdout = stdout
+        self._close = close
+        self.name = name
+        self.closed = False
+        self.version: Optional[int] = None
+        self._next_id = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._write_lock = asyncio.Lock()
+        self._reader = asyncio.create_task(self._read_loop())
+
+    @classmethod
+    async def start_ssh(cls, server) -> "RemoteAgent":
+        """Запустить агент на сервере в отдельном SSH соединении"""
+        conn = await ssh_pool.open_dedicated(server)
+        try:
+            process = await conn.create_process(f"python3 {AGENT_PATH}", encoding=None)
+        except BaseException:
+            conn.close()
+            raise
+
+        def close():
+            process.close()
+            conn.close()
+
+        agent = cls(process.stdin, process.stdout, close, server.host)
+        await agent._handshake()
+        return agent
+
+    @classmethod
+    async def start_local(cls, path: Optional[str] = None) -> "RemoteAgent":
+        """Запустить агент локально (для отладки без сервера)"""
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, path or str(AGENT_SOURCE),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+
+        def close():
+            if process.returncode is None:
+                process.kill()
+
+        agent = cls(process.stdin, process.stdout, close, "local")
+        await agent._handshake()
+        return agent
+
+    async def _handshake(self) -> None:
+        try:
+            ok, result, error = await self.call("ping", timeout=START_TIMEOUT_SECONDS)
+        except AgentError:
+            self.close()
+            raise
+        if not ok:
+            self.close()
+            raise AgentError(f"агент не ответил на ping: {error}")
+        self.version = result.get("version") if isinstance(result, dict) else None
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                line = await self._stdout.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Агент {self.name}: некорректный ответ {line[:200]!r}")
+                    continue
+                future = self._pending.pop(message.get("id"), None)
+                if future and not future.done():
+                    future.set_result(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning(f"Агент {self.name}: ошибка чтения: {e}")
+        finally:
+            self.closed = True
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(AgentError("канал агента закрыт"))
+            self._pending.clear()
+
+    async def call(self, method: str, timeout: float = REQUEST_TIMEOUT_SECONDS, **params) -> Tuple[bool, Any, str]:
+        """
+        Вызвать метод агента.
+        Возвращает (успех, результат, ошибка); AgentError — если канал недоступен.
+        """
+        if self.closed:
+            raise AgentError("канал агента закрыт")
+
+        self._next_id += 1
+        req_id = self._next_id
+        future = asyncio.get_event_loop().create_future()
+        self._pending[req_id] = future
+
+        data = json.dumps({"id": req_id, "method": method, "params": params}) + "\n"
+        try:
+            async with self._write_lock:
+                self._stdin.write(data.encode())
+                await self._stdin.drain()
+            message = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise AgentError(f"таймаут запроса {method}")
+        except (ConnectionError, OSError) as e:
+            raise AgentError(str(e))
+        finally:
+            self._pending.pop(req_id, None)
+
+        return bool(message.get("ok")), message.get("result"), message.get("error") or ""
+
+    def close(self) -> None:
+        self.closed = True
+        self._reader.cancel()
+        try:
+            self._close()
+        except Exception:
+            pass
+
+
+class AgentRegistry:
+    """Запущенные агенты по серверам"""
+
+    _agents: Dict[int, RemoteAgent] = {}
+    _locks: Dict[int, asyncio.Lock] = {}
+    # {server_id: monotonic время, до которого агент не запускаем}
+    _unavailable_until: Dict[int, float] = {}
+
+    @classmethod
+    async def get(cls, server) -> Optional[RemoteAgent]:
+        """Вернуть агент сервера, запустив при необходимости; None — агент недоступен"""
+        agent = cls._agents.get(server.id)
+        if agent and not agent.closed:
+            return agent
+
+        if time.monotonic() < cls._unavailable_until.get(server.id, 0):
+            return None
+
+        lock = cls._locks.setdefault(server.id, asyncio.Lock())
+        async with lock:
+            agent = cls._agents.get(server.id)
+            if agent and not agent.closed:
+                return agent
+            if time.monotonic() < cls._unavailable_until.get(server.id, 0):
+                return None
+
+            try:
+                agent = await RemoteAgent.start_ssh(server)
+            except Exception as e:
+                logger.info(f"Агент на {server.name} недоступен, используем shell: {e}")
+                cls._agents.pop(server.id, None)
+                cls._unavailable_until[server.id] = time.monotonic() + RETRY_AFTER_SECONDS
+                return None
+
+            logger.info(f"Агент на {server.name} запущен (версия {agent.version})")
+            cls._agents[server.id] = agent
+            cls._unavailable_until.pop(server.id, None)
+            return agent
+
+    @classmethod
+    def invalidate(cls, server) -> None:
+        """Закрыть агент сервера и разрешить немедленный перезапуск (после установки/смены реквизитов)"""
+        agent = cls._agents.pop(server.id, None)
+        if agent:
+            agent.close()
+        cls._unavailable_until.pop(server.id, None)
+
+    @classmethod
+    def mark_failed(cls, server) -> None:
+        """Агент сломался — закрываем и какое-то время работаем через shell"""
+        cls.invalidate(server)
+        cls._unavailable_until[server.id] = time.monotonic() + RETRY_AFTER_SECONDS
+
+    @classmethod
+    def close_all(cls) -> None:
+        for agent in cls._agents.values():
+            agent.close()
+        cls._agents.clear()
+        cls._unavailable_until.clear()
@@ -1,4 +1,6 @@
+import asyncio
 import logging
+import time
 from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
@@ -6,10 +8,14 @@ from sqlalchemy import select, func
 from sqlalchemy.orm import selectinload
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 
-from database import async_session, User, Subscription, Config, Server, BotSettings
+from database import async_session, User, Subscription, Server, BotSettings
+from database.counters import recount_client_counters
 from services.wireguard import WireGuardService
 from services.wireguard_multi import WireGuardMultiService
 from services.monitoring import MonitoringService
+from services.capabilities import CapabilityService
+from services.placement import PlacementEngine
+from services.traffic_history import TrafficHistory
 from config import ADMIN_ID
 
 logger = logging.getLogger(__name__)
@@ -72,6 +78,48 @@ class SchedulerService:
             replace_existing=True
         )
         
+        self.scheduler.add_job(
+            self.refresh_server_capabilities,
+            IntervalTrigger(minutes=10),
+            id="refresh_capabilities",
+            replace_existing=True
+        )
+        
+        self.scheduler.add_job(
+            self.replenish_warm_pool,
+            IntervalTrigger(minutes=5),
+            id="replenish_warm_pool",
+            replace_existing=True
+        )
+        
+        self.scheduler.add_job(
+            self.sample_server_load,
+            IntervalTrigger(minutes=5),
+            id="sample_server_load",
+            replace_existing=True
+        )
+        
+        self.scheduler.add_job(
+            self.repair_client_counters,
+            IntervalTrigger(hours=1),
+            id="repair_client_counters",
+            replace_existing=True
+        )
+        
+        self.scheduler.add_job(
+            self.reconcile_servers,
+            IntervalTrigger(minutes=30),
+            id="reconcile_servers",
+            replace_existing=True
+        )
+        
+        self.scheduler.add_job(
+            self.prune_traffic_history,
+            IntervalTrigger(hours=6),
+            id="prune_traffic_history",
+            replace_existing=True
+        )
+        
         self.scheduler.start()
         logger.info("Планировщик запущен")
     
@@ -195,7 +243,7 @@ class SchedulerService:
                     if config.server_id:
                         server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
                         if server:
-                            await WireGuardMultiService.delete_config(config.name, server, config.public_key)
+                            await WireGuardMultiService.delete_config(config.remote_name, server, config.public_key)
                     else:
                         await WireGuardService.delete_config(config.name)
                 except Exception as e:
@@ -232,6 +280,8 @@ class SchedulerService:
             result = await session.execute(stmt)
             subscriptions = result.scalars().all()
             
+            # Подписки, по которым нужно отключить конфиги (нет другой активной)
+            expired = []
             for sub in subscriptions:
                 user = sub.user
                 
@@ -243,34 +293,33 @@ class SchedulerService:
                 active_result = await session.execute(active_sub_stmt)
                 has_active_sub = active_result.scalar() is not None
                 
-                if has_active_sub:
-                    continue
-                
-                for config in user.configs:
+                if not has_active_sub:
+                    expired.append(sub)
+            
+            if not expired:
+                return
+            
+            # Группируем конфиги по серверам, чтобы отключать их пачкой
+            by_server = {}
+            for sub in expired:
+                for config in sub.user.configs:
                     if config.is_active:
-                        # Определяем на каком сервере конфиг
-                        if config.server_id:
-                            # Мультисервер - отключаем на удалённом сервере
-                            server = await WireGuardMultiService.get_server_by_id(session, config.server_id)
-                            if server:
-                                success, msg = await WireGuardMultiService.disable_config(config.public_key, server)
-                            else:
-                                success, msg = True, "Сервер удалён"
-                        else:
-                            # Локальный сервер
-                            success, msg = await WireGuardService.disable_config(config.public_key)
-                        
-                        if success:
-                            config.is_active = False
-                            logger.info(f"Конфиг {config.name} отключен (подписка истекла)")
-                        else:
-                            logger.error(f"Ошибка отключения конфига {config.name}: {msg}")
-                
-                await session.commit()
-                
-                # Удаляем истёкшую подписку чтобы не обрабатывать повторно
+                        by_server.setdefault(config.server_id, []).append(config)
+            
+            for server_id, configs in by_server.items():
+                disabled = await self._disable_server_configs(session, server_id, configs)
+                for config in configs:
+                    if config.id in disabled:
+                        config.is_active = False
+                        logger.info(f"Конфиг {config.name} отключен (подписка истекла)")
+            
+            # Удаляем истёкшие подписки чтобы не обрабатывать повторно
+            for sub in expired:
                 await session.delete(sub)
-                await session.commit()
+            await session.commit()
+            
+            for sub in expired:
+                user = sub.user
                 logger.info(f"Истёкшая подписка #{sub.id} удалена для user_id={user.telegram_id}")
                 
                 try:
@@ -291,6 +340,110 @@ class SchedulerService:
                 except Exception as e:
                     logger.error(f"Ошибка отправки уведомления об истечении user_id={user.telegram_id}: {e}")
     
+    async def _disable_server_configs(self, session, server_id, configs) -> set:
+        """Отключить конфиги одного сервера. Возвращает id успешно отключённых конфигов"""
+        disabled = set()
+        
+        if not server_id:
+            # Локальный сервер
+            for config in configs:
+                success, msg = await WireGuardService.disable_config(config.public_key)
+                if success:
+                    disabled.add(config.id)
+                else:
+                    logger.error(f"Ошибка отключения конфига {config.name}: {msg}")
+            return disabled
+        
+        server = await WireGuardMultiService.get_server_by_id(session, server_id)
+        if not server:
+            # Сервер удалён — отключать нечего
+            return {config.id for config in configs}
+        
+        # V2Ray отключается своим скриптом, WireGuard и AWG пиры — одним вызовом на интерфейс
+        by_interface = {}
+        for config in configs:
+            protocol = getattr(config, 'protocol_type', '')
+            if config.name.startswith("v2ray_") or protocol == 'v2ray':
+                success, msg = await WireGuardMultiService.disable_v2ray_config(config.remote_name, server)
+                if success:
+                    disabled.add(config.id)
+                else:
+                    logger.error(f"Ошибка отключения конфига {config.name}: {msg}")
+            elif protocol == 'awg':
+                by_interface.setdefault(server.awg_interface or "awg0", []).append(config)
+            else:
+                by_interface.setdefault(server.wg_interface, []).append(config)
+        
+        for interface, peer_configs in by_interface.items():
+            removed, failed = await WireGuardMultiService.disable_configs(
+                server, [config.public_key for config in peer_configs], interface=interface
+            )
+            removed = set(removed)
+            for config in peer_configs:
+                if config.public_key in removed:
+                    disabled.add(config.id)
+                else:
+                    logger.error(f"Ошибка отключения конфига {config.name}: {failed.get(config.public_key, 'нет ответа')}")
+        
+        return disabled
+    
+    async def refresh_server_capabilities(self):
+        """Фоновое обновление кэша возможностей серверов (протоколы, порты)"""
+        try:
+            await CapabilityService.refresh_all()
+        except Exception as e:
+            logger.error(f"Ошибка обновления возможностей серверов: {e}")
+    
+    async def replenish_warm_pool(self):
+        """Пополнение пула заготовленных конфигов на серверах"""
+        from services.warm_pool import WarmPoolService
+        try:
+            await WarmPoolService.replenish_all()
+        except Exception as e:
+            logger.error(f"Ошибка пополнения пула конфигов: {e}")
+    
+    async def sample_server_load(self):
+        """Замер загрузки серверов для выбора сервера новым клиентам"""
+        try:
+            servers = await PlacementEngine.get_servers()
+            await asyncio.gather(
+                *(WireGuardMultiService.sample_load(server) for server in servers),
+                return_exceptions=True
+            )
+        except Exception as e:
+            logger.error(f"Ошибка замера загрузки серверов: {e}")
+    
+    async def repair_client_counters(self):
+        """Сверка счётчиков клиентов серверов с полным подсчётом конфигов"""
+        try:
+            async with async_session() as session:
+                fixed = await recount_client_counters(session)
+            if fixed:
+                logger.info(f"Счётчики клиентов исправлены: {', '.join(fixed)}")
+        except Exception as e:
+            logger.error(f"Ошибка сверки счётчиков клиентов: {e}")
+    
+    async def reconcile_servers(self):
+        """Сверка серверов с БД; админу — отчёт, если что-то исправлено или пропало"""
+        from services.reconciliation import ReconciliationService
+        try:
+            reports = await ReconciliationService.run()
+            if any(report.fixed or report.missing for report in reports):
+                await self.bot.send_message(
+                    ADMIN_ID,
+                    ReconciliationService.format_report(reports),
+                    parse_mode="Markdown"
+                )
+        except Exception as e:
+            logger.error(f"Ошибка сверки серверов: {e}")
+    
+    async def prune_traffic_history(self):
+        """Удаление истории трафика старше сроков хранения"""
+        try:
+            await TrafficHistory.prune()
+        except Exception as e:
+            logger.error(f"Ошибка очистки истории трафика: {e}")
+    
     async def check_suspicious_activity(self):
         """Проверяет подозрительную активность пользователей"""
         logger.info("Проверка подозрительной активности...")
@@ -308,68 +461,34 @@ class SchedulerService:
         logger.info("Обновление статистики трафика...")
         
         try:
-            from services.traffic import get_server_traffic
+            from services.traffic import collect_traffic
             
             async with async_session() as session:
                 # Получаем все активные серверы
                 servers_stmt = select(Server).where(Server.is_active == True)
                 servers_result = await session.execute(servers_stmt)
                 servers = servers_result.scalars().all()
-                
-                # Собираем трафик со всех серверов
-                all_traffic = {}
-                for server in servers:
-                    try:
-                        server_traffic = await get_server_traffic(server)
-                        if server_traffic:
-                            all_traffic.update(server_traffic)
-                    except Exception as e:
-                        logger.error(f"Ошибка получения трафика с сервера {server.name}: {e}")
-                
-                if not all_traffic:
-                    logger.info("Нет данных о трафике для обновления")
-                    return
-                
-                # Получаем все активные конфиги
-                configs_stmt = select(Config).where(Config.is_active == True)
-                configs_result = await session.execute(configs_stmt)
-                configs = configs_result.scalars().all()
-                
-                updated_count = 0
-                for config in configs:
-                    if config.public_key in all_traffic:
-                        stats = all_traffic[config.public_key]
-                        current_received = stats.get('received', 0)
-                        current_sent = stats.get('sent', 0)
-                        
-                        # Пропускаем если нет трафика
-                        if current_received == 0 and current_sent == 0:
-                            continue
-                        
-                        # Получаем сохранённые значения "до перезапуска WG"
-                        last_wg_received = config.last_wg_received or 0
-                        last_wg_sent = config.last_wg_sent or 0
-                        
-                        # Если текущий трафик меньше последнего известного — WG перезапустился
-                        # Сохраняем накопленный трафик и начинаем считать заново
-                        if current_received < last_wg_received or current_sent < last_wg_sent:
-                            # WG перезапустился — добавляем последний известный трафик к total
-                            # и начинаем отсчёт заново с текущих значений
-                            config.total_received = (config.total_received or 0) + last_wg_received
-                            config.total_sent = (config.total_sent or 0) + last_wg_sent
-                            config.last_wg_received = current_received
-                            config.last_wg_sent = current_sent
-                            logger.debug(f"WG restart detected for {config.name}: reset counters")
-                        else:
-                            # Обычное обновление — просто запоминаем текущие значения
-                            config.last_wg_received = current_received
-                            config.last_wg_sent = current_sent
-                        
-                        config.last_traffic_update = datetime.utcnow()
-                        updated_count += 1
-                
+            
+            # Собираем трафик со всех серверов параллельно (сессия БД на это время не держится)
+            started = time.monotonic()
+            all_traffic, results = await collect_traffic(servers)
+            failed = [r.server_name for r in results if not r.ok]
+            logger.info(
+                f"Трафик собран с {len(results) - len(failed)}/{len(results)} серверов "
+                f"за {time.monotonic() - started:.1f}с"
+                + (f", без ответа: {', '.join(failed)}" if failed else "")
+            )
+            
+            if not all_traffic:
+                logger.info("Нет данных о трафике для обновления")
+                return
+            
+            # Сброс счётчиков при перезапуске WG, приросты в историю и накопление —
+            # набором запросов по всей пачке и одним коммитом, без загрузки конфигов
+            async with async_session() as session:
+                updated_count, recorded = await TrafficHistory.accumulate(session, all_traffic)
                 await session.commit()
-                logger.info(f"Обновлена статистика трафика для {updated_count} конфигов")
+            logger.info(f"Обновлена статистика трафика для {updated_count} конфигов (замеров в историю: {recorded})")
                 
         except Exception as e:
             logger.error(f"Ошибка обновления статистики трафика: {e}")
@@ -0,0 +1,300 @@
+"""
+Пул постоянных SSH соединений к VPN серверам.
+
+Вместо нового TCP + SSH handshake на каждую команду соединения
+переиспользуются: одно соединение обслуживает несколько каналов
+(exec/SFTP) одновременно, держится keepalive и закрывается по простою.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import asyncssh
+
+from services.placement import record_latency
+
+logger = logging.getLogger(__name__)
+
+# Лимиты пула
+MAX_CONNECTIONS_PER_SERVER = 3
+MAX_CONNECTIONS_TOTAL = 50
+MAX_CHANNELS_PER_CONNECTION = 8  # sshd по умолчанию разрешает 10 сессий (MaxSessions)
+
+# Таймауты
+CONNECT_TIMEOUT_SECONDS = 10
+IDLE_TIMEOUT_SECONDS = 300  # Закрываем соединение после 5 минут простоя
+KEEPALIVE_INTERVAL_SECONDS = 30
+KEEPALIVE_COUNT_MAX = 3
+EVICT_INTERVAL_SECONDS = 60
+
+# Ошибки, после которых соединение считается мёртвым и стоит переподключиться
+RECONNECT_ERRORS = (
+    asyncssh.DisconnectError,
+    asyncssh.ChannelOpenError,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+class _PoolClient(asyncssh.SSHClient):
+    """SSH клиент, который отмечает разрыв соединения"""
+
+    def __init__(self):
+        self.closed = False
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.closed = True
+
+
+@dataclass
+class _PooledConnection:
+    """Соединение в пуле"""
+    conn: asyncssh.SSHClientConnection
+    client: _PoolClient
+    in_use: int = 0
+    broken: bool = False
+    last_used: float = field(default_factory=time.monotonic)
+
+    @property
+    def alive(self) -> bool:
+        return not self.broken and not self.client.closed
+
+
+class SSHConnectionPool:
+    """Пул SSH соединений с разбивкой по серверам"""
+
+    def __init__(self):
+        # {server_key: [соединения]}
+        self._connections: Dict[Tuple, List[_PooledConnection]] = {}
+        # Сколько соединений сейчас открывается (чтобы не превысить лимит)
+        self._pending: Dict[Tuple, int] = {}
+        # id(conn) -> (server_key, соединение в пуле)
+        self._by_conn: Dict[int, Tuple[Tuple, _PooledConnection]] = {}
+        self._cond: Optional[asyncio.Condition] = None
+        self._task: Optional[asyncio.Task] = None
+        self.is_running = False
+
+    @staticmethod
+    def _server_key(server) -> Tuple:
+        """Ключ пула: при смене реквизитов сервера создаётся новый пул"""
+        return (server.id, server.host, server.ssh_port, server.ssh_user, server.ssh_password)
+
+    def _get_cond(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _total_connections(self) -> int:
+        opened = sum(len(conns) for conns in self._connections.values())
+        return opened + sum(self._pending.values())
+
+    def _drop(self, key: Tuple, pc: _PooledConnection) -> None:
+        """Убрать соединение из пула и закрыть его"""
+        conns = self._connections.get(key)
+        if conns and pc in conns:
+            conns.remove(pc)
+            if not conns:
+                self._connections.pop(key, None)
+        self._by_conn.pop(id(pc.conn), None)
+        pc.conn.close()
+
+    def _drop_dead(self, key: Tuple) -> None:
+        for pc in list(self._connections.get(key, [])):
+            if not pc.alive and pc.in_use == 0:
+                self._drop(key, pc)
+
+    def _evict_lru_idle(self, exclude_key: Tuple) -> bool:
+        """Закрыть самое давно не используемое свободное соединение другого сервера"""
+        candidates = [
+            (pc.last_used, key, pc)
+            for key, conns in self._connections.items() if key != exclude_key
+            for pc in conns if pc.in_use == 0
+        ]
+        if not candidates:
+            return False
+        _, key, pc = min(candidates, key=lambda item: item[0])
+        logger.debug(f"SSH пул: закрываем простаивающее соединение к {key[1]} (лимит пула)")
+        self._drop(key, pc)
+        return True
+
+    async def _open(self, server) -> _PooledConnection:
+        started = time.monotonic()
+        conn, client = await asyncssh.create_connection(
+            _PoolClient,
+            server.host,
+            port=server.ssh_port,
+            username=server.ssh_user,
+            password=server.ssh_password,
+            known_hosts=None,
+            connect_timeout=CONNECT_TIMEOUT_SECONDS,
+            keepalive_interval=KEEPALIVE_INTERVAL_SECONDS,
+            keepalive_count_max=KEEPALIVE_COUNT_MAX
+        )
+        # Время handshake — оценка задержки до сервера для выбора сервера
+        record_latency(server.id, (time.monotonic() - started) * 1000)
+        logger.debug(f"SSH пул: новое соединение к {server.host}")
+        return _PooledConnection(conn=conn, client=client)
+
+    async def _acquire(self, server) -> Tuple[Tuple, _PooledConnection]:
+        key = self._server_key(server)
+        cond = self._get_cond()
+
+        async with cond:
+            while True:
+                self._drop_dead(key)
+                conns = self._connections.get(key, [])
+
+                # Переиспользуем наименее загруженное живое соединение
+                free = [pc for pc in conns if pc.alive and pc.in_use < MAX_CHANNELS_PER_CONNECTION]
+                if free:
+                    pc = min(free, key=lambda c: c.in_use)
+                    pc.in_use += 1
+                    pc.last_used = time.monotonic()
+                    return key, pc
+
+                # Можно открыть новое соединение?
+                server_count = len(conns) + self._pending.get(key, 0)
+                if server_count < MAX_CONNECTIONS_PER_SERVER:
+                    if self._total_connections() < MAX_CONNECTIONS_TOTAL or self._evict_lru_idle(key):
+                        self._pending[key] = self._pending.get(key, 0) + 1
+                        break
+
+                await cond.wait()
+
+        try:
+            pc = await self._open(server)
+        except BaseException:
+            async with cond:
+                self._release_pending(key)
+                cond.notify_all()
+            raise
+
+        async with cond:
+            self._release_pending(key)
+            pc.in_use = 1
+            self._connections.setdefault(key, []).append(pc)
+            self._by_conn[id(pc.conn)] = (key, pc)
+            cond.notify_all()
+        return key, pc
+
+    def _release_pending(self, key: Tuple) -> None:
+        self._pending[key] = self._pending.get(key, 1) - 1
+        if self._pending[key] <= 0:
+            self._pending.pop(key, None)
+
+    async def _release(self, key: Tuple, pc: _PooledConnection) -> None:
+        cond = self._get_cond()
+        async with cond:
+            pc.in_use -= 1
+            pc.last_used = time.monotonic()
+            if not pc.alive and pc.in_use == 0:
+                self._drop(key, pc)
+            cond.notify_all()
+
+    @asynccontextmanager
+    async def connection(self, server):
+        """
+        Взять соединение из пула.
+        Использование: async with ssh_pool.connection(server) as conn: ...
+        """
+        key, pc = await self._acquire(server)
+        try:
+            yield pc.conn
+        except RECONNECT_ERRORS:
+            pc.broken = True
+            raise
+        finally:
+            await self._release(key, pc)
+
+    async def open_dedicated(self, server) -> asyncssh.SSHClientConnection:
+        """
+        Открыть отдельное соединение вне пула (для долгоживущих каналов, например агента).
+        Закрывает его вызывающий.
+        """
+        pc = await self._open(server)
+        return pc.conn
+
+    def discard(self, conn: asyncssh.SSHClientConnection) -> None:
+        """Пометить соединение как сломанное — оно будет закрыто после освобождения"""
+        entry = self._by_conn.get(id(conn))
+        if entry:
+            entry[1].broken = True
+
+    async def close_server(self, server) -> None:
+        """Закрыть все свободные соединения к серверу (например, после смены пароля)"""
+        cond = self._get_cond()
+        async with cond:
+            for key in [k for k in self._connections if k[0] == server.id or k[1] == server.host]:
+                for pc in list(self._connections.get(key, [])):
+                    if pc.in_use == 0:
+                        self._drop(key, pc)
+                    else:
+                        pc.broken = True
+            cond.notify_all()
+
+    async def evict_idle(self) -> int:
+        """Закрыть соединения, простаивающие дольше IDLE_TIMEOUT_SECONDS"""
+        cond = self._get_cond()
+        now = time.monotonic()
+        evicted = 0
+        async with cond:
+            for key in list(self._connections):
+                for pc in list(self._connections.get(key, [])):
+                    if pc.in_use == 0 and (not pc.alive or now - pc.last_used > IDLE_TIMEOUT_SECONDS):
+                        self._drop(key, pc)
+                        evicted += 1
+            if evicted:
+                cond.notify_all()
+        if evicted:
+            logger.debug(f"SSH пул: закрыто {evicted} простаивающих соединений")
+        return evicted
+
+    async def close_all(self) -> None:
+        """Закрыть все соединения пула"""
+        cond = self._get_cond()
+        async with cond:
+            for key in list(self._connections):
+                for pc in list(self._connections.get(key, [])):
+                    self._drop(key, pc)
+            cond.notify_all()
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """Статистика пула по хостам: открыто соединений и занято каналов"""
+        stats: Dict[str, Dict[str, int]] = {}
+        for key, conns in self._connections.items():
+            host_stats = stats.setdefault(key[1], {'connections': 0, 'channels': 0})
+            host_stats['connections'] += len(conns)
+            host_stats['channels'] += sum(pc.in_use for pc in conns)
+        return stats
+
+    async def _evict_loop(self):
+        while self.is_running:
+            await asyncio.sleep(EVICT_INTERVAL_SECONDS)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                logger.error(f"Ошибка очистки SSH пула: {e}")
+
+    def start(self):
+        """Запускает фоновую очистку простаивающих соединений"""
+        if self.is_running:
+            return
+        self.is_running = True
+        self._task = asyncio.create_task(self._evict_loop())
+        logger.info("SSH пул запущен")
+
+    async def stop(self):
+        """Останавливает очистку и закрывает все соединения"""
+        self.is_running = False
+        if self._task:
+            self._task.cancel()
+        await self.close_all()
+        logger.info("SSH пул остановлен")
+
+
+# Глобальный пул соединений
+ssh_pool = SSHConnectionPool()
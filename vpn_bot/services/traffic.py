@@ -3,18 +3,31 @@
 Централизованное получение трафика с кэшированием.
 """
 
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
 from dataclasses import dataclass
 
 from config import LOCAL_MODE
+from services.async_cache import AsyncCache
+from services.collectors import feed_key
 
 logger = logging.getLogger(__name__)
 
-# Кэш трафика: {server_id: {'data': {...}, 'expires': datetime}}
-_traffic_cache: Dict[int, dict] = {}
 CACHE_TTL_SECONDS = 30  # Время жизни кэша в секундах
+CACHE_STALE_SECONDS = 60  # Ещё столько отдаём устаревшие данные, обновляя их в фоне
+CACHE_NEGATIVE_SECONDS = 10  # Столько не переспрашиваем сервер, который не ответил
+
+# Кэш трафика {server_id: {ключ: {'received', 'sent'}}}, 0 — локальный сервер
+_traffic_cache: AsyncCache[Dict[str, Dict[str, int]]] = AsyncCache(
+    "traffic", CACHE_TTL_SECONDS, CACHE_STALE_SECONDS, CACHE_NEGATIVE_SECONDS
+)
+
+# Сбор трафика со всего парка: серверов одновременно и таймаут на сервер
+COLLECT_PARALLEL = 10
+COLLECT_TIMEOUT_SECONDS = 45
 
 
 @dataclass
@@ -37,6 +50,22 @@ class TrafficStats:
         return format_bytes(self.total)
 
 
+@dataclass
+class CollectionResult:
+    """Итог сбора трафика с одного сервера"""
+    server_id: int
+    server_name: str
+    ok: bool
+    duration_ms: float
+    peers: int = 0
+    error: Optional[str] = None
+    collected_at: Optional[datetime] = None
+
+
+# Последний сбор трафика по серверам {server_id: CollectionResult}
+_collection_results: Dict[int, CollectionResult] = {}
+
+
 def format_bytes(size: int) -> str:
     """Форматирует размер в байтах в человекочитаемый формат"""
     for unit in ['B', 'KiB', 'MiB', 'GiB']:
@@ -46,39 +75,18 @@ def format_bytes(size: int) -> str:
     return f"{size:.2f} TiB"
 
 
-def _is_cache_valid(server_id: int) -> bool:
-    """Проверяет валидность кэша для сервера"""
-    if server_id not in _traffic_cache:
-        return False
-    cache_entry = _traffic_cache[server_id]
-    return datetime.utcnow() < cache_entry.get('expires', datetime.min)
-
-
-def _get_cached_traffic(server_id: int) -> Optional[Dict[str, Dict[str, int]]]:
-    """Получает трафик из кэша если он валиден"""
-    if _is_cache_valid(server_id):
-        logger.debug(f"Трафик для сервера {server_id} взят из кэша")
-        return _traffic_cache[server_id]['data']
-    return None
-
-
 def _set_cached_traffic(server_id: int, data: Dict[str, Dict[str, int]]):
     """Сохраняет трафик в кэш"""
-    _traffic_cache[server_id] = {
-        'data': data,
-        'expires': datetime.utcnow() + timedelta(seconds=CACHE_TTL_SECONDS)
-    }
+    _traffic_cache.set(server_id, data)
     logger.debug(f"Трафик для сервера {server_id} сохранён в кэш (TTL: {CACHE_TTL_SECONDS}с)")
 
 
 def clear_traffic_cache(server_id: Optional[int] = None):
     """Очищает кэш трафика (для конкретного сервера или весь)"""
-    global _traffic_cache
+    _traffic_cache.invalidate(server_id)
     if server_id is not None:
-        _traffic_cache.pop(server_id, None)
         logger.debug(f"Кэш трафика для сервера {server_id} очищен")
     else:
-        _traffic_cache = {}
         logger.debug("Весь кэш трафика очищен")
 
 
@@ -91,7 +99,7 @@ async def get_server_traffic(server, session=None) -> Dict[str, Dict[str, int]]:
         session: SQLAlchemy session (опционально)
     
     Returns:
-        Dict[public_key, {'received': int, 'sent': int}]
+        Dict[public_key или email Xray, {'received': int, 'sent': int}]
     """
     if LOCAL_MODE:
         return {}
@@ -99,25 +107,20 @@ async def get_server_traffic(server, session=None) -> Dict[str, Dict[str, int]]:
     # Определяем server_id (0 для локального)
     server_id = server.id if server else 0
     
-    # Проверяем кэш
-    cached = _get_cached_traffic(server_id)
-    if cached is not None:
-        return cached
-    
-    # Получаем свежие данные
-    if server:
-        from services.wireguard_multi import WireGuardMultiService
-        traffic_stats = await WireGuardMultiService.get_traffic_stats(server)
-        logger.info(f"Получен трафик с сервера {server.name} ({len(traffic_stats)} пиров)")
-    else:
+    async def load() -> Optional[Dict[str, Dict[str, int]]]:
+        if server:
+            from services.wireguard_multi import WireGuardMultiService
+            traffic_stats = await WireGuardMultiService.collect_counters(server)
+            if traffic_stats is not None:
+                logger.info(f"Получен трафик с сервера {server.name} ({len(traffic_stats)} пиров)")
+            return traffic_stats
         from services.wireguard import WireGuardService
         traffic_stats = await WireGuardService.get_traffic_stats()
         logger.info(f"Получен трафик с локального сервера ({len(traffic_stats)} пиров)")
+        return traffic_stats
     
-    # Сохраняем в кэш
-    _set_cached_traffic(server_id, traffic_stats)
-    
-    return traffic_stats
+    # Параллельные запросы одного сервера ждут одну загрузку
+    return await _traffic_cache.get(server_id, load) or {}
 
 
 async def get_config_traffic(config, session) -> TrafficStats:
@@ -131,7 +134,8 @@ async def get_config_traffic(config, session) -> TrafficStats:
     Returns:
         TrafficStats с данными о трафике
     """
-    if LOCAL_MODE or not config.public_key:
+    key = feed_key(config)
+    if LOCAL_MODE or not key:
         return TrafficStats()
     
     # Получаем сервер конфига
@@ -147,8 +151,8 @@ async def get_config_traffic(config, session) -> TrafficStats:
     traffic_stats = await get_server_traffic(server, session)
     
     # Извлекаем данные для конкретного конфига
-    if config.public_key in traffic_stats:
-        stats = traffic_stats[config.public_key]
+    if key in traffic_stats:
+        stats = traffic_stats[key]
         return TrafficStats(
             received=stats.get('received', 0),
             sent=stats.get('sent', 0)
@@ -178,7 +182,8 @@ async def get_user_total_traffic(user, session) -> TrafficStats:
     server_cache = {}
     
     for config in user.configs:
-        if not config.public_key:
+        key = feed_key(config)
+        if not key:
             continue
         
         # Получаем сервер (с кэшированием)
@@ -194,9 +199,69 @@ async def get_user_total_traffic(user, session) -> TrafficStats:
         # Получаем трафик с сервера (с кэшированием)
         traffic_stats = await get_server_traffic(server, session)
         
-        if config.public_key in traffic_stats:
-            stats = traffic_stats[config.public_key]
+        if key in traffic_stats:
+            stats = traffic_stats[key]
             total_received += stats.get('received', 0)
             total_sent += stats.get('sent', 0)
     
     return TrafficStats(received=total_received, sent=total_sent)
+
+
+async def collect_traffic(servers: Iterable) -> Tuple[Dict[str, Dict[str, int]], List[CollectionResult]]:
+    """
+    Снять трафик (WG, AWG и Xray, см. services/collectors.py) со всех
+    серверов параллельно (не больше COLLECT_PARALLEL
+    одновременно, на сервер — COLLECT_TIMEOUT_SECONDS). Медленный или
+    недоступный сервер не задерживает остальных: его пиров просто нет в
+    результате. Возвращает (трафик всех ответивших серверов, итоги по серверам).
+    """
+    from services.wireguard_multi import WireGuardMultiService
+    
+    slots = asyncio.Semaphore(COLLECT_PARALLEL)
+    
+    async def collect(server) -> Tuple[Dict[str, Dict[str, int]], CollectionResult]:
+        async with slots:
+            started = time.monotonic()
+            data: Dict[str, Dict[str, int]] = {}
+            error = None
+            try:
+                counters = await asyncio.wait_for(
+                    WireGuardMultiService.collect_counters(server), COLLECT_TIMEOUT_SECONDS
+                )
+                if counters is None:
+                    error = "сервер не ответил"
+                else:
+                    data = counters
+                    _set_cached_traffic(server.id, data)
+            except asyncio.TimeoutError:
+                error = f"таймаут {COLLECT_TIMEOUT_SECONDS}с"
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            
+            result = CollectionResult(
+                server_id=server.id,
+                server_name=server.name,
+                ok=error is None,
+                duration_ms=(time.monotonic() - started) * 1000,
+                peers=len(data),
+                error=error,
+                collected_at=datetime.utcnow()
+            )
+            _collection_results[server.id] = result
+            if error:
+                logger.warning(f"Трафик с сервера {server.name} не получен за {result.duration_ms:.0f} мс: {error}")
+            return data, result
+    
+    collected = await asyncio.gather(*(collect(server) for server in servers))
+    
+    all_traffic: Dict[str, Dict[str, int]] = {}
+    results = []
+    for data, result in collected:
+        all_traffic.update(data)
+        results.append(result)
+    return all_traffic, results
+
+
+def get_collection_result(server_id: int) -> Optional[CollectionResult]:
+    """Итог последнего сбора трафика с сервера"""
+    return _collection_results.get(server_id)
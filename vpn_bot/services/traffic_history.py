@@ -0,0 +1,255 @@
+"""
+История трафика конфигов.
+
+Каждый цикл сбора (SchedulerService.update_traffic_stats → accumulate)
+дописывает приросты трафика: сырой замер в traffic_samples и сразу же
+прибавляет его к часовому и суточному итогу в traffic_rollups (upsert),
+в той же транзакции, что и накопительные счётчики конфигов. Поэтому
+запросы за период читают готовые итоги по индексу, а не суммируют замеры
+и не ходят на серверы за `wg show`.
+
+Прореживание — по сроку хранения: сырые замеры живут RAW_RETENTION,
+часовые итоги — HOURLY_RETENTION, суточные — DAILY_RETENTION (prune).
+"""
+
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import (
+    BigInteger, Column, DateTime, MetaData, String, Table,
+    and_, case, delete, func, literal, or_, select, text, update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_session, Config, TrafficSample, TrafficRollup
+from services.traffic import TrafficStats
+
+logger = logging.getLogger(__name__)
+
+RAW_RETENTION = timedelta(days=2)
+HOURLY_RETENTION = timedelta(days=45)
+DAILY_RETENTION = timedelta(days=400)
+
+PERIOD_HOUR = "hour"
+PERIOD_DAY = "day"
+
+# Временная таблица соединения (своя для каждого соединения SQLite, в metadata моделей не входит)
+_batch = Table(
+    "traffic_batch", MetaData(),
+    Column("feed_key", String(255), primary_key=True),
+    Column("received", BigInteger),
+    Column("sent", BigInteger),
+    prefixes=["TEMPORARY"],
+)
+
+
+class TrafficPoint(NamedTuple):
+    """Точка ряда: трафик за интервал, начинающийся в bucket_start"""
+    bucket_start: datetime
+    received: int
+    sent: int
+
+
+def _bucket(at: datetime, period: str) -> datetime:
+    if period == PERIOD_DAY:
+        return at.replace(hour=0, minute=0, second=0, microsecond=0)
+    return at.replace(minute=0, second=0, microsecond=0)
+
+
+def _period_for(since: datetime) -> str:
+    """Часовые итоги, пока они ещё хранятся, иначе суточные"""
+    return PERIOD_HOUR if datetime.utcnow() - since <= HOURLY_RETENTION else PERIOD_DAY
+
+
+class TrafficHistory:
+    """Запись и выборка истории трафика"""
+
+    @classmethod
+    async def accumulate(
+        cls,
+        session: AsyncSession,
+        traffic: Dict[str, Dict[str, int]],
+        at: Optional[datetime] = None
+    ) -> Tuple[int, int]:
+        """
+        Учесть ленту счётчиков {ключ: {'received', 'sent'}} набором запросов
+        без загрузки конфигов: пачка ключей во временной таблице, приросты в
+        историю, итоги часа и суток и накопительные счётчики конфигов — каждое
+        одним INSERT/UPDATE с join по пачке. Коммит — за вызывающим.
+        Возвращает (обновлено конфигов, записано замеров).
+        """
+        at = at or datetime.utcnow()
+        rows = [
+            {"feed_key": key, "received": stats.get("received", 0), "sent": stats.get("sent", 0)}
+            for key, stats in traffic.items()
+            if stats.get("received") or stats.get("sent")
+        ]
+        if not rows:
+            return 0, 0
+
+        await session.execute(text(
+            "CREATE TEMP TABLE IF NOT EXISTS traffic_batch "
+            "(feed_key VARCHAR(255) PRIMARY KEY, received BIGINT, sent BIGINT)"
+        ))
+        await session.execute(_batch.delete())
+        await session.execute(_batch.insert(), rows)
+
+        last_received = func.coalesce(Config.last_wg_received, 0)
+        last_sent = func.coalesce(Config.last_wg_sent, 0)
+        # Счётчик меньше прошлого — интерфейс перезапускался, отсчёт пошёл с нуля
+        restarted = or_(_batch.c.received < last_received, _batch.c.sent < last_sent)
+        delta_received = case((restarted, _batch.c.received), else_=_batch.c.received - last_received)
+        delta_sent = case((restarted, _batch.c.sent), else_=_batch.c.sent - last_sent)
+        # Ключ ленты счётчиков (services/collectors.feed_key): email у Xray, public_key у WG/AWG
+        config_key = case(
+            (Config.protocol_type == "v2ray", func.coalesce(Config.peer_name, Config.name)),
+            else_=Config.public_key
+        )
+        matched = and_(config_key == _batch.c.feed_key, Config.is_active == True)
+
+        # Приросты — до обновления счётчиков. Первый замер конфига — только
+        # точка отсчёта, иначе весь счётчик WG попал бы в один интервал
+        samples = await session.execute(
+            TrafficSample.__table__.insert().from_select(
+                ["config_id", "user_id", "server_id", "sampled_at", "received", "sent"],
+                select(
+                    Config.id, Config.user_id, Config.server_id,
+                    literal(at, DateTime), delta_received, delta_sent
+                ).where(
+                    matched,
+                    Config.last_traffic_update.isnot(None),
+                    delta_received + delta_sent > 0
+                )
+            )
+        )
+
+        rollups = TrafficRollup.__table__
+        for period in (PERIOD_HOUR, PERIOD_DAY):
+            stmt = sqlite_insert(rollups).from_select(
+                ["period", "bucket_start", "config_id", "user_id", "server_id", "received", "sent"],
+                select(
+                    literal(period), literal(_bucket(at, period), DateTime),
+                    TrafficSample.config_id, TrafficSample.user_id, TrafficSample.server_id,
+                    TrafficSample.received, TrafficSample.sent
+                ).where(TrafficSample.sampled_at == at)
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["period", "config_id", "bucket_start"],
+                set_={
+                    "received": rollups.c.received + stmt.excluded.received,
+                    "sent": rollups.c.sent + stmt.excluded.sent,
+                    "user_id": stmt.excluded.user_id,
+                    "server_id": stmt.excluded.server_id,
+                }
+            )
+            await session.execute(stmt)
+
+        # При перезапуске последние известные значения уходят в total, как и раньше
+        updated = await session.execute(
+            update(Config)
+            .where(matched)
+            .values(
+                total_received=func.coalesce(Config.total_received, 0) + case((restarted, last_received), else_=0),
+                total_sent=func.coalesce(Config.total_sent, 0) + case((restarted, last_sent), else_=0),
+                last_wg_received=_batch.c.received,
+                last_wg_sent=_batch.c.sent,
+                last_traffic_update=at,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return updated.rowcount, samples.rowcount
+
+    @classmethod
+    async def get_series(
+        cls,
+        since: datetime,
+        until: Optional[datetime] = None,
+        config_ids: Optional[Iterable[int]] = None,
+        user_id: Optional[int] = None,
+        period: Optional[str] = None
+    ) -> List[TrafficPoint]:
+        """Ряд трафика за период (по конфигам или пользователю) с шагом час/сутки"""
+        period = period or _period_for(since)
+        table = TrafficRollup
+        stmt = (
+            select(table.bucket_start, func.sum(table.received), func.sum(table.sent))
+            .where(table.period == period, table.bucket_start >= _bucket(since, period))
+            .group_by(table.bucket_start)
+            .order_by(table.bucket_start)
+        )
+        if until is not None:
+            stmt = stmt.where(table.bucket_start < until)
+        if user_id is not None:
+            stmt = stmt.where(table.user_id == user_id)
+        if config_ids is not None:
+            stmt = stmt.where(table.config_id.in_(list(config_ids)))
+
+        async with async_session() as session:
+            rows = (await session.execute(stmt)).all()
+        return [TrafficPoint(bucket, received or 0, sent or 0) for bucket, received, sent in rows]
+
+    @classmethod
+    async def get_usage(
+        cls,
+        since: datetime,
+        config_ids: Optional[Iterable[int]] = None,
+        user_id: Optional[int] = None
+    ) -> Dict[int, TrafficStats]:
+        """Трафик за период по конфигам: {config_id: TrafficStats}"""
+        period = _period_for(since)
+        stmt = (
+            select(TrafficRollup.config_id, func.sum(TrafficRollup.received), func.sum(TrafficRollup.sent))
+            .where(TrafficRollup.period == period, TrafficRollup.bucket_start >= _bucket(since, period))
+            .group_by(TrafficRollup.config_id)
+        )
+        if user_id is not None:
+            stmt = stmt.where(TrafficRollup.user_id == user_id)
+        if config_ids is not None:
+            stmt = stmt.where(TrafficRollup.config_id.in_(list(config_ids)))
+
+        async with async_session() as session:
+            rows = (await session.execute(stmt)).all()
+        return {config_id: TrafficStats(received or 0, sent or 0) for config_id, received, sent in rows}
+
+    @classmethod
+    async def get_heavy_configs(cls, since: datetime, min_bytes: int) -> Dict[int, int]:
+        """Конфиги, потратившие за период больше min_bytes: {config_id: байт}"""
+        period = _period_for(since)
+        total = func.sum(TrafficRollup.received + TrafficRollup.sent)
+        stmt = (
+            select(TrafficRollup.config_id, total)
+            .where(TrafficRollup.period == period, TrafficRollup.bucket_start >= _bucket(since, period))
+            .group_by(TrafficRollup.config_id)
+            .having(total > min_bytes)
+        )
+        async with async_session() as session:
+            rows = (await session.execute(stmt)).all()
+        return {config_id: used for config_id, used in rows}
+
+    @classmethod
+    async def prune(cls) -> None:
+        """Удалить замеры и итоги старше сроков хранения"""
+        now = datetime.utcnow()
+        async with async_session() as session:
+            samples = await session.execute(
+                delete(TrafficSample).where(TrafficSample.sampled_at < now - RAW_RETENTION)
+            )
+            hourly = await session.execute(
+                delete(TrafficRollup).where(
+                    TrafficRollup.period == PERIOD_HOUR,
+                    TrafficRollup.bucket_start < now - HOURLY_RETENTION
+                )
+            )
+            daily = await session.execute(
+                delete(TrafficRollup).where(
+                    TrafficRollup.period == PERIOD_DAY,
+                    TrafficRollup.bucket_start < now - DAILY_RETENTION
+                )
+            )
+            await session.commit()
+        logger.info(
+            f"История трафика: удалено замеров {samples.rowcount}, "
+            f"часовых итогов {hourly.rowcount}, суточных {daily.rowcount}"
+        )
@@ -13,6 +13,9 @@ from datetime import datetime, timedelta
 from typing import Optional, Dict, List
 from dataclasses import dataclass
 
+from services.circuit_breaker import breakers
+from services.placement import record_latency
+
 logger = logging.getLogger(__name__)
 
 # Конфигурация
@@ -163,6 +166,11 @@ class UptimeMonitor:
                     status = await self.ping_server(server.host)
                     status.host = f"{server.name} ({server.host})"
                     
+                    # Делимся результатом с circuit breaker'ом SSH операций
+                    breakers.report_ping(server, status.is_up, status.error)
+                    if status.latency_ms is not None:
+                        record_latency(server.id, status.latency_ms)
+                    
                     # Проверяем изменение статуса
                     old_status = self.server_statuses.get(server.host)
                     
@@ -251,6 +259,11 @@ class UptimeMonitor:
             error = f" - {status.error}" if status.error else ""
             lines.append(f"{emoji} {status.host}{latency}{error}")
         
+        # Серверы, отключённые circuit breaker'ом по ошибкам SSH
+        open_breakers = breakers.get_open()
+        if open_breakers:
+            lines.append("\n⛔ *SSH недоступен:* " + ", ".join(open_breakers))
+        
         return "\n".join(lines)
 
 
@@ -0,0 +1,244 @@
+"""
+Пул заготовленных конфигов (warm pool).
+
+Создание конфига — это запуск скрипта на сервере (curl ifconfig.me,
+wg syncconf / перезапуск xray, чтение файлов), пока пользователь ждёт.
+Поэтому на каждом сервере заранее создаются невыданные пиры по каждому
+протоколу. Выдача конфига — это атомарное изъятие заготовки из БД,
+а фоновая задача добирает пул до верхней отметки, когда он опускается
+ниже нижней.
+
+Заготовка живёт на сервере под своим именем (<протокол>_pool_<токен>),
+в Config оно сохраняется в peer_name — см. Config.remote_name.
+"""
+
+import asyncio
+import logging
+import secrets
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_session, PooledPeer, Server
+from services.settings import get_setting
+from services.wireguard_multi import WireGuardMultiService, ConfigData
+from services.capabilities import CapabilityService
+from config import LOCAL_MODE
+
+logger = logging.getLogger(__name__)
+
+# Отметки по умолчанию (переопределяются настройками warm_pool_low / warm_pool_high).
+# Пул выключен, пока warm_pool_low не задан: заготовки — живые пиры на серверах
+DEFAULT_LOW_WATERMARK = 0
+DEFAULT_HIGH_WATERMARK = 5
+
+# Без v2ray: каждый новый клиент Xray — перезапуск x-ui, который рвёт
+# соединения всех подключённых клиентов сервера
+PROTOCOLS = ("wg", "awg")
+
+# Идущие пополнения {(server_id, protocol): task}
+_replenishing: Dict[Tuple[int, str], asyncio.Task] = {}
+
+
+class WarmPoolService:
+    """Выдача конфигов из пула заготовок и его пополнение"""
+
+    @staticmethod
+    async def get_watermarks() -> Tuple[int, int]:
+        """(нижняя, верхняя) отметки; нижняя 0 — пул выключен"""
+        try:
+            low = int(await get_setting("warm_pool_low") or DEFAULT_LOW_WATERMARK)
+            high = int(await get_setting("warm_pool_high") or DEFAULT_HIGH_WATERMARK)
+        except ValueError:
+            low, high = DEFAULT_LOW_WATERMARK, DEFAULT_HIGH_WATERMARK
+        return max(low, 0), max(high, low)
+
+    @classmethod
+    async def claim(cls, server: Server, protocol: str, config_name: str) -> Optional[ConfigData]:
+        """
+        Забрать заготовку с сервера. Атомарность — через DELETE по id:
+        если строку уже забрал другой запрос, пробуем следующую.
+        """
+        async with async_session() as session:
+            while True:
+                result = await session.execute(
+                    select(PooledPeer)
+                    .where(PooledPeer.server_id == server.id, PooledPeer.protocol_type == protocol)
+                    .order_by(PooledPeer.id.asc())
+                    .limit(1)
+                )
+                peer = result.scalar_one_or_none()
+                if peer is None:
+                    return None
+
+                deleted = await session.execute(delete(PooledPeer).where(PooledPeer.id == peer.id))
+                await session.commit()
+                if deleted.rowcount == 1:
+                    break
+
+        config_content = peer.config_content
+        if protocol == "v2ray":
+            # Подпись ссылки — имя конфига пользователя, а не заготовки
+            config_content = config_content.replace(f"#{peer.peer_name}", f"#{config_name}")
+
+        logger.info(f"Конфиг {config_name} выдан из пула ({peer.peer_name} на {server.name})")
+        return ConfigData(
+            name=config_name,
+            public_key=peer.public_key,
+            preshared_key=peer.preshared_key,
+            allowed_ips=peer.allowed_ips,
+            client_ip=peer.client_ip,
+            config_content=config_content,
+            server_id=server.id,
+            peer_name=peer.peer_name
+        )
+
+    @classmethod
+    async def issue(
+        cls,
+        config_name: str,
+        server: Server,
+        protocol: str,
+        session: Optional[AsyncSession] = None
+    ) -> Tuple[bool, Optional[ConfigData], str]:
+        """
+        Выдать конфиг на сервере: из пула, а если он пуст — обычным созданием на сервере.
+        После выдачи пул пополняется в фоне.
+        """
+        if not LOCAL_MODE:
+            config_data = await cls.claim(server, protocol, config_name)
+            if config_data:
+                cls.replenish_in_background(server, protocol)
+                return True, config_data, "Конфиг выдан из пула"
+
+        if protocol == "v2ray":
+            result = await WireGuardMultiService.create_v2ray_config(config_name, server)
+        elif protocol == "awg":
+            result = await WireGuardMultiService.create_awg_config(config_name, server)
+        elif session is not None:
+            result = await WireGuardMultiService.create_config(config_name, session, server)
+        else:
+            async with async_session() as own_session:
+                result = await WireGuardMultiService.create_config(config_name, own_session, server)
+
+        if not LOCAL_MODE and result[0]:
+            cls.replenish_in_background(server, protocol)
+        return result
+
+    @classmethod
+    async def _create_peer(cls, server: Server, protocol: str) -> bool:
+        """Создать одну заготовку на сервере и записать её в пул"""
+        # Префикс протокола — по нему delete_config определяет тип конфига
+        peer_name = f"{protocol}_pool_{secrets.token_hex(4)}"
+        if protocol == "v2ray":
+            success, config_data, msg = await WireGuardMultiService.create_v2ray_config(peer_name, server)
+        elif protocol == "awg":
+            success, config_data, msg = await WireGuardMultiService.create_awg_config(peer_name, server)
+        else:
+            async with async_session() as session:
+                success, config_data, msg = await WireGuardMultiService.create_config(peer_name, session, server)
+
+        if not success or not config_data:
+            logger.warning(f"Не удалось создать заготовку {protocol} на {server.name}: {msg}")
+            return False
+
+        async with async_session() as session:
+            session.add(PooledPeer(
+                server_id=server.id,
+                protocol_type=protocol,
+                peer_name=peer_name,
+                public_key=config_data.public_key,
+                preshared_key=config_data.preshared_key or "",
+                allowed_ips=config_data.allowed_ips or "",
+                client_ip=config_data.client_ip or "",
+                config_content=config_data.config_content or ""
+            ))
+            await session.commit()
+        return True
+
+    @classmethod
+    async def replenish(cls, server: Server, protocol: str) -> int:
+        """Добрать пул сервера по протоколу до верхней отметки; возвращает число созданных"""
+        low, high = await cls.get_watermarks()
+        if low == 0 or protocol not in PROTOCOLS:
+            return 0
+
+        async with async_session() as session:
+            ready = (await session.execute(
+                select(func.count(PooledPeer.id))
+                .where(PooledPeer.server_id == server.id, PooledPeer.protocol_type == protocol)
+            )).scalar() or 0
+            if ready >= low:
+                return 0
+
+            # Заготовки занимают места на сервере — не превышаем max_clients
+            fresh = await session.get(Server, server.id)
+            clients = fresh.client_count if fresh else server.client_count
+            pooled = (await session.execute(
+                select(func.count(PooledPeer.id)).where(PooledPeer.server_id == server.id)
+            )).scalar() or 0
+
+        to_create = min(high - ready, server.max_clients - clients - pooled)
+        created = 0
+        for _ in range(max(to_create, 0)):
+            if not await cls._create_peer(server, protocol):
+                break
+            created += 1
+
+        if created:
+            logger.info(f"Пул {protocol} на {server.name} пополнен: +{created}")
+        return created
+
+    @classmethod
+    def replenish_in_background(cls, server: Server, protocol: str) -> None:
+        key = (server.id, protocol)
+        if key in _replenishing:
+            return
+        task = asyncio.create_task(cls.replenish(server, protocol))
+        _replenishing[key] = task
+        task.add_done_callback(lambda _: _replenishing.pop(key, None))
+
+    @classmethod
+    async def replenish_all(cls) -> None:
+        """Пополнить пулы всех активных серверов по всем поддерживаемым протоколам"""
+        if LOCAL_MODE:
+            return
+
+        low, _ = await cls.get_watermarks()
+        if low == 0:
+            return
+
+        async with async_session() as session:
+            result = await session.execute(select(Server).where(Server.is_active == True))
+            servers = result.scalars().all()
+
+        async def replenish_server(server: Server):
+            caps = await CapabilityService.get(server)
+            # Протоколы одного сервера — по очереди, чтобы не гонять скрипты параллельно
+            for protocol in PROTOCOLS:
+                if caps.supports(protocol):
+                    await cls.replenish(server, protocol)
+
+        results = await asyncio.gather(*(replenish_server(s) for s in servers), return_exceptions=True)
+        for server, result in zip(servers, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка пополнения пула на {server.name}: {result}")
+
+    @staticmethod
+    async def discard_server(session: AsyncSession, server_id: int) -> None:
+        """Забыть заготовки сервера (сервер удаляется)"""
+        await session.execute(delete(PooledPeer).where(PooledPeer.server_id == server_id))
+
+    @staticmethod
+    async def get_stats() -> Dict[int, Dict[str, int]]:
+        """Размер пула: {server_id: {протокол: заготовок}}"""
+        async with async_session() as session:
+            result = await session.execute(
+                select(PooledPeer.server_id, PooledPeer.protocol_type, func.count(PooledPeer.id))
+                .group_by(PooledPeer.server_id, PooledPeer.protocol_type)
+            )
+            stats: Dict[int, Dict[str, int]] = {}
+            for server_id, protocol, count in result.all():
+                stats.setdefault(server_id, {})[protocol] = count
+            return stats
@@ -0,0 +1,96 @@
+"""
+Разбор машиночитаемого вывода `wg show <iface> dump`.
+
+В отличие от обычного `wg show` здесь точные счётчики в байтах и
+handshake в виде unix-времени, без округления "1.23 GiB" и разбора
+строк вида "2 minutes, 3 seconds ago".
+"""
+
+import time
+from typing import Dict, NamedTuple, Optional
+
+
+class PeerInfo(NamedTuple):
+    """Состояние пира из одной строки dump"""
+    public_key: str
+    endpoint: Optional[str]
+    allowed_ips: Optional[str]
+    latest_handshake: int  # unix-время, 0 — handshake не было
+    received: int
+    sent: int
+
+
+class PeerTable:
+    """Снимок пиров одного сервера на момент fetched_at"""
+
+    __slots__ = ("server_id", "fetched_at", "peers")
+
+    def __init__(self, server_id: Optional[int], peers: Dict[str, PeerInfo], fetched_at: Optional[float] = None):
+        self.server_id = server_id
+        self.peers = peers
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+
+    def handshake_ago(self, peer: PeerInfo) -> Optional[int]:
+        """Секунд с последнего handshake (None — никогда не подключался)"""
+        if not peer.latest_handshake:
+            return None
+        return max(0, int(self.fetched_at) - peer.latest_handshake)
+
+    def traffic(self) -> Dict[str, Dict[str, int]]:
+        """Трафик в формате get_traffic_stats: {public_key: {'received', 'sent'}}"""
+        return {
+            key: {'received': peer.received, 'sent': peer.sent}
+            for key, peer in self.peers.items()
+        }
+
+    def status(self) -> Dict[str, Dict]:
+        """Статус пиров в формате get_peers_status"""
+        return {
+            key: {
+                'received': peer.received,
+                'sent': peer.sent,
+                'latest_handshake': self.handshake_ago(peer),  # секунд назад
+                'latest_handshake_at': peer.latest_handshake or None,  # unix-время
+                'endpoint': peer.endpoint,
+                'allowed_ips': peer.allowed_ips
+            }
+            for key, peer in self.peers.items()
+        }
+
+
+def _none_if_empty(value: str) -> Optional[str]:
+    return None if value in ("", "(none)") else value
+
+
+def parse_wg_dump(output: str) -> Dict[str, PeerInfo]:
+    """
+    Разобрать вывод `wg show <iface> dump` (или `wg show all dump`).
+
+    Первая строка интерфейса (4 поля) пропускается, строки пиров:
+    public-key, preshared-key, endpoint, allowed-ips, latest-handshake,
+    transfer-rx, transfer-tx, persistent-keepalive.
+    У `all dump` перед ними ещё имя интерфейса.
+    """
+    peers: Dict[str, PeerInfo] = {}
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if len(fields) == 9:
+            fields = fields[1:]
+        if len(fields) != 8:
+            continue
+        try:
+            handshake = int(fields[4])
+            received = int(fields[5])
+            sent = int(fields[6])
+        except ValueError:
+            continue
+        public_key = fields[0]
+        peers[public_key] = PeerInfo(
+            public_key=public_key,
+            endpoint=_none_if_empty(fields[2]),
+            allowed_ips=_none_if_empty(fields[3]),
+            latest_handshake=handshake,
+            received=received,
+            sent=sent
+        )
+    return peers
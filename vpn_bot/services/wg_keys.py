@@ -0,0 +1,70 @@
+"""
+Ключи и клиентский конфиг WireGuard на стороне бота.
+
+Ключи клиента генерируются ботом (X25519, как `wg genkey` / `wg pubkey`),
+конфиг собирается по шаблону из кэша возможностей сервера (публичный ключ,
+внешний адрес, порт), а на сервер уходит только строка пира.
+Приватный ключ на сервере не хранится — конфиг живёт в БД бота.
+"""
+
+import base64
+import os
+from typing import Tuple
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+CLIENT_DNS = "1.1.1.1, 8.8.8.8"
+PERSISTENT_KEEPALIVE = 25
+
+CLIENT_CONFIG_TEMPLATE = """[Interface]
+PrivateKey = {private_key}
+Address = {address}
+DNS = {dns}
+
+[Peer]
+PublicKey = {server_public_key}
+PresharedKey = {preshared_key}
+Endpoint = {endpoint}
+AllowedIPs = 0.0.0.0/0
+PersistentKeepalive = {keepalive}
+"""
+
+
+def generate_keypair() -> Tuple[str, str]:
+    """(приватный, публичный) ключи в base64"""
+    private = X25519PrivateKey.generate()
+    private_raw = private.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    public_raw = private.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    )
+    return base64.b64encode(private_raw).decode("ascii"), base64.b64encode(public_raw).decode("ascii")
+
+
+def generate_psk() -> str:
+    """Preshared key (аналог `wg genpsk`)"""
+    return base64.b64encode(os.urandom(32)).decode("ascii")
+
+
+def render_client_config(
+    private_key: str,
+    address: str,
+    server_public_key: str,
+    preshared_key: str,
+    endpoint: str
+) -> str:
+    """Клиентский .conf; address — адрес с префиксом подсети (10.7.0.5/24)"""
+    return CLIENT_CONFIG_TEMPLATE.format(
+        private_key=private_key,
+        address=address,
+        dns=CLIENT_DNS,
+        server_public_key=server_public_key,
+        preshared_key=preshared_key,
+        endpoint=endpoint,
+        keepalive=PERSISTENT_KEEPALIVE
+    )
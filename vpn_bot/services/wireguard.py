@@ -9,6 +9,7 @@ import logging
 from typing import Tuple, Dict
 
 from config import WG_INTERFACE, CLIENT_DIR, REMOVE_SCRIPT, LOCAL_MODE
+from services.wg_dump import PeerTable, parse_wg_dump
 
 logger = logging.getLogger(__name__)
 
@@ -99,7 +100,7 @@ class WireGuardService:
         
         try:
             result = subprocess.run(
-                ['wg', 'show', WG_INTERFACE],
+                ['wg', 'show', WG_INTERFACE, 'dump'],
                 capture_output=True,
                 text=True,
                 timeout=10
@@ -108,44 +109,12 @@ class WireGuardService:
             if result.returncode != 0:
                 return {}
             
-            peers = {}
-            current_peer = None
-            
-            for line in result.stdout.split('\n'):
-                line = line.strip()
-                if line.startswith('peer:'):
-                    current_peer = line.split()[-1]
-                    peers[current_peer] = {'received': 0, 'sent': 0}
-                elif current_peer and 'transfer:' in line:
-                    parts = line.replace(',', '').split()
-                    if 'received' in parts:
-                        rx_idx = parts.index('received')
-                        rx_value = float(parts[rx_idx - 2])
-                        rx_unit = parts[rx_idx - 1].lower()
-                        peers[current_peer]['received'] = cls._convert_to_bytes(rx_value, rx_unit)
-                    
-                    if 'sent' in parts:
-                        tx_idx = parts.index('sent')
-                        tx_value = float(parts[tx_idx - 2])
-                        tx_unit = parts[tx_idx - 1].lower()
-                        peers[current_peer]['sent'] = cls._convert_to_bytes(tx_value, tx_unit)
-            
-            return peers
+            return PeerTable(None, parse_wg_dump(result.stdout)).traffic()
             
         except Exception as e:
             logger.error(f"Ошибка получения статистики: {e}")
             return {}
     
-    @staticmethod
-    def _convert_to_bytes(value: float, unit: str) -> int:
-        units = {
-            'b': 1,
-            'kib': 1024,
-            'mib': 1024 * 1024,
-            'gib': 1024 * 1024 * 1024
-        }
-        return int(value * units.get(unit.lower(), 1))
-    
     @staticmethod
     def format_bytes(size: int) -> str:
         for unit in ['B', 'KiB', 'MiB', 'GiB']:
@@ -2,20 +2,74 @@
 WireGuard сервис с поддержкой нескольких серверов через SSH
 """
 import asyncio
+import base64
+import ipaddress
+import json
 import re
+import shlex
+import time
 import logging
-from typing import Optional, Tuple, Dict, List
+from typing import Any, Optional, Tuple, Dict, List, Callable, Awaitable, TypeVar
 from dataclasses import dataclass
 
 import asyncssh
-from sqlalchemy import select, func
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from database import async_session
 from database.models import Server, Config
 from config import LOCAL_MODE
+from services.ssh_pool import ssh_pool, RECONNECT_ERRORS
+from services.remote_agent import AgentRegistry, AgentError, AGENT_PATH, AGENT_SOURCE
+from services.wg_dump import PeerTable, parse_wg_dump
+from services.collectors import COLLECTORS
+from services.async_cache import AsyncCache
+from services.bulkhead import bulkheads
+from services.circuit_breaker import breakers, CircuitOpenError
+from services.capabilities import CapabilityService, ServerCapabilities
+from services.ipam import IpamService, IpLease
+from services.wg_keys import generate_keypair, generate_psk, render_client_config
+from services.qr import QrService
+from services.placement import PlacementEngine, record_load
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+class CommandTimeoutError(asyncio.TimeoutError):
+    """Команда не уложилась в таймаут: сервер отвечает, просто команда долгая"""
+
+
+# Ошибки, означающие что сервер недоступен (считаются circuit breaker'ом).
+# Таймаут здесь — только подключения/handshake; CommandTimeoutError ловится раньше
+CONNECTIVITY_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncssh.DisconnectError,
+    asyncssh.ChannelOpenError,
+)
+
+# Ключ WireGuard: 32 байта в base64
+_WG_KEY_RE = re.compile(r"^[A-Za-z0-9+/]{42}[AEIMQUYcgkosw048]=$")
+# Сколько пиров удалять за один вызов wg set
+BULK_PEERS_CHUNK = 200
+
+AWG_CONF_PATH = "/etc/amnezia/amneziawg/awg0.conf"
+
+# Клиенты Xray хранятся в БД панели X-UI (см. v2ray-*-client-xui.sh)
+XUI_DB = "/etc/x-ui/x-ui.db"
+XUI_INBOUND_TAG = "inbound-443"
+XRAY_CLIENT_DIR = "/usr/local/etc/xray/clients"
+
+PEER_TABLE_TTL_SECONDS = 15
+PEER_TABLE_STALE_SECONDS = 45
+PEER_TABLE_NEGATIVE_SECONDS = 10
+
+# Последние снятые таблицы пиров {server_id: PeerTable}
+_peer_tables: AsyncCache[PeerTable] = AsyncCache(
+    "peer_tables", PEER_TABLE_TTL_SECONDS, PEER_TABLE_STALE_SECONDS, PEER_TABLE_NEGATIVE_SECONDS
+)
+
 
 @dataclass
 class ConfigData:
@@ -26,8 +80,8 @@ class ConfigData:
     allowed_ips: str
     client_ip: str
     config_content: str  # содержимое .conf файла
-    qr_content: bytes    # содержимое QR PNG
     server_id: int
+    peer_name: Optional[str] = None  # имя пира на сервере, если отличается от name (пул заготовок)
 
 
 class WireGuardMultiService:
@@ -36,44 +90,19 @@ class WireGuardMultiService:
     @classmethod
     async def get_best_server(cls, session: AsyncSession) -> Optional[Server]:
         """
-        Умная балансировка нагрузки.
-        Алгоритм:
-        1. Только активные серверы с свободными местами
-        2. Вычисляем % заполненности каждого сервера
-        3. Сортируем по: priority (desc), % заполненности (asc)
-        
-        Это обеспечивает равномерное распределение по всем серверам,
-        а не заполнение одного сервера до конца.
+        Лучший сервер для нового клиента — по оценке PlacementEngine
+        (priority, заполненность, загрузка, задержка, состояние breaker'а).
         """
-        stmt = (
-            select(
-                Server,
-                func.count(Config.id).label("client_count"),
-                # % заполненности: clients / max_clients * 100
-                (func.count(Config.id) * 100.0 / Server.max_clients).label("fill_percent")
-            )
-            .outerjoin(Config, (Config.server_id == Server.id) & (Config.is_active == True))
-            .where(Server.is_active == True)
-            .group_by(Server.id)
-            .having(func.count(Config.id) < Server.max_clients)
-            .order_by(
-                Server.priority.desc(),  # Сначала высокий приоритет
-                (func.count(Config.id) * 100.0 / Server.max_clients).asc()  # Потом менее заполненные
-            )
-        )
-        
-        result = await session.execute(stmt)
-        row = result.first()
-        
-        if row:
-            server = row[0]
-            client_count = row[1]
-            fill_percent = row[2] if row[2] else 0
-            logger.info(f"Выбран сервер {server.name}: {client_count}/{server.max_clients} ({fill_percent:.1f}%)")
-            return server
-        
-        return None
+        return await PlacementEngine.choose()
     
+    @classmethod
+    async def get_free_capacity(cls, session: AsyncSession) -> List[Tuple[Server, int, int]]:
+        """
+        Свободные места всех доступных серверов (из счётчиков PlacementEngine):
+        [(сервер, клиентов, свободно)] — только серверы, где есть места.
+        """
+        return await PlacementEngine.get_free_capacity()
+
     @classmethod
     async def get_server_by_id(cls, session: AsyncSession, server_id: int) -> Optional[Server]:
         """Получить сервер по ID"""
@@ -88,83 +117,84 @@ class WireGuardMultiService:
     
     @classmethod
     async def get_server_client_count(cls, session: AsyncSession, server_id: int) -> int:
-        """Получить количество активных клиентов на сервере"""
+        """Получить количество активных клиентов на сервере (счётчик Server.active_clients)"""
         result = await session.execute(
-            select(func.count(Config.id))
-            .where(Config.server_id == server_id, Config.is_active == True)
+            select(Server.active_clients).where(Server.id == server_id)
         )
         return result.scalar() or 0
     
     @classmethod
     async def get_best_server_for_protocol(cls, session: AsyncSession, protocol: str) -> Optional[Server]:
         """
-        Выбрать лучший сервер с поддержкой указанного протокола.
-        Учитывает заполненность и приоритет серверов.
+        Выбрать лучший сервер с поддержкой указанного протокола
+        (оценка PlacementEngine, серверы без протокола исключаются).
         
         protocol: "wg", "awg", "v2ray"
         """
-        # Получаем все активные серверы с подсчётом клиентов
-        stmt = (
-            select(
-                Server,
-                func.count(Config.id).label("client_count"),
-                (func.count(Config.id) * 100.0 / Server.max_clients).label("fill_percent")
-            )
-            .outerjoin(Config, (Config.server_id == Server.id) & (Config.is_active == True))
-            .where(Server.is_active == True)
-            .group_by(Server.id)
-            .having(func.count(Config.id) < Server.max_clients)
-            .order_by(
-                Server.priority.desc(),
-                (func.count(Config.id) * 100.0 / Server.max_clients).asc()
-            )
-        )
-        
-        result = await session.execute(stmt)
-        rows = result.all()
-        
-        # Проверяем каждый сервер на поддержку протокола
-        for row in rows:
-            server = row[0]
-            client_count = row[1]
-            fill_percent = row[2] if row[2] else 0
-            
-            if protocol == "v2ray":
-                if await cls.check_v2ray_available(server):
-                    logger.info(f"Выбран сервер {server.name} для V2Ray: {client_count}/{server.max_clients} ({fill_percent:.1f}%)")
-                    return server
-            elif protocol == "awg":
-                if await cls.check_awg_available(server):
-                    logger.info(f"Выбран сервер {server.name} для AWG: {client_count}/{server.max_clients} ({fill_percent:.1f}%)")
-                    return server
-            else:  # wg
-                logger.info(f"Выбран сервер {server.name} для WG: {client_count}/{server.max_clients} ({fill_percent:.1f}%)")
-                return server
-        
-        return None
+        return await PlacementEngine.choose(protocol)
     
     @classmethod
-    async def _ssh_connect(cls, server: Server) -> asyncssh.SSHClientConnection:
-        """Создать SSH соединение к серверу"""
-        return await asyncssh.connect(
-            server.host,
-            port=server.ssh_port,
-            username=server.ssh_user,
-            password=server.ssh_password,
-            known_hosts=None,
-            connect_timeout=10
-        )
+    async def _with_connection(cls, server: Server, operation: Callable[[asyncssh.SSHClientConnection], Awaitable[T]]) -> T:
+        """
+        Выполнить operation(conn) на соединении из пула в пределах лимита операций сервера.
+        Если переиспользованное соединение оказалось мёртвым — переподключаемся один раз.
+        Если сервер помечен недоступным (circuit breaker) — сразу CircuitOpenError.
+        """
+        breakers.check(server)
+        try:
+            async with bulkheads.slot(server):
+                for attempt in range(2):
+                    async with ssh_pool.connection(server) as conn:
+                        try:
+                            result = await operation(conn)
+                            break
+                        except asyncio.TimeoutError as e:
+                            if isinstance(e, CommandTimeoutError):
+                                raise
+                            # Соединение уже установлено — таймаут самой операции
+                            raise CommandTimeoutError(str(e)) from e
+                        except RECONNECT_ERRORS as e:
+                            if attempt:
+                                raise
+                            ssh_pool.discard(conn)
+                            logger.warning(f"SSH соединение к {server.host} оборвалось ({e}), переподключаемся")
+        except CommandTimeoutError:
+            # Медленная команда на живом сервере — не повод размыкать breaker
+            breakers.release_probe(server)
+            raise
+        except CONNECTIVITY_ERRORS as e:
+            breakers.record_failure(server, str(e) or type(e).__name__)
+            raise
+        except asyncssh.Error:
+            # Ошибка уровня команды/SFTP — сам сервер отвечает
+            breakers.record_success(server)
+            raise
+        except BaseException:
+            breakers.release_probe(server)
+            raise
+        
+        breakers.record_success(server)
+        return result
     
     @classmethod
-    async def _ssh_execute(cls, server: Server, command: str) -> Tuple[bool, str, str]:
+    async def _ssh_execute(cls, server: Server, command: str, timeout: int = 30) -> Tuple[bool, str, str]:
         """Выполнить команду на удалённом сервере через SSH"""
+        async def run(conn: asyncssh.SSHClientConnection):
+            # Отмена conn.run() не закрывает канал, и он висел бы на общем соединении
+            # пула до исчерпания MaxSessions — по таймауту закрываем его сами
+            async with conn.create_process(command) as process:
+                try:
+                    return await asyncio.wait_for(process.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    process.close()
+                    raise
+        
         try:
-            async with await cls._ssh_connect(server) as conn:
-                result = await asyncio.wait_for(
-                    conn.run(command),
-                    timeout=30
-                )
-                return result.exit_status == 0, result.stdout or "", result.stderr or ""
+            result = await cls._with_connection(server, run)
+            return result.exit_status == 0, result.stdout or "", result.stderr or ""
+        except CircuitOpenError as e:
+            logger.debug(f"SSH to {server.host} skipped: {e}")
+            return False, "", str(e)
         except asyncio.TimeoutError:
             logger.error(f"SSH timeout to {server.host}")
             return False, "", "Таймаут SSH соединения"
@@ -175,18 +205,98 @@ class WireGuardMultiService:
             logger.error(f"Unexpected error connecting to {server.host}: {e}")
             return False, "", str(e)
     
+    @classmethod
+    async def _agent_call(cls, server: Server, method: str, **params) -> Optional[Tuple[bool, Any, str]]:
+        """
+        Вызвать метод агента на сервере.
+        Возвращает (успех, результат, ошибка) или None, если агента нет — тогда действуем через shell.
+        """
+        if not breakers.is_available(server):
+            return None
+        agent = await AgentRegistry.get(server)
+        if not agent:
+            return None
+        try:
+            async with bulkheads.slot(server):
+                return await agent.call(method, **params)
+        except AgentError as e:
+            logger.warning(f"Агент на {server.name} не ответил ({e}), переходим на shell")
+            AgentRegistry.mark_failed(server)
+            return None
+    
     @classmethod
     async def _ssh_read_file(cls, server: Server, path: str) -> Optional[bytes]:
         """Прочитать файл с удалённого сервера"""
+        reply = await cls._agent_call(server, "read_file", path=path)
+        if reply is not None:
+            ok, result, error = reply
+            if ok:
+                return base64.b64decode(result)
+            logger.error(f"Agent read error from {server.host}:{path}: {error}")
+            return None
+        
+        async def read(conn: asyncssh.SSHClientConnection) -> bytes:
+            async with conn.start_sftp_client() as sftp:
+                async with sftp.open(path, 'rb') as f:
+                    return await f.read()
+        
         try:
-            async with await cls._ssh_connect(server) as conn:
-                async with conn.start_sftp_client() as sftp:
-                    async with sftp.open(path, 'rb') as f:
-                        return await f.read()
+            return await cls._with_connection(server, read)
         except Exception as e:
             logger.error(f"SFTP read error from {server.host}:{path}: {e}")
             return None
     
+    @staticmethod
+    def _bundle_command(script_cmd: str, sections: Dict[str, str]) -> str:
+        """
+        Собрать shell-команду «за один заход»: запускает скрипт и сразу
+        возвращает его вывод и нужные файлы.
+        Ответ — по строке на секцию: «<имя> <base64>». Вывод скрипта идёт в секцию stdout.
+        """
+        lines = [
+            'OUT=$(mktemp)',
+            f'{script_cmd} > "$OUT" || {{ rc=$?; cat "$OUT" >&2; rm -f "$OUT"; exit $rc; }}',
+            'printf "stdout "; base64 -w0 < "$OUT"; echo',
+            'rm -f "$OUT"',
+        ]
+        return "\n".join(lines) + "\n" + WireGuardMultiService._sections_command(sections)
+    
+    @staticmethod
+    def _sections_command(sections: Dict[str, str]) -> str:
+        """Выполнить команды и вывести результат каждой строкой «<имя> <base64>» (ошибки — пустая секция)"""
+        return "\n".join(
+            f'printf "{name} "; {{ {command}; }} 2>/dev/null | base64 -w0; echo'
+            for name, command in sections.items()
+        )
+    
+    @staticmethod
+    def _parse_bundle(stdout: str) -> Dict[str, bytes]:
+        """Разобрать ответ _bundle_command в {секция: содержимое}"""
+        sections = {}
+        for line in stdout.splitlines():
+            name, _, payload = line.strip().partition(' ')
+            if not name:
+                continue
+            try:
+                sections[name] = base64.b64decode(payload) if payload else b""
+            except ValueError:
+                logger.warning(f"Не удалось декодировать секцию {name} ответа сервера")
+                sections[name] = b""
+        return sections
+    
+    @classmethod
+    async def _ssh_execute_bundle(
+        cls,
+        server: Server,
+        script_cmd: str,
+        sections: Dict[str, str]
+    ) -> Tuple[bool, Dict[str, bytes], str]:
+        """Запустить скрипт и получить его вывод и файлы одним SSH запросом"""
+        success, stdout, stderr = await cls._ssh_execute(server, cls._bundle_command(script_cmd, sections))
+        if not success:
+            return False, {}, stderr
+        return True, cls._parse_bundle(stdout), stderr
+    
     @classmethod
     async def check_server_connection(cls, server: Server) -> Tuple[bool, str]:
         """Проверить подключение к серверу"""
@@ -208,7 +318,33 @@ class WireGuardMultiService:
         if success:
             return True, stdout.strip()
         return False, "WireGuard не установлен"
-    
+
+    @classmethod
+    async def sample_load(cls, server: Server) -> bool:
+        """Замерить загрузку сервера (loadavg на ядро и счётчик трафика) для выбора сервера"""
+        if LOCAL_MODE:
+            return False
+
+        success, stdout, _ = await cls._ssh_execute(
+            server,
+            "cut -d' ' -f1 /proc/loadavg; nproc; "
+            "awk 'NR>2 && $1 !~ /^lo:/ {sub(/^[^:]*:/, \"\"); rx+=$1; tx+=$9} END {print rx+tx}' /proc/net/dev",
+            timeout=15
+        )
+        if not success:
+            return False
+
+        try:
+            loadavg, cores, net_total = stdout.split()[:3]
+            cpu = float(loadavg) / max(int(cores), 1)
+            net_total_bytes = int(float(net_total))
+        except ValueError:
+            logger.warning(f"Не удалось разобрать загрузку сервера {server.name}: {stdout!r}")
+            return False
+
+        record_load(server.id, cpu, net_total_bytes)
+        return True
+
     @classmethod
     async def create_config(
         cls, 
@@ -227,7 +363,6 @@ class WireGuardMultiService:
                 allowed_ips="10.7.0.100/32",
                 client_ip="10.7.0.100",
                 config_content="[Interface]\nPrivateKey = LOCAL_MODE\nAddress = 10.7.0.100/24\nDNS = 1.1.1.1",
-                qr_content=b"",
                 server_id=0
             ), "Конфиг создан (LOCAL_MODE)"
         
@@ -239,36 +374,48 @@ class WireGuardMultiService:
         
         logger.info(f"Создание конфига {username} на сервере {server.name} ({server.host})")
         
-        # Создать конфиг на удалённом сервере
-        success, stdout, stderr = await cls._ssh_execute(
-            server, 
-            f"{server.add_script} {username}"
+        # Адрес выдаёт IPAM; без него скрипт выберет адрес сам
+        lease = await IpamService.allocate(server, "wg", username)
+        
+        # Ключи и конфиг — на стороне бота, если известны ключ и адрес сервера
+        if lease:
+            caps = await CapabilityService.get(server)
+            if caps.endpoint and caps.wg_port and caps.wg_public_key and _WG_KEY_RE.match(caps.wg_public_key):
+                return await cls._create_config_with_bot_keys(username, server, lease, caps)
+        
+        # Создаём конфиг и сразу забираем .conf и блок пира из wg0.conf — один SSH запрос
+        name = shlex.quote(username)
+        add_cmd = f"{server.add_script} {name}"
+        if lease:
+            add_cmd += f" {lease.cidr}"
+        success, bundle, stderr = await cls._ssh_execute_bundle(
+            server,
+            add_cmd,
+            {
+                'peer': f"awk -v n={name} '$0 == \"# BEGIN_PEER \" n {{p=1}} p {{print}} $0 == \"# END_PEER \" n {{p=0}}' {server.wg_conf_path}",
+                'conf': f"cat {server.client_dir}/{name}.conf",
+            }
         )
         
         if not success:
             logger.error(f"Ошибка создания конфига на {server.host}: {stderr}")
+            if lease:
+                await IpamService.release(server, username)
             return False, None, stderr or "Ошибка создания конфига"
         
-        # Прочитать созданные файлы
-        config_path = f"{server.client_dir}/{username}.conf"
-        qr_path = f"{server.client_dir}/{username}.png"
-        
-        config_content = await cls._ssh_read_file(server, config_path)
-        qr_content = await cls._ssh_read_file(server, qr_path)
-        
+        config_content = bundle.get('conf')
         if not config_content:
+            await cls.discard_peer(server, username, "wg")
             return False, None, "Не удалось прочитать созданный конфиг"
         
-        # Парсим данные из wg0.conf на сервере
-        wg_conf_content = await cls._ssh_read_file(server, server.wg_conf_path)
-        if not wg_conf_content:
-            return False, None, "Не удалось прочитать wg0.conf"
-        
-        parsed = cls._parse_peer_from_wg_conf(wg_conf_content.decode('utf-8'), username)
+        parsed = cls._parse_peer_from_wg_conf(bundle.get('peer', b"").decode('utf-8'), username)
         
         if not parsed:
+            await cls.discard_peer(server, username, "wg")
             return False, None, "Не удалось распарсить данные пира"
         
+        await IpamService.confirm(server, "wg", username, lease, parsed['client_ip'])
+        
         return True, ConfigData(
             name=username,
             public_key=parsed['public_key'],
@@ -276,10 +423,112 @@ class WireGuardMultiService:
             allowed_ips=parsed['allowed_ips'],
             client_ip=parsed['client_ip'],
             config_content=config_content.decode('utf-8'),
-            qr_content=qr_content or b"",
             server_id=server.id
         ), f"Конфиг создан на сервере {server.name}"
     
+    @classmethod
+    async def discard_peer(
+        cls,
+        server: Server,
+        username: str,
+        protocol: str,
+        public_key: Optional[str] = None
+    ) -> None:
+        """
+        Пир создан на сервере, но конфиг не получился (результат не разобран,
+        запись в БД не удалась): убрать пира, чтобы он не остался сиротой,
+        и вернуть адрес в IPAM
+        """
+        logger.warning(f"Конфиг {username} создан на {server.name}, но не сохранён — удаляем")
+        try:
+            await cls.delete_config(username, server, public_key, protocol_type=protocol)
+        except Exception as e:
+            logger.error(f"Не удалось удалить недосозданный конфиг {username} с {server.name}: {e}")
+        await IpamService.release(server, username)
+    
+    @classmethod
+    async def _create_config_with_bot_keys(
+        cls,
+        username: str,
+        server: Server,
+        lease: IpLease,
+        caps: ServerCapabilities
+    ) -> Tuple[bool, Optional[ConfigData], str]:
+        """
+        Создать конфиг с ключами, сгенерированными ботом: на сервер уходит только пир
+        (wg set + блок BEGIN_PEER в конфиге), клиентский .conf собирается по шаблону.
+        """
+        private_key, public_key = generate_keypair()
+        preshared_key = generate_psk()
+        allowed_ips = f"{lease.address}/32"
+        
+        name = shlex.quote(username)
+        cmd = (
+            f"PSK_FILE=$(mktemp) && printf '%s\\n' {preshared_key} > \"$PSK_FILE\" && "
+            f"wg set {server.wg_interface} peer {public_key} preshared-key \"$PSK_FILE\" allowed-ips {allowed_ips}; "
+            f"rc=$?; rm -f \"$PSK_FILE\"; [ $rc -eq 0 ] && "
+            f"printf '\\n# BEGIN_PEER %s\\n[Peer]\\nPublicKey = %s\\nPresharedKey = %s\\nAllowedIPs = %s\\n# END_PEER %s\\n' "
+            f"{name} {public_key} {preshared_key} {allowed_ips} {name} >> {shlex.quote(server.wg_conf_path)}"
+        )
+        success, stdout, stderr = await cls._ssh_execute(server, cmd)
+        if not success:
+            logger.error(f"Ошибка добавления пира {username} на {server.host}: {stderr}")
+            await IpamService.release(server, username)
+            return False, None, stderr or "Ошибка создания конфига"
+        
+        config_content = render_client_config(
+            private_key=private_key,
+            address=lease.cidr,
+            server_public_key=caps.wg_public_key,
+            preshared_key=preshared_key,
+            endpoint=f"{caps.endpoint}:{caps.wg_port}"
+        )
+        
+        return True, ConfigData(
+            name=username,
+            public_key=public_key,
+            preshared_key=preshared_key,
+            allowed_ips=allowed_ips,
+            client_ip=lease.address,
+            config_content=config_content,
+            server_id=server.id
+        ), f"Конфиг создан на сервере {server.name}"
+    
+    @classmethod
+    async def get_client_config(cls, config: Config, server: Server) -> Optional[str]:
+        """
+        Клиентский конфиг (для V2Ray — ссылка). Берётся из БД без обращения к серверу;
+        у старых конфигов читается с сервера один раз и сохраняется в БД.
+        """
+        if config.config_content:
+            return config.config_content
+        
+        if LOCAL_MODE:
+            return None
+        
+        protocol_type = config.protocol_type or "wg"
+        content = await cls.fetch_config_content(config.remote_name, server, protocol_type)
+        if not content and protocol_type != "v2ray":
+            content = await cls.regenerate_config_file(config.remote_name, server)
+        if not content:
+            return None
+        
+        async with async_session() as session:
+            await session.execute(
+                update(Config).where(Config.id == config.id).values(config_content=content)
+            )
+            await session.commit()
+        config.config_content = content
+        return content
+    
+    @classmethod
+    async def get_client_qr(cls, config: Config, server: Server) -> Optional[bytes]:
+        """QR-код клиентского конфига (PNG), рисуется локально"""
+        content = await cls.get_client_config(config, server)
+        if not content:
+            return None
+        return await QrService.get_png(content)
+    
     @classmethod
     async def fetch_config_content(cls, config_name: str, server: Server, protocol_type: str = "wg") -> Optional[str]:
         """Получить содержимое конфига с удалённого сервера"""
@@ -383,22 +632,6 @@ class WireGuardMultiService:
         
         return None
     
-    @classmethod
-    async def fetch_qr_content(cls, config_name: str, server: Server, protocol_type: str = "wg") -> Optional[bytes]:
-        """Получить QR-код конфига с удалённого сервера"""
-        if LOCAL_MODE:
-            return None
-        
-        # Определяем путь в зависимости от протокола
-        if protocol_type == "v2ray":
-            qr_path = f"/usr/local/etc/xray/clients/{config_name}.png"
-        elif protocol_type == "awg":
-            qr_path = f"/etc/amnezia/amneziawg/clients/{config_name}.png"
-        else:
-            qr_path = f"{server.client_dir}/{config_name}.png"
-        
-        return await cls._ssh_read_file(server, qr_path)
-    
     @classmethod
     def _parse_peer_from_wg_conf(cls, wg_content: str, username: str) -> Optional[Dict[str, str]]:
         """Парсинг данных пира из wg0.conf"""
@@ -462,10 +695,12 @@ class WireGuardMultiService:
         # Сначала отключаем пир из активного WireGuard (если есть public_key)
         if public_key:
             logger.info(f"Отключение пира {public_key[:20]}... перед удалением")
-            await cls._ssh_execute(
-                server,
-                f"wg set {server.wg_interface} peer {public_key} remove"
-            )
+            reply = await cls._agent_call(server, "remove_peer", interface=server.wg_interface, public_key=public_key)
+            if reply is None:
+                await cls._ssh_execute(
+                    server,
+                    f"wg set {server.wg_interface} peer {public_key} remove"
+                )
         
         # Затем удаляем файлы конфига через скрипт
         success, stdout, stderr = await cls._ssh_execute(
@@ -474,9 +709,12 @@ class WireGuardMultiService:
         )
         
         # Сохраняем конфигурацию WireGuard
-        await cls._ssh_execute(server, f"wg-quick save {server.wg_interface}")
+        reply = await cls._agent_call(server, "save", interface=server.wg_interface)
+        if reply is None:
+            await cls._ssh_execute(server, f"wg-quick save {server.wg_interface}")
         
         if success:
+            await IpamService.release(server, username)
             logger.info(f"Конфиг {username} успешно удалён с сервера {server.name}")
             return True, f"Конфиг удален с сервера {server.name}"
         
@@ -492,10 +730,14 @@ class WireGuardMultiService:
         
         logger.info(f"Отключение конфига на сервере {server.name} (peer: {public_key[:20]}...)")
         
-        success, stdout, stderr = await cls._ssh_execute(
-            server,
-            f"wg set {server.wg_interface} peer {public_key} remove"
-        )
+        reply = await cls._agent_call(server, "disable_peer", interface=server.wg_interface, public_key=public_key)
+        if reply is not None:
+            success, _, stderr = reply
+        else:
+            success, stdout, stderr = await cls._ssh_execute(
+                server,
+                f"wg set {server.wg_interface} peer {public_key} remove"
+            )
         
         if success:
             logger.info(f"Конфиг успешно отключен на {server.name}")
@@ -504,27 +746,129 @@ class WireGuardMultiService:
         
         return success, "Конфиг отключен" if success else stderr
     
+    @classmethod
+    async def remove_peers(
+        cls,
+        server: Server,
+        public_keys: List[str],
+        save: bool = True,
+        interface: Optional[str] = None
+    ) -> Tuple[List[str], Dict[str, str]]:
+        """
+        Убрать несколько пиров из интерфейса за один удалённый вызов и (по умолчанию) один wg-quick save.
+        Возвращает (удалённые ключи, {ключ: ошибка}).
+        """
+        interface = interface or server.wg_interface
+        keys = list(dict.fromkeys(k for k in public_keys if k))
+        
+        if LOCAL_MODE:
+            return keys, {}
+        
+        failed = {k: "Некорректный ключ" for k in keys if not _WG_KEY_RE.match(k)}
+        keys = [k for k in keys if k not in failed]
+        
+        if not keys:
+            return [], failed
+        
+        removed: List[str] = []
+        for start in range(0, len(keys), BULK_PEERS_CHUNK):
+            chunk = keys[start:start + BULK_PEERS_CHUNK]
+            # Сохраняем только после последней пачки
+            save_now = save and start + BULK_PEERS_CHUNK >= len(keys)
+            
+            reply = await cls._agent_call(
+                server, "remove_peers",
+                interface=interface, public_keys=chunk, save=save_now
+            )
+            if reply is not None:
+                success, result, error = reply
+                if success:
+                    removed.extend(result.get("removed", []))
+                    failed.update(result.get("failed", {}))
+                    if result.get("save_error"):
+                        logger.warning(f"Пиры удалены, но {interface} на {server.name} не сохранён: {result['save_error']}")
+                else:
+                    failed.update({k: error for k in chunk})
+                continue
+            
+            # Без агента: один shell вызов, при ошибке — поштучно
+            peers_args = " ".join(f"peer {k} remove" for k in chunk)
+            cmd = (
+                f"if wg set {interface} {peers_args} 2>/dev/null; then echo ALL_OK; "
+                f"else for k in {' '.join(chunk)}; do "
+                f"wg set {interface} peer \"$k\" remove >/dev/null 2>&1 && echo \"OK $k\" || echo \"FAIL $k\"; done; fi"
+            )
+            if save_now:
+                cmd += f"; wg-quick save {interface}"
+            success, stdout, stderr = await cls._ssh_execute(server, cmd, timeout=60)
+            
+            lines = stdout.split("\n")
+            if "ALL_OK" in lines:
+                removed.extend(chunk)
+                continue
+            chunk_removed = [line[3:] for line in lines if line.startswith("OK ")]
+            chunk_failed = [line[5:] for line in lines if line.startswith("FAIL ")]
+            removed.extend(chunk_removed)
+            failed.update({k: "wg set завершился с ошибкой" for k in chunk_failed})
+            # Ключи без ответа — команда не выполнилась вовсе
+            answered = set(chunk_removed) | set(chunk_failed)
+            failed.update({k: stderr or "Нет ответа от сервера" for k in chunk if k not in answered})
+        
+        logger.info(f"Пакетное удаление пиров на {server.name}: удалено {len(removed)}, ошибок {len(failed)}")
+        return removed, failed
+    
+    @classmethod
+    async def disable_configs(
+        cls,
+        server: Server,
+        public_keys: List[str],
+        interface: Optional[str] = None
+    ) -> Tuple[List[str], Dict[str, str]]:
+        """
+        Отключить несколько конфигов на сервере одним вызовом (AWG — с interface=awg0).
+        Как и disable_config, пиры остаются в конфиге на диске (без wg-quick save).
+        """
+        logger.info(f"Пакетное отключение {len(public_keys)} конфигов на сервере {server.name}")
+        return await cls.remove_peers(server, public_keys, save=False, interface=interface)
+    
     @classmethod
     async def enable_config(
         cls, 
         public_key: str, 
         preshared_key: str, 
         allowed_ips: str,
-        server: Server
+        server: Server,
+        interface: Optional[str] = None
     ) -> Tuple[bool, str]:
-        """Включить конфиг (добавить пир в WireGuard)"""
+        """Включить конфиг (добавить пир в WireGuard; interface — для AWG)"""
         
         if LOCAL_MODE:
             return True, "Конфиг включен (LOCAL_MODE)"
         
+        interface = interface or server.wg_interface
         logger.info(f"Включение конфига на сервере {server.name} (peer: {public_key[:20]}...)")
         
+        reply = await cls._agent_call(
+            server, "enable_peer",
+            interface=interface,
+            public_key=public_key,
+            preshared_key=preshared_key,
+            allowed_ips=allowed_ips
+        )
+        if reply is not None:
+            success, _, stderr = reply
+            if success:
+                logger.info(f"Конфиг успешно включен на {server.name}")
+            else:
+                logger.error(f"Ошибка включения конфига на {server.name}: {stderr}")
+            return success, "Конфиг включен" if success else stderr
+        
         # Создаём временный файл с preshared key и используем его
         # Убираем пробелы после запятых в allowed_ips (WireGuard их не понимает)
         allowed_ips_clean = allowed_ips.replace(", ", ",").replace(" ,", ",")
         cmd = f"""
 echo '{preshared_key}' > /tmp/psk_{public_key[:8]}.key && \
-wg set {server.wg_interface} peer {public_key} preshared-key /tmp/psk_{public_key[:8]}.key allowed-ips {allowed_ips_clean} && \
+wg set {interface} peer {public_key} preshared-key /tmp/psk_{public_key[:8]}.key allowed-ips {allowed_ips_clean} && \
 rm /tmp/psk_{public_key[:8]}.key
 """
         success, stdout, stderr = await cls._ssh_execute(server, cmd)
@@ -579,121 +923,165 @@ rm /tmp/psk_{public_key[:8]}.key
             return False, stderr or "Ошибка включения"
     
     @classmethod
-    async def get_traffic_stats(cls, server: Server) -> Dict[str, Dict[str, int]]:
-        """Получить статистику трафика с сервера"""
-        
+    async def list_v2ray_clients(cls, server: Server) -> Optional[Dict[str, bool]]:
+        """Клиенты Xray из X-UI: {email: включён}. None — сервер не ответил"""
         if LOCAL_MODE:
             return {}
         
         success, stdout, stderr = await cls._ssh_execute(
             server,
-            f"wg show {server.wg_interface}"
+            f"sqlite3 {XUI_DB} \"SELECT settings FROM inbounds WHERE tag='{XUI_INBOUND_TAG}'\" "
+            "| jq -r '.clients[] | \"\\(.email)\\t\\(.enable)\"'"
         )
-        
         if not success:
-            return {}
-        
-        peers = {}
-        current_peer = None
+            logger.warning(f"Не удалось получить клиентов Xray с {server.name}: {stderr}")
+            return None
         
-        for line in stdout.split('\n'):
-            line = line.strip()
-            if line.startswith('peer:'):
-                current_peer = line.split()[-1]
-                peers[current_peer] = {'received': 0, 'sent': 0}
-            elif current_peer and 'transfer:' in line:
-                parts = line.replace(',', '').split()
-                if 'received' in parts:
-                    rx_idx = parts.index('received')
-                    rx_value = float(parts[rx_idx - 2])
-                    rx_unit = parts[rx_idx - 1].lower()
-                    peers[current_peer]['received'] = cls._convert_to_bytes(rx_value, rx_unit)
-                
-                if 'sent' in parts:
-                    tx_idx = parts.index('sent')
-                    tx_value = float(parts[tx_idx - 2])
-                    tx_unit = parts[tx_idx - 1].lower()
-                    peers[current_peer]['sent'] = cls._convert_to_bytes(tx_value, tx_unit)
-        
-        return peers
+        clients = {}
+        for line in stdout.splitlines():
+            email, _, enabled = line.partition("\t")
+            if email:
+                clients[email] = enabled != "false"
+        return clients
     
     @classmethod
-    async def get_peers_status(cls, server: Server) -> Dict[str, Dict]:
-        """Получить полную информацию о пирах: handshake, endpoint, трафик, статус"""
+    async def update_v2ray_clients(
+        cls,
+        server: Server,
+        remove: List[str] = (),
+        enable: List[str] = (),
+        disable: List[str] = ()
+    ) -> Tuple[bool, str]:
+        """
+        Удалить, включить и отключить несколько клиентов Xray одним вызовом:
+        одна правка настроек X-UI и один перезапуск вместо вызова скрипта на каждого.
+        """
+        if LOCAL_MODE or not (remove or enable or disable):
+            return True, "Нечего менять"
         
+        jq_filter = (
+            ".clients |= (map(select(.email | IN($rm[]) | not)) "
+            "| map(if (.email | IN($on[])) then .enable = true "
+            "elif (.email | IN($off[])) then .enable = false else . end))"
+        )
+        files = " ".join(
+            f"{XRAY_CLIENT_DIR}/{shlex.quote(name)}{ext}"
+            for name in remove for ext in (".txt", ".uuid", ".png")
+        )
+        cmd = (
+            "set -e; "
+            f"S=$(sqlite3 {XUI_DB} \"SELECT settings FROM inbounds WHERE tag='{XUI_INBOUND_TAG}'\"); "
+            f"N=$(echo \"$S\" | jq --argjson rm {shlex.quote(json.dumps(list(remove)))} "
+            f"--argjson on {shlex.quote(json.dumps(list(enable)))} "
+            f"--argjson off {shlex.quote(json.dumps(list(disable)))} {shlex.quote(jq_filter)}); "
+            "E=$(echo \"$N\" | sed \"s/'/''/g\"); "
+            f"sqlite3 {XUI_DB} \"UPDATE inbounds SET settings='$E' WHERE tag='{XUI_INBOUND_TAG}'\"; "
+            + (f"rm -f {files}; " if files else "")
+            + "systemctl restart x-ui"
+        )
+        success, stdout, stderr = await cls._ssh_execute(server, cmd, timeout=60)
+        if success:
+            logger.info(
+                f"Клиенты Xray на {server.name}: удалено {len(remove)}, "
+                f"включено {len(enable)}, отключено {len(disable)}"
+            )
+            return True, "OK"
+        logger.error(f"Ошибка изменения клиентов Xray на {server.name}: {stderr}")
+        return False, stderr or "Ошибка изменения клиентов Xray"
+    
+    @classmethod
+    async def get_awg_peer_table(cls, server: Server) -> Optional[PeerTable]:
+        """Таблица пиров AmneziaWG интерфейса (None — сервер не ответил)"""
         if LOCAL_MODE:
-            return {}
+            return PeerTable(server.id, {})
         
+        interface = server.awg_interface or "awg0"
         success, stdout, stderr = await cls._ssh_execute(
             server,
-            f"wg show {server.wg_interface}"
+            f"wg show {interface} dump 2>/dev/null || awg show {interface} dump"
         )
-        
         if not success:
-            return {}
-        
-        peers = {}
-        current_peer = None
-        
-        for line in stdout.split('\n'):
-            line = line.strip()
-            if line.startswith('peer:'):
-                current_peer = line.split()[-1]
-                peers[current_peer] = {
-                    'received': 0,
-                    'sent': 0,
-                    'latest_handshake': None,  # timestamp в секундах
-                    'endpoint': None,
-                    'allowed_ips': None
-                }
-            elif current_peer:
-                if 'transfer:' in line:
-                    parts = line.replace(',', '').split()
-                    if 'received' in parts:
-                        rx_idx = parts.index('received')
-                        rx_value = float(parts[rx_idx - 2])
-                        rx_unit = parts[rx_idx - 1].lower()
-                        peers[current_peer]['received'] = cls._convert_to_bytes(rx_value, rx_unit)
-                    if 'sent' in parts:
-                        tx_idx = parts.index('sent')
-                        tx_value = float(parts[tx_idx - 2])
-                        tx_unit = parts[tx_idx - 1].lower()
-                        peers[current_peer]['sent'] = cls._convert_to_bytes(tx_value, tx_unit)
-                elif 'latest handshake:' in line:
-                    # Парсим время последнего handshake
-                    handshake_str = line.replace('latest handshake:', '').strip()
-                    peers[current_peer]['latest_handshake'] = cls._parse_handshake_time(handshake_str)
-                elif 'endpoint:' in line:
-                    peers[current_peer]['endpoint'] = line.split()[-1]
-                elif 'allowed ips:' in line:
-                    peers[current_peer]['allowed_ips'] = line.replace('allowed ips:', '').strip()
-        
-        return peers
+            logger.warning(f"Не удалось получить awg dump с {server.name}: {stderr}")
+            return None
+        return PeerTable(server.id, parse_wg_dump(stdout or ""))
     
-    @staticmethod
-    def _parse_handshake_time(handshake_str: str) -> Optional[int]:
-        """Парсит строку времени handshake в секунды назад"""
-        import re
+    @classmethod
+    async def get_peer_table(cls, server: Server) -> Optional[PeerTable]:
+        """
+        Снять таблицу пиров сервера через `wg show <iface> dump`.
+        Точные байты и unix-время handshake; None — сервер не ответил.
+        """
+        if LOCAL_MODE:
+            return PeerTable(server.id, {})
         
-        if not handshake_str or handshake_str == '(none)':
+        reply = await cls._agent_call(server, "dump", interface=server.wg_interface)
+        if reply is not None:
+            success, stdout, stderr = reply
+        else:
+            success, stdout, stderr = await cls._ssh_execute(
+                server,
+                f"wg show {server.wg_interface} dump"
+            )
+        
+        if not success:
+            logger.warning(f"Не удалось получить wg dump с {server.name}: {stderr}")
             return None
         
-        total_seconds = 0
+        table = PeerTable(server.id, parse_wg_dump(stdout or ""))
+        _peer_tables.set(server.id, table)
+        return table
+    
+    @staticmethod
+    def get_cached_peer_table(server_id: int) -> Optional[PeerTable]:
+        """Последняя снятая таблица пиров сервера (без запроса к серверу)"""
+        return _peer_tables.peek(server_id)
+    
+    @classmethod
+    async def collect_counters(cls, server: Server) -> Optional[Dict[str, Dict[str, int]]]:
+        """
+        Счётчики трафика всех протоколов сервера одним SSH запросом:
+        {public_key или email Xray: {'received', 'sent'}}. None — сервер не ответил.
+        """
+        if LOCAL_MODE:
+            return {}
         
-        # Парсим дни, часы, минуты, секунды
-        patterns = [
-            (r'(\d+)\s*day', 86400),
-            (r'(\d+)\s*hour', 3600),
-            (r'(\d+)\s*minute', 60),
-            (r'(\d+)\s*second', 1),
+        caps = CapabilityService.peek(server)
+        collectors = [
+            c for c in COLLECTORS
+            if c.protocol == "wg" or caps is None or caps.supports(c.protocol)
         ]
+        success, stdout, stderr = await cls._ssh_execute(
+            server,
+            cls._sections_command({c.protocol: c.command(server) for c in collectors})
+        )
+        if not success:
+            logger.warning(f"Не удалось получить счётчики трафика с {server.name}: {stderr}")
+            return None
         
-        for pattern, multiplier in patterns:
-            match = re.search(pattern, handshake_str)
-            if match:
-                total_seconds += int(match.group(1)) * multiplier
-        
-        return total_seconds if total_seconds > 0 else None
+        sections = cls._parse_bundle(stdout)
+        counters: Dict[str, Dict[str, int]] = {}
+        for collector in collectors:
+            output = sections.get(collector.protocol, b"").decode(errors="replace")
+            if collector.protocol == "wg" and output:
+                # Заодно обновляем таблицу пиров для статусов (пустой вывод — wg show не отработал)
+                table = collector.table(server, output)
+                _peer_tables.set(server.id, table)
+                counters.update(table.traffic())
+            else:
+                counters.update(collector.parse(server, output))
+        return counters
+    
+    @classmethod
+    async def get_traffic_stats(cls, server: Server) -> Dict[str, Dict[str, int]]:
+        """Получить статистику трафика с сервера (все протоколы, через кэш services.traffic)"""
+        from services.traffic import get_server_traffic
+        return await get_server_traffic(server)
+    
+    @classmethod
+    async def get_peers_status(cls, server: Server) -> Dict[str, Dict]:
+        """Получить полную информацию о пирах: handshake, endpoint, трафик, статус"""
+        table = await _peer_tables.get(server.id, lambda: cls.get_peer_table(server))
+        return table.status() if table else {}
     
     @staticmethod
     def get_peer_status(handshake_seconds: Optional[int]) -> str:
@@ -724,17 +1112,6 @@ rm /tmp/psk_{public_key[:8]}.key
         else:
             return f"{seconds // 86400} дн назад"
     
-    @staticmethod
-    def _convert_to_bytes(value: float, unit: str) -> int:
-        """Конвертировать значение в байты"""
-        units = {
-            'b': 1,
-            'kib': 1024,
-            'mib': 1024 * 1024,
-            'gib': 1024 * 1024 * 1024
-        }
-        return int(value * units.get(unit.lower(), 1))
-    
     @staticmethod
     def format_bytes(size: int) -> str:
         """Форматировать байты в читаемый вид"""
@@ -924,6 +1301,11 @@ PostDown = iptables -D FORWARD -i %i -j ACCEPT; iptables -D FORWARD -o %i -j ACC
         if not success:
             return False, f"Ошибка создания скрипта удаления: {stderr}"
         
+        # Агент не обязателен: без него всё работает через shell
+        agent_ok, agent_error = await cls.deploy_agent(server)
+        if not agent_ok:
+            logger.warning(f"Не удалось установить агент на {server.name}: {agent_error}")
+        
         await report("start", "Запуск WireGuard...")
         
         # Запускаем WireGuard
@@ -941,6 +1323,9 @@ PostDown = iptables -D FORWARD -i %i -j ACCEPT; iptables -D FORWARD -o %i -j ACC
         if not success:
             return False, f"WireGuard не запустился: {stderr}"
         
+        # Набор протоколов и порты изменились — перепроверим при следующем обращении
+        CapabilityService.invalidate(server)
+        
         await report("done", f"Установка завершена! Публичный ключ: {server_public_key}")
         
         return True, f"WireGuard установлен. Публичный ключ: {server_public_key}"
@@ -948,34 +1333,37 @@ PostDown = iptables -D FORWARD -i %i -j ACCEPT; iptables -D FORWARD -o %i -j ACC
     @classmethod
     async def _ssh_execute_long(cls, server: Server, command: str, timeout: int = 120) -> Tuple[bool, str, str]:
         """Выполнить длительную команду на удалённом сервере"""
-        try:
-            async with await cls._ssh_connect(server) as conn:
-                result = await asyncio.wait_for(
-                    conn.run(command),
-                    timeout=timeout
-                )
-                return result.exit_status == 0, result.stdout or "", result.stderr or ""
-        except asyncio.TimeoutError:
-            logger.error(f"SSH timeout to {server.host}")
-            return False, "", "Таймаут SSH соединения"
-        except Exception as e:
-            logger.error(f"SSH error to {server.host}: {e}")
-            return False, "", str(e)
+        return await cls._ssh_execute(server, command, timeout=timeout)
     
     @classmethod
     async def _ssh_upload_script(cls, server: Server, path: str, content: str) -> Tuple[bool, str, str]:
         """Загрузить скрипт на сервер"""
+        async def upload(conn: asyncssh.SSHClientConnection):
+            async with conn.start_sftp_client() as sftp:
+                async with sftp.open(path, 'w') as f:
+                    await f.write(content)
+            # Делаем исполняемым
+            return await conn.run(f"chmod +x {path}")
+        
         try:
-            async with await cls._ssh_connect(server) as conn:
-                async with conn.start_sftp_client() as sftp:
-                    async with sftp.open(path, 'w') as f:
-                        await f.write(content)
-                # Делаем исполняемым
-                result = await conn.run(f"chmod +x {path}")
-                return result.exit_status == 0, "", ""
+            result = await cls._with_connection(server, upload)
+            return result.exit_status == 0, "", ""
         except Exception as e:
             return False, "", str(e)
     
+    @classmethod
+    async def deploy_agent(cls, server: Server) -> Tuple[bool, str]:
+        """Загрузить agde-agent на сервер и перезапустить его канал"""
+        try:
+            source = AGENT_SOURCE.read_text(encoding="utf-8")
+        except OSError as e:
+            return False, str(e)
+        
+        success, stdout, stderr = await cls._ssh_upload_script(server, AGENT_PATH, source)
+        # Старый агент (если был) закрываем — следующий вызов запустит новый
+        AgentRegistry.invalidate(server)
+        return success, stderr
+    
     @staticmethod
     def _get_add_client_script() -> str:
         """Скрипт добавления клиента"""
@@ -994,7 +1382,7 @@ SERVER_ENDPOINT="${SERVER_IP}:${SERVER_PORT}"
 
 USERNAME="$1"
 if [ -z "$USERNAME" ]; then
-  echo "Usage: $0 <username>"
+  echo "Usage: $0 <username> [client_ip/prefix]"
   exit 1
 fi
 
@@ -1004,13 +1392,23 @@ PRIVATE_KEY=$(wg genkey)
 PUBLIC_KEY=$(echo "$PRIVATE_KEY" | wg pubkey)
 PRESHARED_KEY=$(wg genpsk)
 
-LAST_IP=$(grep -rhPo "(?<=AllowedIPs = ${VPN_SUBNET}\\.)[0-9]+" "$WG_CONF" "$CLIENT_DIR"/*.conf 2>/dev/null | sort -n | tail -n1)
-if [[ ! $LAST_IP =~ ^[0-9]+$ ]]; then
-  LAST_IP=1
+# Адрес выдаёт бот (IPAM) вторым аргументом: 10.7.0.5/24
+if [ -n "$2" ]; then
+  CLIENT_IPV4="${2%/*}"
+  CLIENT_PREFIX=24
+  [[ "$2" == */* ]] && CLIENT_PREFIX="${2#*/}"
+  IFS=. read -r _ _ OCTET3 OCTET4 <<< "$CLIENT_IPV4"
+  CLIENT_IPV6="fddd:2c4:2c4:2c4::${OCTET3}:${OCTET4}"
+else
+  LAST_IP=$(grep -rhPo "(?<=AllowedIPs = ${VPN_SUBNET}\\.)[0-9]+" "$WG_CONF" "$CLIENT_DIR"/*.conf 2>/dev/null | sort -n | tail -n1)
+  if [[ ! $LAST_IP =~ ^[0-9]+$ ]]; then
+    LAST_IP=1
+  fi
+  NEXT_IP=$((LAST_IP + 1))
+  CLIENT_IPV4="${VPN_SUBNET}.${NEXT_IP}"
+  CLIENT_PREFIX=24
+  CLIENT_IPV6="fddd:2c4:2c4:2c4::${NEXT_IP}"
 fi
-NEXT_IP=$((LAST_IP + 1))
-CLIENT_IPV4="${VPN_SUBNET}.${NEXT_IP}"
-CLIENT_IPV6="fddd:2c4:2c4:2c4::${NEXT_IP}"
 
 CONFIG_FILE="$CLIENT_DIR/${USERNAME}.conf"
 QR_PNG="$CLIENT_DIR/${USERNAME}.png"
@@ -1018,7 +1416,7 @@ QR_PNG="$CLIENT_DIR/${USERNAME}.png"
 cat > "$CONFIG_FILE" <<EOF
 [Interface]
 PrivateKey = $PRIVATE_KEY
-Address = $CLIENT_IPV4/24, $CLIENT_IPV6/64
+Address = $CLIENT_IPV4/$CLIENT_PREFIX, $CLIENT_IPV6/64
 DNS = 1.1.1.1
 
 [Peer]
@@ -1096,16 +1494,116 @@ echo "OK: $USERNAME removed"
 '''
     
     @classmethod
-    async def check_awg_available(cls, server: Server) -> bool:
-        """Проверить доступен ли AmneziaWG на сервере"""
+    async def probe_capabilities(cls, server: Server) -> Optional[ServerCapabilities]:
+        """
+        Проверить за один SSH вызов, какие протоколы есть на сервере, их порты,
+        внешний адрес и публичный ключ WireGuard.
+        None — сервер не ответил.
+        """
         if LOCAL_MODE:
-            return False
+            return ServerCapabilities(wg=True, wg_interface=server.wg_interface, checked_at=time.time())
+        
+        wg_conf = shlex.quote(server.wg_conf_path)
+        cmd = f"""
+AWG_CONF={AWG_CONF_PATH}
+echo "WG=$(command -v wg >/dev/null 2>&1 && test -f {wg_conf} && echo 1 || echo 0)"
+echo "WG_PORT=$(grep -m1 '^ListenPort' {wg_conf} 2>/dev/null | cut -d'=' -f2 | tr -d ' ')"
+echo "WG_PUBKEY=$(wg show {shlex.quote(server.wg_interface)} public-key 2>/dev/null || cat /etc/wireguard/server_public.key 2>/dev/null)"
+echo "AWG=$(command -v awg >/dev/null 2>&1 && test -f $AWG_CONF && echo 1 || echo 0)"
+echo "AWG_PORT=$(grep -m1 ListenPort $AWG_CONF 2>/dev/null | awk '{{print $3}}')"
+echo "V2RAY=$(test -f /usr/local/bin/v2ray-new-conf.sh && systemctl is-active xray >/dev/null 2>&1 && echo 1 || echo 0)"
+echo "V2RAY_PORT=$(jq -r '.inbounds[0].port' /usr/local/etc/xray/config.json 2>/dev/null)"
+echo "ENDPOINT=$(curl -s --max-time 3 ifconfig.me 2>/dev/null || hostname -I | awk '{{print $1}}')"
+"""
+        success, stdout, stderr = await cls._ssh_execute(server, cmd)
+        if not success and "WG=" not in stdout:
+            logger.warning(f"Не удалось проверить возможности {server.name}: {stderr}")
+            return None
         
+        values = {}
+        for line in stdout.splitlines():
+            if "=" in line:
+                key, _, value = line.partition("=")
+                values[key.strip()] = value.strip()
+        
+        def port(key: str) -> Optional[int]:
+            value = values.get(key, "")
+            return int(value) if value.isdigit() else None
+        
+        awg = values.get("AWG") == "1"
+        return ServerCapabilities(
+            wg=values.get("WG") == "1",
+            awg=awg,
+            v2ray=values.get("V2RAY") == "1",
+            wg_interface=server.wg_interface,
+            awg_interface="awg0" if awg else None,
+            endpoint=values.get("ENDPOINT") or None,
+            wg_public_key=values.get("WG_PUBKEY") or None,
+            wg_port=port("WG_PORT"),
+            awg_port=port("AWG_PORT"),
+            v2ray_port=port("V2RAY_PORT"),
+            checked_at=time.time()
+        )
+    
+    @classmethod
+    async def read_address_plan(cls, server: Server, protocol: str) -> Optional[Tuple[str, List[str]]]:
+        """
+        Адрес интерфейса (10.7.0.1/24) и занятые клиентами IPv4 адреса из AllowedIPs —
+        для создания пула IPAM. None — сервер не ответил или Address не найден.
+        """
+        conf = shlex.quote(AWG_CONF_PATH if protocol == "awg" else server.wg_conf_path)
         success, stdout, stderr = await cls._ssh_execute(
             server,
-            "which awg && test -f /etc/amnezia/amneziawg/awg0.conf && echo 'AWG_OK'"
+            f"grep -E '^[[:space:]]*(Address|AllowedIPs)[[:space:]]*=' {conf}"
+        )
+        if not success:
+            logger.warning(f"Не удалось прочитать адреса {protocol} на {server.name}: {stderr}")
+            return None
+        
+        interface_address = None
+        used: List[str] = []
+        for line in stdout.splitlines():
+            key, _, value = line.partition("=")
+            for part in value.split(","):
+                try:
+                    iface = ipaddress.ip_interface(part.strip())
+                except ValueError:
+                    continue
+                if iface.version != 4:
+                    continue
+                if key.strip() == "Address":
+                    interface_address = interface_address or str(iface)
+                else:
+                    used.append(str(iface.ip))
+        
+        if interface_address is None:
+            return None
+        return interface_address, used
+    
+    @classmethod
+    async def get_available_protocols(cls, servers: List[Server]) -> set:
+        """Протоколы, доступные хотя бы на одном из серверов (из кэша, проверки — параллельно)"""
+        if LOCAL_MODE or not servers:
+            return set()
+        
+        results = await asyncio.gather(
+            *(CapabilityService.get(server) for server in servers),
+            return_exceptions=True
         )
-        return success and "AWG_OK" in stdout
+        protocols = set()
+        for caps in results:
+            if isinstance(caps, ServerCapabilities):
+                protocols.update(caps.protocols())
+        return protocols
+    
+    @classmethod
+    async def check_awg_available(cls, server: Server) -> bool:
+        """Доступен ли AmneziaWG на сервере (из кэша возможностей)"""
+        if LOCAL_MODE:
+            return False
+        
+        caps = await CapabilityService.get(server)
+        return caps.awg
     
     @classmethod
     async def create_awg_config(
@@ -1124,56 +1622,63 @@ echo "OK: $USERNAME removed"
                 allowed_ips="10.8.0.100/32",
                 client_ip="10.8.0.100",
                 config_content="[Interface]\nPrivateKey = LOCAL_MODE_AWG\nAddress = 10.8.0.100/24\nDNS = 1.1.1.1\nJc = 4",
-                qr_content=b"",
                 server_id=server.id if server else 0
             ), "AWG конфиг создан (LOCAL_MODE)"
         
         logger.info(f"Создание AWG конфига {username} на сервере {server.name} ({server.host})")
         
-        # Создать конфиг через AWG скрипт
-        success, stdout, stderr = await cls._ssh_execute(
-            server, 
-            f"/usr/local/bin/awg-new-conf.sh {username}"
+        lease = await IpamService.allocate(server, "awg", username)
+        
+        # Создаём конфиг через AWG скрипт и забираем файлы тем же SSH запросом
+        name = shlex.quote(username)
+        add_cmd = f"/usr/local/bin/awg-new-conf.sh {name}"
+        if lease:
+            add_cmd += f" {lease.cidr}"
+        success, bundle, stderr = await cls._ssh_execute_bundle(
+            server,
+            add_cmd,
+            {
+                'conf': f"cat /etc/amnezia/amneziawg/clients/{name}.conf",
+            }
         )
         
         if not success:
             logger.error(f"Ошибка создания AWG конфига на {server.host}: {stderr}")
+            if lease:
+                await IpamService.release(server, username)
             return False, None, stderr or "Ошибка создания AWG конфига"
         
         # Парсим вывод скрипта для получения public_key
         public_key = None
-        for line in stdout.split('\n'):
+        for line in bundle.get('stdout', b"").decode('utf-8').split('\n'):
             if line.startswith('PUBLIC_KEY:'):
                 public_key = line.split(':')[1].strip()
                 break
         
-        # Прочитать созданные файлы
-        config_path = f"/etc/amnezia/amneziawg/clients/{username}.conf"
-        qr_path = f"/etc/amnezia/amneziawg/clients/{username}.png"
-        
-        config_content = await cls._ssh_read_file(server, config_path)
-        qr_content = await cls._ssh_read_file(server, qr_path)
-        
+        config_content = bundle.get('conf')
         if not config_content:
+            await cls.discard_peer(server, username, "awg", public_key)
             return False, None, "Не удалось прочитать созданный AWG конфиг"
         
-        # Парсим IP из конфига
+        # Парсим IP и PSK из конфига
         config_text = config_content.decode('utf-8')
         client_ip = "10.8.0.2"
+        preshared_key = ""
         for line in config_text.split('\n'):
             if line.startswith('Address=') or line.startswith('Address ='):
-                addr = line.split('=')[1].strip().split(',')[0].split('/')[0]
-                client_ip = addr
-                break
+                client_ip = line.split('=', 1)[1].strip().split(',')[0].split('/')[0]
+            elif line.startswith('PresharedKey'):
+                preshared_key = line.split('=', 1)[1].strip()
+        
+        await IpamService.confirm(server, "awg", username, lease, client_ip)
         
         return True, ConfigData(
             name=username,
             public_key=public_key or "UNKNOWN",
-            preshared_key="",
+            preshared_key=preshared_key,
             allowed_ips=f"{client_ip}/32",
             client_ip=client_ip,
             config_content=config_text,
-            qr_content=qr_content or b"",
             server_id=server.id
         ), "AWG конфиг создан"
     
@@ -1187,6 +1692,9 @@ echo "OK: $USERNAME removed"
         
         logger.info(f"Удаление AWG конфига {username} с сервера {server.name}")
         
+        # Удаление AWG всегда считается успешным — адрес освобождаем сразу
+        await IpamService.release(server, username)
+        
         # Проверяем наличие скрипта
         script_check, _, _ = await cls._ssh_execute(server, "test -f /usr/local/bin/awg-remove-client.sh && echo 'OK'")
         if not script_check:
@@ -1225,15 +1733,12 @@ echo "OK: $USERNAME removed"
     
     @classmethod
     async def check_v2ray_available(cls, server: Server) -> bool:
-        """Проверить доступность V2Ray/Xray на сервере"""
+        """Доступен ли V2Ray/Xray на сервере (из кэша возможностей)"""
         if LOCAL_MODE:
             return False
         
-        success, stdout, stderr = await cls._ssh_execute(
-            server,
-            "test -f /usr/local/bin/v2ray-new-conf.sh && systemctl is-active xray >/dev/null 2>&1 && echo 'OK'"
-        )
-        return success and 'OK' in stdout
+        caps = await CapabilityService.get(server)
+        return caps.v2ray
     
     @classmethod
     async def create_v2ray_config(cls, username: str, server: Server) -> Tuple[bool, Optional[ConfigData], str]:
@@ -1245,10 +1750,10 @@ echo "OK: $USERNAME removed"
         
         logger.info(f"Создание V2Ray конфига {username} на сервере {server.name}")
         
-        # Создаём конфиг через скрипт
+        # Создаём конфиг через скрипт (QR-код рисует бот)
         success, stdout, stderr = await cls._ssh_execute(
             server,
-            f"/usr/local/bin/v2ray-new-conf.sh {username}"
+            f"/usr/local/bin/v2ray-new-conf.sh {shlex.quote(username)}"
         )
         
         if not success:
@@ -1267,10 +1772,6 @@ echo "OK: $USERNAME removed"
         if not vless_link:
             return False, None, "Не удалось получить VLESS ссылку"
         
-        # Прочитать QR-код
-        qr_path = f"/usr/local/etc/xray/clients/{username}.png"
-        qr_content = await cls._ssh_read_file(server, qr_path)
-        
         return True, ConfigData(
             name=username,
             public_key=uuid or "UNKNOWN",
@@ -1278,7 +1779,6 @@ echo "OK: $USERNAME removed"
             allowed_ips="",
             client_ip="",
             config_content=vless_link,
-            qr_content=qr_content or b"",
             server_id=server.id
         ), "V2Ray конфиг создан"
     
@@ -0,0 +1,56 @@
+"""
+Общие фикстуры pytest.
+
+Запуск (из vpn_bot): pip install pytest pytest-asyncio && python -m pytest tests
+
+БД — SQLite в памяти со схемой моделей; один StaticPool, чтобы все сессии
+теста (и временные таблицы) жили в одном соединении.
+"""
+
+import os
+import sys
+
+# config.py требует токен и админа при импорте
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("ADMIN_ID", "1")
+
+# Добавляем путь к проекту
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+import database.db  # noqa: F401 — регистрирует before_flush счётчиков клиентов
+from database.models import Base, Config, Server, User
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False}
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    await engine.dispose()
+
+
+def make_server(name: str = "srv", **kwargs) -> Server:
+    kwargs.setdefault("host", f"{name}.example")
+    kwargs.setdefault("max_clients", 30)
+    return Server(name=name, **kwargs)
+
+
+def make_config(user: User, name: str, server: Server = None, **kwargs) -> Config:
+    kwargs.setdefault("public_key", f"{name}-key")
+    kwargs.setdefault("preshared_key", "psk")
+    kwargs.setdefault("allowed_ips", "10.0.0.2/32")
+    kwargs.setdefault("client_ip", "10.0.0.2")
+    return Config(user=user, name=name, server=server, **kwargs)
+
+
+def make_user(telegram_id: int = 1000) -> User:
+    return User(telegram_id=telegram_id, full_name=f"user {telegram_id}")
@@ -0,0 +1,159 @@
+"""Кэш с single-flight загрузкой (services/async_cache.py)"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services import async_cache
+from services.async_cache import AsyncCache
+
+pytestmark = pytest.mark.asyncio
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class Loader:
+    """Загрузчик-заглушка: отдаёт values по очереди и считает вызовы"""
+
+    def __init__(self, *values, gate: asyncio.Event = None):
+        self.values = list(values)
+        self.calls = 0
+        self.gate = gate
+
+    async def __call__(self):
+        self.calls += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        value = self.values.pop(0)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Подменяем только часы кэша — asyncio пользуется настоящим time.monotonic
+    clock = Clock()
+    monkeypatch.setattr(async_cache, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+async def test_concurrent_misses_share_one_load(clock):
+    cache = AsyncCache("test", ttl=10)
+    gate = asyncio.Event()
+    loader = Loader("value", gate=gate)
+
+    waiters = [asyncio.create_task(cache.get("k", loader)) for _ in range(5)]
+    await asyncio.sleep(0)
+    gate.set()
+
+    assert await asyncio.gather(*waiters) == ["value"] * 5
+    assert loader.calls == 1
+    assert await cache.get("k", loader) == "value"
+    assert loader.calls == 1
+
+
+async def test_cancelled_waiter_does_not_cancel_load(clock):
+    cache = AsyncCache("test", ttl=10)
+    gate = asyncio.Event()
+    loader = Loader("value", gate=gate)
+
+    first = asyncio.create_task(cache.get("k", loader))
+    second = asyncio.create_task(cache.get("k", loader))
+    await asyncio.sleep(0)
+    first.cancel()
+    gate.set()
+
+    assert await second == "value"
+    assert loader.calls == 1
+    assert cache.peek("k") == "value"
+
+
+async def test_expired_value_reloads(clock):
+    cache = AsyncCache("test", ttl=10)
+    loader = Loader("old", "new")
+
+    assert await cache.get("k", loader) == "old"
+    clock.now += 11
+    assert await cache.get("k", loader) == "new"
+    assert loader.calls == 2
+
+
+async def test_stale_value_served_while_revalidating(clock):
+    cache = AsyncCache("test", ttl=10, stale_ttl=30)
+    gate = asyncio.Event()
+    loader = Loader("old", "new", gate=gate)
+    gate.set()
+    assert await cache.get("k", loader) == "old"
+
+    gate.clear()
+    clock.now += 15
+    # Устаревшее значение отдаётся сразу, загрузка идёт в фоне
+    assert await cache.get("k", loader) == "old"
+    await asyncio.sleep(0)
+    assert await cache.get("k", loader) == "old"
+    assert loader.calls == 2
+
+    gate.set()
+    await asyncio.sleep(0)
+    assert await cache.get("k", loader) == "new"
+
+    # За пределами stale_ttl ждём новой загрузки
+    await asyncio.sleep(0)  # done-callback фоновой загрузки
+    clock.now += 10 + 30 + 1
+    assert await cache.get("k", Loader("fresh")) == "fresh"
+
+
+async def test_failed_load_is_cached_negatively(clock):
+    cache = AsyncCache("test", ttl=10, negative_ttl=5)
+    loader = Loader(None, "value")
+
+    assert await cache.get("k", loader) is None
+    assert await cache.get("k", loader) is None
+    assert loader.calls == 1
+
+    clock.now += 6
+    assert await cache.get("k", loader) == "value"
+    assert loader.calls == 2
+
+
+async def test_failed_refresh_keeps_stale_value(clock):
+    cache = AsyncCache("test", ttl=10, stale_ttl=30, negative_ttl=5)
+    cache.set("k", "old")
+    clock.now += 15
+
+    loader = Loader(None)
+    assert await cache.refresh("k", loader) is None
+    # Промах запомнен: устаревшее значение отдаётся без новых попыток
+    assert await cache.get("k", loader) == "old"
+    assert loader.calls == 1
+
+
+async def test_errors_reach_waiters_and_are_not_cached(clock):
+    cache = AsyncCache("test", ttl=10, negative_ttl=5)
+    loader = Loader(RuntimeError("boom"), "value")
+
+    with pytest.raises(RuntimeError):
+        await cache.get("k", loader)
+    assert await cache.get("k", loader) == "value"
+    assert loader.calls == 2
+
+
+async def test_set_with_age_and_invalidate(clock):
+    cache = AsyncCache("test", ttl=10)
+    cache.set("k", "pushed", age=8)
+    loader = Loader("loaded")
+
+    assert await cache.get("k", loader) == "pushed"
+    clock.now += 3
+    assert await cache.get("k", loader) == "loaded"
+
+    cache.invalidate("k")
+    assert cache.peek("k") is None
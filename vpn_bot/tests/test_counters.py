@@ -0,0 +1,103 @@
+"""Счётчики клиентов серверов (database/counters.py)"""
+
+import pytest
+from sqlalchemy import update
+
+from database.counters import recount_client_counters
+from database.models import Config, Server
+from conftest import make_config, make_server, make_user
+
+pytestmark = pytest.mark.asyncio
+
+
+async def add_servers(session, *servers: Server) -> None:
+    # Конфиги добавляются на уже существующие серверы (id нужен до flush)
+    session.add_all(servers)
+    await session.commit()
+
+
+async def counters(session, server_id: int):
+    server = await session.get(Server, server_id, populate_existing=True)
+    return server.active_clients, server.active_wg, server.active_awg, server.active_v2ray
+
+
+async def test_new_configs_counted_in_same_flush(session_factory):
+    async with session_factory() as session:
+        server = make_server()
+        await add_servers(session, server)
+        user = make_user()
+        session.add_all([
+            make_config(user, "a", server),
+            make_config(user, "b", server, protocol_type="awg"),
+            make_config(user, "c", server, protocol_type="v2ray"),
+            make_config(user, "off", server, is_active=False),
+        ])
+        await session.commit()
+
+        assert await counters(session, server.id) == (3, 1, 1, 1)
+
+
+async def test_config_changes_shift_counters(session_factory):
+    async with session_factory() as session:
+        first, second = make_server("first"), make_server("second")
+        await add_servers(session, first, second)
+        user = make_user()
+        moved = make_config(user, "moved", first)
+        disabled = make_config(user, "disabled", first, protocol_type="awg")
+        deleted = make_config(user, "deleted", first)
+        session.add_all([moved, disabled, deleted])
+        await session.commit()
+        assert await counters(session, first.id) == (3, 2, 1, 0)
+
+        moved.server_id = second.id
+        moved.protocol_type = "v2ray"
+        disabled.is_active = False
+        await session.delete(deleted)
+        await session.commit()
+
+        assert await counters(session, first.id) == (0, 0, 0, 0)
+        assert await counters(session, second.id) == (1, 0, 0, 1)
+
+        disabled.is_active = True
+        await session.commit()
+        assert await counters(session, first.id) == (1, 0, 1, 0)
+
+
+async def test_unchanged_dirty_config_keeps_counters(session_factory):
+    async with session_factory() as session:
+        server = make_server()
+        await add_servers(session, server)
+        config = make_config(make_user(), "a", server)
+        session.add(config)
+        await session.commit()
+
+        config.total_received = 100
+        await session.commit()
+
+        assert await counters(session, server.id) == (1, 1, 0, 0)
+
+
+async def test_recount_fixes_bulk_updates(session_factory):
+    async with session_factory() as session:
+        server = make_server()
+        await add_servers(session, server)
+        user = make_user()
+        session.add_all([
+            make_config(user, "a", server),
+            make_config(user, "b", server, protocol_type="awg"),
+            make_config(user, "legacy", server, protocol_type=None),
+        ])
+        await session.commit()
+        assert await counters(session, server.id) == (3, 2, 1, 0)
+
+        # Массовый UPDATE в обход ORM before_flush не видит
+        await session.execute(
+            update(Config).where(Config.name == "b").values(is_active=False)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        assert await counters(session, server.id) == (3, 2, 1, 0)
+
+        assert await recount_client_counters(session) == [server.name]
+        assert await counters(session, server.id) == (2, 2, 0, 0)
+        assert await recount_client_counters(session) == []
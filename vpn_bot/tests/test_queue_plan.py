@@ -0,0 +1,81 @@
+"""Распределение очереди по серверам (ConfigQueueService._plan)"""
+
+import pytest
+
+from database.models import ConfigQueue
+from services.config_queue import ConfigQueueService
+from services.wireguard_multi import WireGuardMultiService
+from conftest import make_server
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def protocols(monkeypatch):
+    """{server_id: поддерживаемые протоколы}; проверки возможностей без SSH"""
+    supported = {}
+
+    async def check(protocol, server):
+        return protocol in supported.get(server.id, ())
+
+    async def check_awg(server):
+        return await check("awg", server)
+
+    async def check_v2ray(server):
+        return await check("v2ray", server)
+
+    monkeypatch.setattr(WireGuardMultiService, "check_awg_available", check_awg)
+    monkeypatch.setattr(WireGuardMultiService, "check_v2ray_available", check_v2ray)
+    return supported
+
+
+def job(n: int, **kwargs) -> ConfigQueue:
+    return ConfigQueue(id=n, user_id=n, config_name=f"job{n}", **kwargs)
+
+
+def capacity(*servers):
+    return [(server, server.active_clients, server.max_clients - server.active_clients) for server in servers]
+
+
+async def test_spreads_by_fill_and_stops_when_full(protocols):
+    first = make_server("first", id=101, max_clients=4, active_clients=2)
+    second = make_server("second", id=102, max_clients=4, active_clients=1)
+
+    plan = await ConfigQueueService._plan(capacity(first, second), [job(n) for n in range(6)])
+
+    # Каждый следующий — на менее заполненный с учётом уже распределённых; мест всего 5
+    assert [(item.id, server.name) for item, server, _ in plan] == [
+        (0, "second"), (1, "first"), (2, "second"), (3, "first"), (4, "second"),
+    ]
+
+
+async def test_priority_wins_over_fill(protocols):
+    busy = make_server("busy", id=111, max_clients=10, active_clients=8, priority=5)
+    empty = make_server("empty", id=112, max_clients=10, active_clients=0)
+
+    plan = await ConfigQueueService._plan(capacity(busy, empty), [job(n) for n in range(3)])
+
+    assert [server.name for _, server, _ in plan] == ["busy", "busy", "empty"]
+
+
+async def test_pinned_server_and_protocols(protocols):
+    plain = make_server("plain", id=121, max_clients=10, active_clients=0)
+    amnezia = make_server("amnezia", id=122, max_clients=10, active_clients=5)
+    protocols[amnezia.id] = {"awg"}
+
+    items = [
+        job(1, protocol_type="awg"),
+        job(2, server_id=amnezia.id),
+        job(3),
+        job(4, protocol_type="v2ray"),
+        job(5, protocol_type="wg"),
+    ]
+    plan = await ConfigQueueService._plan(capacity(plain, amnezia), items)
+
+    # v2ray нет ни на одном сервере — задание остаётся в очереди
+    assert [(item.id, server.name, protocol) for item, server, protocol in plan] == [
+        (1, "amnezia", "awg"),
+        (2, "amnezia", "awg"),
+        (3, "plain", "wg"),
+        (5, "plain", "wg"),
+    ]
@@ -0,0 +1,164 @@
+"""Сверка БД с сервером (ReconciliationService._reconcile_server)"""
+
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+
+from database.models import PooledPeer
+from services import reconciliation
+from services.capabilities import CapabilityService, ServerCapabilities
+from services.reconciliation import CONFIRM_AFTER_SECONDS, ReconciliationService
+from services.wg_dump import PeerInfo, PeerTable
+from services.wireguard_multi import WireGuardMultiService
+from conftest import make_config, make_server, make_user
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeServer:
+    """Пиры на сервере и вызовы, которыми сверка их исправляет"""
+
+    def __init__(self):
+        self.wg = {}  # public_key → allowed_ips
+        self.awg = {}
+        self.v2ray = {}  # email → включён
+        self.removed = []  # (ключи, save, interface)
+        self.enabled = []
+        self.v2ray_updates = []
+
+    def table(self, peers):
+        return PeerTable(1, {key: PeerInfo(key, None, ips, 0, 0, 0) for key, ips in peers.items()})
+
+    async def get_peer_table(self, server):
+        return self.table(self.wg)
+
+    async def get_awg_peer_table(self, server):
+        return self.table(self.awg)
+
+    async def list_v2ray_clients(self, server):
+        return dict(self.v2ray)
+
+    async def remove_peers(self, server, public_keys, save=True, interface=None):
+        self.removed.append((sorted(public_keys), save, interface))
+        return list(public_keys), {}
+
+    async def enable_config(self, public_key, preshared_key, allowed_ips, server, interface=None):
+        self.enabled.append((public_key, interface))
+        return True, "ok"
+
+    async def update_v2ray_clients(self, server, remove=(), enable=(), disable=()):
+        self.v2ray_updates.append((sorted(remove), sorted(enable), sorted(disable)))
+        return True, None
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    remote = FakeServer()
+    for name in (
+        "get_peer_table", "get_awg_peer_table", "list_v2ray_clients",
+        "remove_peers", "enable_config", "update_v2ray_clients",
+    ):
+        monkeypatch.setattr(WireGuardMultiService, name, getattr(remote, name))
+
+    async def capabilities(server):
+        return ServerCapabilities(wg=True, awg=True, v2ray=True)
+
+    monkeypatch.setattr(CapabilityService, "get", capabilities)
+    return remote
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(reconciliation, "time", SimpleNamespace(time=lambda: clock.now))
+    monkeypatch.setattr(reconciliation, "_seen", {})
+    return clock
+
+
+@pytest_asyncio.fixture
+async def server(session_factory, monkeypatch):
+    monkeypatch.setattr(reconciliation, "async_session", session_factory)
+    async with session_factory() as session:
+        server = make_server(awg_interface="awg0")
+        session.add(server)
+        await session.commit()
+        user = make_user()
+        session.add_all([
+            make_config(user, "ok", server, public_key="A"),
+            make_config(user, "paused", server, public_key="B", is_active=False),
+            make_config(user, "lost", server, public_key="C"),
+            make_config(user, "amnezia", server, public_key="D", protocol_type="awg"),
+            # Старый AWG конфиг без ключа — его пир узнаётся по адресу
+            make_config(
+                user, "legacy", server, public_key="UNKNOWN", protocol_type="awg",
+                client_ip="10.8.0.9", allowed_ips="10.8.0.9/32"
+            ),
+            make_config(user, "xray", server, protocol_type="v2ray", peer_name="xray_1"),
+            PooledPeer(server_id=server.id, protocol_type="wg", peer_name="wg_pool_1", public_key="P"),
+        ])
+        await session.commit()
+    return server
+
+
+async def test_discrepancies_fixed_only_after_confirmation(server, remote, clock):
+    remote.wg = {"A": "10.0.0.2/32", "B": "10.0.0.3/32", "P": "10.0.0.4/32", "ORPHAN": "10.0.0.5/32"}
+    remote.awg = {"D": "10.8.0.2/32", "X": "10.8.0.9/32", "AWG_ORPHAN": "10.8.0.7/32"}
+    remote.v2ray = {"xray_1": True, "stray": True}
+
+    report = await ReconciliationService._reconcile_server(server)
+    # wg: сирота, отключённый и пропавший; awg: сирота; v2ray: сирота
+    assert (report.fixed, report.pending) == (0, 5)
+    assert remote.removed == remote.enabled == remote.v2ray_updates == []
+
+    clock.now += CONFIRM_AFTER_SECONDS
+    report = await ReconciliationService._reconcile_server(server)
+
+    assert report.pending == 0
+    assert report.removed == {"wg": 1, "awg": 1, "v2ray": 1}
+    assert (report.enabled, report.disabled) == (1, 1)
+    assert remote.removed == [
+        (["ORPHAN"], True, server.wg_interface),
+        (["B"], False, server.wg_interface),
+        # wg-quick save не знает awg0
+        (["AWG_ORPHAN"], False, "awg0"),
+    ]
+    assert remote.enabled == [("C", server.wg_interface)]
+    assert remote.v2ray_updates == [(["stray"], [], [])]
+    assert report.peers == {"wg": 4, "awg": 3, "v2ray": 2}
+
+
+async def test_fresh_discrepancy_restarts_confirmation(server, remote, clock):
+    remote.wg = {"A": "10.0.0.2/32", "B": "10.0.0.3/32", "C": "10.0.0.6/32"}
+    remote.awg = {"D": "10.8.0.2/32", "X": "10.8.0.9/32"}
+    remote.v2ray = {"xray_1": True}
+
+    await ReconciliationService._reconcile_server(server)
+    clock.now += CONFIRM_AFTER_SECONDS / 2
+    remote.wg["LATE"] = "10.0.0.7/32"
+    await ReconciliationService._reconcile_server(server)
+    clock.now += CONFIRM_AFTER_SECONDS / 2
+    report = await ReconciliationService._reconcile_server(server)
+
+    # Отключённый B подтверждён, сирота LATE замечен только полцикла назад
+    assert remote.removed == [(["B"], False, server.wg_interface)]
+    assert report.pending == 1
+
+
+async def test_unkeyed_config_without_address_blocks_orphan_removal(server, remote, clock, session_factory):
+    async with session_factory() as session:
+        session.add(make_config(
+            make_user(2000), "blind", server, public_key="UNKNOWN", protocol_type="awg",
+            client_ip="", allowed_ips=""
+        ))
+        await session.commit()
+    remote.wg = {"A": "10.0.0.2/32", "B": "10.0.0.3/32", "C": "10.0.0.6/32"}
+    remote.awg = {"D": "10.8.0.2/32", "X": "10.8.0.9/32", "Y": "10.8.0.10/32"}
+    remote.v2ray = {"xray_1": True}
+
+    await ReconciliationService._reconcile_server(server)
+    clock.now += CONFIRM_AFTER_SECONDS
+    report = await ReconciliationService._reconcile_server(server)
+
+    assert "awg" not in report.removed
+    assert all(interface != "awg0" for _, _, interface in remote.removed)
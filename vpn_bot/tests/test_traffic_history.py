@@ -0,0 +1,111 @@
+"""Накопление трафика одним набором запросов (TrafficHistory.accumulate)"""
+
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+
+from database.models import Config, TrafficRollup, TrafficSample
+from services.traffic_history import PERIOD_DAY, PERIOD_HOUR, TrafficHistory
+from conftest import make_config, make_server, make_user
+
+pytestmark = pytest.mark.asyncio
+
+T0 = datetime(2026, 3, 1, 10, 15)
+
+
+def feed(**counters):
+    return {key: {"received": received, "sent": sent} for key, (received, sent) in counters.items()}
+
+
+@pytest_asyncio.fixture
+async def configs(session_factory):
+    async with session_factory() as session:
+        server = make_server()
+        session.add(server)
+        await session.commit()
+        user = make_user()
+        session.add_all([
+            make_config(user, "wg1", server, public_key="key1"),
+            make_config(user, "wg2", server, public_key="key2"),
+            make_config(user, "xray", server, protocol_type="v2ray", public_key="-", peer_name="xray_pool_1"),
+            make_config(user, "off", server, public_key="key_off", is_active=False),
+        ])
+        await session.commit()
+    return session_factory
+
+
+async def load(session, name: str) -> Config:
+    return (await session.execute(
+        select(Config).where(Config.name == name).execution_options(populate_existing=True)
+    )).scalar_one()
+
+
+async def test_first_sample_is_baseline_only(configs):
+    async with configs() as session:
+        updated, samples = await TrafficHistory.accumulate(
+            session, feed(key1=(100, 50), key_off=(10, 10), unknown=(5, 5)), at=T0
+        )
+        await session.commit()
+
+        assert (updated, samples) == (1, 0)
+        config = await load(session, "wg1")
+        assert (config.last_wg_received, config.last_wg_sent, config.last_traffic_update) == (100, 50, T0)
+        assert (config.total_received, config.total_sent) == (0, 0)
+        assert (await load(session, "off")).last_traffic_update is None
+        assert (await session.execute(select(TrafficSample))).scalars().all() == []
+
+
+async def test_deltas_go_to_samples_and_rollups(configs):
+    async with configs() as session:
+        await TrafficHistory.accumulate(session, feed(key1=(100, 50), key2=(7, 7), xray_pool_1=(1000, 2000)), at=T0)
+        t1 = T0 + timedelta(minutes=5)
+        updated, samples = await TrafficHistory.accumulate(
+            session, feed(key1=(150, 80), key2=(7, 7), xray_pool_1=(1500, 2100)), at=t1
+        )
+        await session.commit()
+
+        # key2 не изменился — замера нет, но точка отсчёта обновлена
+        assert (updated, samples) == (3, 2)
+        rows = {
+            (row.config_id, row.received, row.sent)
+            for row in (await session.execute(select(TrafficSample))).scalars().all()
+        }
+        wg1, xray = await load(session, "wg1"), await load(session, "xray")
+        assert rows == {(wg1.id, 50, 30), (xray.id, 500, 100)}
+
+        t2 = T0 + timedelta(minutes=10)
+        await TrafficHistory.accumulate(session, feed(key1=(170, 90)), at=t2)
+        await session.commit()
+
+        rollups = {
+            (row.period, row.bucket_start, row.received, row.sent)
+            for row in (await session.execute(
+                select(TrafficRollup).where(TrafficRollup.config_id == wg1.id)
+            )).scalars().all()
+        }
+        assert rollups == {
+            (PERIOD_HOUR, datetime(2026, 3, 1, 10), 70, 40),
+            (PERIOD_DAY, datetime(2026, 3, 1), 70, 40),
+        }
+
+
+async def test_counter_reset_moves_last_values_to_total(configs):
+    async with configs() as session:
+        await TrafficHistory.accumulate(session, feed(key1=(100, 50)), at=T0)
+        t1 = T0 + timedelta(minutes=5)
+        await TrafficHistory.accumulate(session, feed(key1=(30, 20)), at=t1)
+        await session.commit()
+
+        config = await load(session, "wg1")
+        assert (config.total_received, config.total_sent) == (100, 50)
+        assert (config.last_wg_received, config.last_wg_sent) == (30, 20)
+        sample = (await session.execute(select(TrafficSample))).scalar_one()
+        assert (sample.received, sample.sent) == (30, 20)
+
+
+async def test_empty_feed_does_nothing(configs):
+    async with configs() as session:
+        assert await TrafficHistory.accumulate(session, feed(key1=(0, 0)), at=T0) == (0, 0)
+        assert await TrafficHistory.accumulate(session, {}, at=T0) == (0, 0)